@@ -1,13 +1,30 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort, url_for, jsonify
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (Flask, render_template, request, flash, redirect, session, g, abort, url_for, jsonify,
+                   Response, stream_with_context)
 from sqlalchemy.exc import IntegrityError
 from functools import wraps
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import func
+import click
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
 from models import db, connect_db, User, Message
+from passwords import hasher
+from timeline import connect_timeline
+from pagination import decode_cursor, decode_rank_cursor, page_of, paginate
+from search import search_messages, reindex
+from migrations import upgrade
+from user_cache import SNAPSHOT_FIELDS, connect_user_cache, load_current_user
+from fragments import connect_fragments
+from http_cache import connect_http_cache, not_modified
+from assets import build_assets, connect_assets
+from images import connect_images
+from export import export_user
+from batch import follow_users, post_messages, toggle_likes
+from stream import connect_pubsub, message_stream
+from metrics import connect_metrics
+from replicas import connect_replicas, read_replica, replica_binds
 
 CURR_USER_KEY = "curr_user"
 
@@ -21,10 +38,119 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+# Each process keeps DB_POOL_SIZE connections open, and opens up to
+# DB_MAX_OVERFLOW more under load. Connections are checked before use
+# (unless DB_POOL_PRE_PING=0) and replaced after DB_POOL_RECYCLE seconds.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+}
+
+# Read-only pages are served from DATABASE_REPLICA_URLS (comma-separated),
+# if set, except to users who wrote in the last REPLICA_STICKY_SECONDS.
+app.config['SQLALCHEMY_BINDS'] = replica_binds(os.environ.get('DATABASE_REPLICA_URLS', ''))
+app.config['DATABASE_REPLICAS'] = list(app.config['SQLALCHEMY_BINDS'])
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
 
+# Authors with more followers than this are merged into home feeds at read
+# time instead of being fanned out to every follower's timeline on write.
+app.config['TIMELINE_FANOUT_LIMIT'] = (
+    int(os.environ['TIMELINE_FANOUT_LIMIT'])
+    if 'TIMELINE_FANOUT_LIMIT' in os.environ else None)
+app.config['TIMELINE_FOLLOW_BACKFILL'] = int(
+    os.environ.get('TIMELINE_FOLLOW_BACKFILL', 800))
+
+# Feeds are paginated by cursor; clients may ask for up to the max per page.
+app.config['FEED_PAGE_SIZE'] = int(os.environ.get('FEED_PAGE_SIZE', 20))
+app.config['FEED_MAX_PAGE_SIZE'] = int(os.environ.get('FEED_MAX_PAGE_SIZE', 100))
+
+# The user directory shows this many cards per page; searches only rank
+# and page through the best USER_SEARCH_LIMIT matches.
+app.config['USERS_PAGE_SIZE'] = int(os.environ.get('USERS_PAGE_SIZE', 24))
+app.config['USER_SEARCH_LIMIT'] = int(os.environ.get('USER_SEARCH_LIMIT', 240))
+
+# Snapshots of logged-in users are cached so g.user doesn't need a query.
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+
+# bcrypt work factor for new hashes, and how many can run at once (by
+# default the CPU count). Requests still wait for their hash, so this
+# limits CPU, not tied-up request workers. Existing hashes are upgraded to
+# the current work factor on login.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = (
+    int(os.environ['PASSWORD_HASH_WORKERS'])
+    if 'PASSWORD_HASH_WORKERS' in os.environ else None)
+
+# Rendered message list items are cached; this bounds how many are kept.
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 20000))
+
+# Resized avatars and headers are kept on disk, up to this many bytes.
+# Originals bigger than IMAGE_MAX_SOURCE_BYTES aren't fetched.
+app.config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR')
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['IMAGE_MAX_SOURCE_BYTES'] = int(
+    os.environ.get('IMAGE_MAX_SOURCE_BYTES', 10 * 1024 * 1024))
+app.config['IMAGE_FETCH_TIMEOUT'] = int(os.environ.get('IMAGE_FETCH_TIMEOUT', 5))
+# Sources that fail aren't fetched again for this many seconds.
+app.config['IMAGE_FAILURE_TTL'] = int(os.environ.get('IMAGE_FAILURE_TTL', 300))
+
+# Batch API requests may carry up to this many items.
+app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 500))
+
+# Live feed streams: 'postgres' (LISTEN/NOTIFY, the default on Postgres)
+# or 'local' (this process only). Streams send a keepalive comment every
+# STREAM_KEEPALIVE seconds and end after STREAM_MAX_SECONDS, when browsers
+# reconnect and catch up on at most STREAM_BACKLOG messages.
+app.config['PUBSUB_BACKEND'] = os.environ.get('PUBSUB_BACKEND')
+app.config['STREAM_KEEPALIVE'] = int(os.environ.get('STREAM_KEEPALIVE', 15))
+app.config['STREAM_MAX_SECONDS'] = int(os.environ.get('STREAM_MAX_SECONDS', 300))
+app.config['STREAM_BACKLOG'] = int(os.environ.get('STREAM_BACKLOG', 100))
+
+# Served over ASGI (see asgi.py), requests the async API doesn't handle
+# run on a pool of this many threads.
+app.config['ASGI_WSGI_THREADS'] = int(os.environ.get('ASGI_WSGI_THREADS', 10))
+
+# Exports read and write this many rows at a time.
+app.config['EXPORT_BATCH_SIZE'] = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+# Requests slower than this are logged with their SQL (unset: off), and
+# /metrics requires this bearer token if it's set.
+app.config['SLOW_REQUEST_MS'] = (
+    int(os.environ['SLOW_REQUEST_MS'])
+    if 'SLOW_REQUEST_MS' in os.environ else None)
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# The debug toolbar is a development tool; only load it in debug mode.
+if app.debug:
+    from flask_debugtoolbar import DebugToolbarExtension
+    toolbar = DebugToolbarExtension(app)
+
+metrics = connect_metrics(app, hasher)
 connect_db(app)
+connect_replicas(app, db)
+hasher.init_app(app)
+timeline = connect_timeline(app)
+user_cache = connect_user_cache(app)
+fragments = connect_fragments(app)
+connect_http_cache(app)
+connect_assets(app)
+images = connect_images(app)
+pubsub = connect_pubsub(app)
+
+metrics.registry.callback('warbler_fragment_cache_hits_total', "Message fragments served from cache.",
+                          lambda: fragments.stats()['hits'], type='counter')
+metrics.registry.callback('warbler_fragment_cache_misses_total', "Message fragments rendered.",
+                          lambda: fragments.stats()['misses'], type='counter')
+metrics.registry.callback('warbler_bcrypt_queue_depth', "Password hashes waiting or running.",
+                          lambda: hasher.queue_depth)
+metrics.registry.callback('warbler_stream_subscribers', "Open live feed streams in this process.",
+                          pubsub.subscriber_count)
 
 def login_required(f):
     @wraps(f)
@@ -35,16 +161,71 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def get_page_args(decode=decode_cursor):
+    """Read the `before` cursor and `limit` page size from the querystring.
+
+    Aborts with 400 on a malformed cursor.
+    """
+
+    cursor = request.args.get('before')
+    try:
+        before = decode(cursor) if cursor else None
+    except ValueError:
+        abort(400)
+
+    size = request.args.get('limit', app.config['FEED_PAGE_SIZE'], type=int)
+    size = max(1, min(size, app.config['FEED_MAX_PAGE_SIZE']))
+    return before, size
+
+def get_list_args(default_size, key='after'):
+    """Read an id to page from (`after`, or `key`) and the `limit` page size.
+
+    For lists paged by id rather than by cursor.
+    """
+
+    size = request.args.get('limit', default_size, type=int)
+    size = max(1, min(size, app.config['FEED_MAX_PAGE_SIZE']))
+    return request.args.get(key, type=int), size
+
+def get_batch(key):
+    """Read the list of items under `key` in the JSON body.
+
+    Aborts with 400 unless it's a non-empty list of at most BATCH_MAX_ITEMS.
+    """
+
+    items = (request.get_json(silent=True) or {}).get(key)
+    if not isinstance(items, list) or not 0 < len(items) <= app.config['BATCH_MAX_ITEMS']:
+        abort(400)
+    return items
+
+def commit_batch(results):
+    """Commit a batch written by batch.py and return its per-item results.
+
+    A batch that races a concurrent write to the same rows is rolled back
+    whole with a 409, and can be retried.
+    """
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify(error="conflicting concurrent write, retry the batch"), 409
+    return jsonify(results=results)
+
 ##############################################################################
 # User signup/login/logout
 
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a cached read-only snapshot; use g.user.instance to get the
+    User row when a view needs to change it.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(user_cache, session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -111,6 +292,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # save the password hash if authenticate upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -130,56 +313,137 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@read_replica
 def list_users():
     """Page with listing of users.
 
     Can take a 'q' param in querystring to search by that username.
+
+    Without a search, pages through everyone in id order using an 'after'
+    param; search results are ranked and paged with a 'page' param.
     """
 
     search = request.args.get('q')
+    size = app.config['USERS_PAGE_SIZE']
 
     if not search:
-        users = User.query.all()
+        users = User.directory(after=request.args.get('after', type=int),
+                               limit=size + 1)
+        next_args = {'after': users[size - 1].id} if len(users) > size else None
     else:
-        users = User.query.filter(User.username.ilike(f"%{search}%")).all()
+        page = max(request.args.get('page', 1, type=int), 1)
+        offset = (page - 1) * size
+        limit = min(size + 1, app.config['USER_SEARCH_LIMIT'] - offset)
+        users = User.search(search, offset=offset, limit=limit) if limit > 0 else []
+        next_args = {'q': search, 'page': page + 1} if len(users) > size else None
+
+    users = users[:size]
 
-    return render_template('users/index.html', users=users)
+    if g.user:
+        g.user.cache_following()
+
+    return render_template('users/index.html', users=users, next_args=next_args)
 
 @app.route('/users/<int:user_id>')
+@read_replica
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
 
-    # snagging messages in order from the database;
+    # snagging messages in order from the database, one page at a time;
     # user.messages won't be in order by default
-    if g.user:
-        likes = [like.id for like in g.user.likes]
-    else:
-        likes = []
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    likes = g.user.cache_likes() if g.user else set()
+    before, size = get_page_args()
+    query = (Message.query
+             .options(joinedload(Message.user, innerjoin=True))
+             .filter(Message.user_id == user_id))
+    messages, next_cursor = paginate(query, Message.timestamp, Message.id, before, size)
+
+    cached = not_modified(
+        [getattr(user, field) for field in SNAPSHOT_FIELDS],
+        g.user and g.user.is_following(user),
+        [(msg.id, msg.likes_count, msg.id in likes) for msg in messages])
+    if cached:
+        return cached
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           fragments=fragments.render(messages),
+                           likes=likes, next_cursor=next_cursor)
+
+@app.route('/api/users/<int:user_id>')
+@read_replica
+def user_api(user_id):
+    """Get endpoint for a user's public profile."""
+
+    user = User.query.get_or_404(user_id)
+    return jsonify(user=user.serialize())
+
+def follow_list(page):
+    """A page of a user's `following_page` or `followers_page`, from the querystring.
+
+    Returns (user, is_following) pairs and the id to pass as `after` for
+    the next page.
+    """
+
+    after, size = get_list_args(app.config['USERS_PAGE_SIZE'])
+    users = page(g.user.id, after=after, limit=size + 1)
+    next_after = users[size - 1][0].id if len(users) > size else None
+    return users[:size], next_after
+
+def user_card(user, is_following):
+    return {"id": user.id,
+            "username": user.username,
+            "image_url": user.image_url,
+            "header_image_url": user.header_image_url,
+            "bio": user.bio,
+            "is_following": is_following}
 
 @app.route('/users/<int:user_id>/following')
+@read_replica
 @login_required
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show a page of the people this user is following."""
+
+    user = User.query.get_or_404(user_id)
+    users, next_after = follow_list(user.following_page)
+    return render_template('users/following.html', user=user, users=users,
+                           next_after=next_after)
+
+@app.route('/api/users/<int:user_id>/following')
+@read_replica
+@login_required
+def following_api(user_id):
+    """Get endpoint for a page of the people this user is following.
+
+    Each says whether the current user follows them too. Pass the
+    returned `next` value as `after` to get the following page.
+    """
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users, next_after = follow_list(user.following_page)
+    return jsonify(users=[user_card(*row) for row in users], next=next_after)
 
 @app.route('/users/<int:user_id>/followers')
+@read_replica
 @login_required
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show a page of the followers of this user."""
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users, next_after = follow_list(user.followers_page)
+    return render_template('users/followers.html', user=user, users=users,
+                           next_after=next_after)
+
+@app.route('/api/users/<int:user_id>/followers')
+@read_replica
+@login_required
+def followers_api(user_id):
+    """Get endpoint for a page of this user's followers; see `following_api`."""
+
+    user = User.query.get_or_404(user_id)
+    users, next_after = follow_list(user.followers_page)
+    return jsonify(users=[user_card(*row) for row in users], next=next_after)
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 @login_required
@@ -189,34 +453,95 @@ def add_follow(follow_id):
     followed_user = User.query.get_or_404(follow_id)
     if followed_user.id == g.user.id:
         return abort(403)
-    g.user.following.append(followed_user)
+    user = g.user.instance
+    user.following.append(followed_user)
+    user.adjust_counts(following_count=1)
+    followed_user.adjust_counts(followers_count=1)
+    db.session.flush()
+    timeline.add_follow(user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
+@app.route('/api/follows/batch', methods=['POST'])
+@login_required
+def add_follows_batch_api():
+    """Follow many users at once: {"user_ids": [...]}"""
+    user_ids = get_batch("user_ids")
+    return commit_batch(follow_users(g.user.instance, user_ids, timeline))
+
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 @login_required
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
     followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    user = g.user.instance
+    user.following.remove(followed_user)
+    user.adjust_counts(following_count=-1)
+    followed_user.adjust_counts(followers_count=-1)
+    timeline.remove_follow(user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
+def liked_list(user):
+    """A page of `user.liked_messages` from the querystring, and the next `before` id."""
+
+    before, size = get_list_args(app.config['FEED_PAGE_SIZE'], key='before')
+    messages = user.liked_messages(g.user.id, before=before, limit=size + 1)
+    next_before = messages[size - 1][0].id if len(messages) > size else None
+    return messages[:size], next_before
+
 @app.route('/users/<int:user_id>/likes')
+@read_replica
 @login_required
 def show_likes(user_id):
-    """Show list of messages this user has liked."""
+    """Show a page of the messages this user has liked, newest first."""
+    user = User.query.get_or_404(user_id)
+    messages, next_before = liked_list(user)
+    likes = {msg.id for msg, liked in messages if liked}
+    messages = [msg for msg, liked in messages]
+    return render_template('users/likes.html', user=user, messages=messages,
+                           fragments=fragments.render(messages), likes=likes,
+                           next_before=next_before)
+
+@app.route('/api/users/<int:user_id>/likes')
+@read_replica
+@login_required
+def likes_api(user_id):
+    """Get endpoint for a page of the messages this user has liked, newest first.
+
+    Each says whether the current user likes it too. Pass the returned
+    `next` value as `before` to get the following page.
+    """
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    messages, next_before = liked_list(user)
+    return jsonify(messages=[{**msg.serialize(), "liked": liked} for msg, liked in messages],
+                   next=next_before)
+
+@app.route('/api/users/<int:user_id>/export')
+@login_required
+def export_user_api(user_id):
+    """Stream all of a user's data as NDJSON; users can only export themselves."""
+    if user_id != g.user.id:
+        return abort(403)
+
+    chunks = export_user(user_id, app.config['EXPORT_BATCH_SIZE'])
+    if chunks is None:
+        return abort(404)
+
+    response = Response(stream_with_context(chunks), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename="warbler-{user_id}.ndjson"'
+    # Let proxies pass chunks through as they're written
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/users/profile', methods=["GET", "POST"])
 @login_required
 def profile():
     """Update profile for current user."""
-    user = g.user
+    user = g.user.instance
 
     form = UserEditForm(obj=user)
     if form.image_url.data == "/static/images/default-pic.png":
@@ -231,6 +556,7 @@ def profile():
             user.header_image_url = form.header_image_url.data.strip() or "/static/images/warbler-hero.jpg"
             user.location = form.location.data.strip() or None
             user.bio = form.bio.data.strip() or None
+            user.profile_version = User.profile_version + 1
             try:
                 db.session.commit()
             except IntegrityError:
@@ -252,7 +578,10 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user = g.user.instance
+    timeline.remove_user(user.id)
+    user.remove_from_counts()
+    db.session.delete(user)
     db.session.commit()
 
     return redirect("/signup")
@@ -271,7 +600,11 @@ def messages_add():
 
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        user = g.user.instance
+        user.messages.append(msg)
+        user.adjust_counts(messages_count=1)
+        timeline.add_message(msg)
+        pubsub.publish(msg.id, user.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -283,16 +616,121 @@ def messages_add():
 def messages_add_api():
     """Post endpoint for adding new messages"""
     msg = Message(text=request.json["text"])
-    g.user.messages.append(msg)
+    user = g.user.instance
+    user.messages.append(msg)
+    user.adjust_counts(messages_count=1)
+    timeline.add_message(msg)
+    pubsub.publish(msg.id, user.id)
     db.session.commit()
     response_json = jsonify(message=msg.serialize())
     return (response_json, 201)
 
+@app.route('/api/messages/batch', methods=["POST"])
+@login_required
+def messages_add_batch_api():
+    """Post endpoint for adding many messages: {"messages": [{"text": ...}, ...]}"""
+    items = get_batch("messages")
+    texts = [item.get("text") if isinstance(item, dict) else None for item in items]
+    results = post_messages(g.user.instance, texts, timeline)
+    for result in results:
+        if result['status'] == 'created':
+            pubsub.publish(result['message']['id'], g.user.id)
+    return commit_batch(results)
+
+@app.route('/api/messages', methods=["GET"])
+@login_required
+def messages_feed_api():
+    """Get endpoint for a page of messages.
+
+    Returns the current user's home feed, or a single user's messages if
+    a `user_id` param is given. Pass the returned `next` cursor as `before`
+    to get the following page.
+    """
+    before, size = get_page_args()
+    user_id = request.args.get('user_id', type=int)
+
+    if user_id is None:
+        messages, next_cursor = page_of(
+            timeline.home_messages(g.user.id, limit=size + 1, before=before), size)
+    else:
+        query = (Message.query
+                 .options(joinedload(Message.user, innerjoin=True))
+                 .filter(Message.user_id == user_id))
+        messages, next_cursor = paginate(query, Message.timestamp, Message.id, before, size)
+
+    return jsonify(messages=[msg.serialize() for msg in messages], next=next_cursor)
+
+@app.route('/api/stream')
+@login_required
+def stream_api():
+    """Server-Sent Events stream of new messages from followed users.
+
+    Resumes after the message id in the Last-Event-ID header (sent by
+    reconnecting browsers) or the `after` param. Under ASGI, asgi.py
+    serves this path without taking a thread.
+    """
+    after = request.headers.get('Last-Event-ID') or request.args.get('after')
+    if after is not None:
+        try:
+            after = int(after)
+        except ValueError:
+            abort(400)
+
+    def serialize(msg):
+        data = msg.serialize()
+        data["user"]["image_url"] = images.url(msg.user.image_url, "timeline")
+        return data
+
+    events = message_stream(pubsub, g.user.id, serialize, after=after,
+                            keepalive=app.config['STREAM_KEEPALIVE'],
+                            max_seconds=app.config['STREAM_MAX_SECONDS'],
+                            backlog=app.config['STREAM_BACKLOG'])
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/messages/<int:message_id>')
+@read_replica
+def message_api(message_id):
+    """Get endpoint for a single message."""
+    msg = (Message.query
+           .options(joinedload(Message.user, innerjoin=True))
+           .get_or_404(message_id))
+    return jsonify(message=msg.serialize())
+
+@app.route('/api/messages/<int:message_id>/likes')
+def message_likes_api(message_id):
+    """Get endpoint for a page of the users who like a message.
+
+    Users are listed in id order; pass the returned `next` value as
+    `after` to get the following page.
+    """
+    msg = Message.query.get_or_404(message_id)
+    after, size = get_list_args(app.config['USERS_PAGE_SIZE'])
+
+    users = msg.likers(after=after, limit=size + 1)
+    next_after = users[size - 1].id if len(users) > size else None
+
+    return jsonify(likes_count=msg.likes_count,
+                   users=[{"id": user.id,
+                           "username": user.username,
+                           "image_url": user.image_url} for user in users[:size]],
+                   next=next_after)
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@read_replica
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
+    msg = (Message.query
+           .options(joinedload(Message.user, innerjoin=True))
+           .get_or_404(message_id))
+
+    cached = not_modified(msg.id, msg.user.username, msg.user.image_url,
+                          g.user and g.user.is_following(msg.user))
+    if cached:
+        return cached
+
     return render_template('messages/show.html', message=msg)
 
 @app.route('/messages/<int:msg_id>/like', methods=['POST'])
@@ -302,11 +740,7 @@ def like_message(msg_id):
     liked_msg = Message.query.get_or_404(msg_id)
     if liked_msg.user_id == g.user.id:
         return abort(403)
-    user_likes = g.user.likes
-    if liked_msg in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_msg]
-    else:
-        g.user.likes.append(liked_msg)
+    g.user.instance.toggle_like(liked_msg.id)
     db.session.commit()
 
     return redirect("/")
@@ -318,18 +752,19 @@ def like_message_api():
     liked_msg = Message.query.get_or_404(request.json["msg_id"])
     if liked_msg.user_id == g.user.id:
         return abort(403)
-    user_likes = g.user.likes
-    if liked_msg in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_msg]
-        response_json = jsonify(message="unliked")
-
-    else:
-        g.user.likes.append(liked_msg)
-        response_json = jsonify(message="liked")
+    liked = g.user.instance.toggle_like(liked_msg.id)
+    response_json = jsonify(message="liked" if liked else "unliked")
     db.session.commit()
     
     return (response_json, 200)
 
+@app.route('/api/likes/batch', methods=['POST'])
+@login_required
+def like_messages_batch_api():
+    """endpoint to toggle likes on many messages: {"message_ids": [...]}"""
+    message_ids = get_batch("message_ids")
+    return commit_batch(toggle_likes(g.user.instance, message_ids))
+
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
@@ -338,32 +773,69 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    timeline.remove_message(msg)
+    fragments.forget(msg)
+    msg.remove_from_counts()
     db.session.delete(msg)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
+##############################################################################
+# Search routes:
+
+@app.route('/search')
+def search_page():
+    """Show messages matching the 'q' param, best matches first."""
+
+    term = request.args.get('q', '').strip()
+    before, size = get_page_args(decode=decode_rank_cursor)
+    messages, next_cursor = search_messages(term, before, size) if term else ([], None)
+    likes = g.user.cache_likes() if g.user else set()
+
+    return render_template('messages/search.html', term=term, messages=messages,
+                           fragments=fragments.render(messages),
+                           likes=likes, next_cursor=next_cursor)
+
+@app.route('/api/search')
+def search_api():
+    """Get endpoint for a page of messages matching the 'q' param."""
+
+    term = request.args.get('q', '').strip()
+    before, size = get_page_args(decode=decode_rank_cursor)
+    messages, next_cursor = search_messages(term, before, size) if term else ([], None)
+
+    return jsonify(messages=[msg.serialize() for msg in messages], next=next_cursor)
+
 ##############################################################################
 # Homepage and error pages
 
 @app.route('/')
+@read_replica
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-        like_ids = [like.id for like in g.user.likes]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        like_ids = g.user.cache_likes()
+        before, size = get_page_args()
+        messages, next_cursor = page_of(
+            timeline.home_messages(g.user.id, limit=size + 1, before=before), size)
 
-        return render_template('home.html', messages=messages, likes=like_ids)
+        cached = not_modified([(msg.id, msg.likes_count, msg.id in like_ids,
+                                msg.user.profile_version) for msg in messages])
+        if cached:
+            return cached
+
+        # The first page streams newer messages in as they're posted
+        stream_after = (max((msg.id for msg in messages), default=0)
+                        if before is None else None)
+
+        return render_template('home.html', messages=messages, likes=like_ids,
+                               fragments=fragments.render(messages),
+                               next_cursor=next_cursor, stream_after=stream_after)
 
     else:
         return render_template('home-anon.html')
@@ -375,18 +847,46 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Command-line tools (run with `flask <command>`)
+
+@app.cli.command('backfill-timelines')
+def backfill_timelines():
+    """Rebuild every user's home timeline from existing follows/messages."""
+
+    written = timeline.backfill()
+    db.session.commit()
+    click.echo(f"Wrote {written} timeline entries.")
+
+@app.cli.command('reindex-search')
+def reindex_search():
+    """Build the full-text search index for all existing messages."""
+
+    reindex()
+    db.session.commit()
+    click.echo("Rebuilt the message search index.")
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Repair drift in users' and messages' counter columns."""
+
+    users = User.reconcile_counts()
+    messages = Message.reconcile_counts()
+    db.session.commit()
+    click.echo(f"Repaired counts for {users} users and {messages} messages.")
+
+@app.cli.command('build-assets')
+def build_static_assets():
+    """Fingerprint and precompress static files into static/dist."""
+
+    manifest = build_assets(app.static_folder)
+    click.echo(f"Built {len(manifest)} assets; restart the app to serve them.")
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Bring an existing database's tables, columns and indexes up to date."""
+
+    applied = upgrade()
+    db.session.commit()
+    for version in applied:
+        click.echo(f"Applied {version}")
+    click.echo("Schema is up to date.")
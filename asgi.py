@@ -0,0 +1,387 @@
+"""Async serving for the JSON API.
+
+    uvicorn asgi:app --workers 4
+
+The busiest JSON API endpoints are served by async views on an asyncio
+database driver (asyncpg, or aiosqlite for SQLite). A request waiting on
+the database holds no thread, so one process can keep thousands of API
+connections open. Every other request goes through to the Flask app,
+which runs on a pool of ASGI_WSGI_THREADS threads as it would under a
+WSGI server.
+
+The async views run the same statements over the same models, read the
+same session cookie and return the same JSON as the Flask views they
+stand in for:
+
+    GET  /api/messages               home feed, or a user's (?user_id=)
+    POST /api/messages               post a message: {"text": ...}
+    POST /api/messages/like          toggle a like: {"msg_id": ...}
+    GET  /api/messages/<id>          one message
+    GET  /api/messages/<id>/likes    users who like a message
+    GET  /api/users/<id>             a user's public profile
+    GET  /api/stream                 live feed (Server-Sent Events)
+
+Live feed streams stay open for minutes at a time, so they must not take
+one of the Flask app's threads: a handful of open tabs would stall every
+other page. Writes set the same read-from-the-primary flag in the session
+cookie as Flask's (see replicas.py).
+
+Errors are JSON, and views that need a login answer 401 instead of
+redirecting. These requests aren't counted in /metrics.
+"""
+
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from functools import wraps
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import joinedload, sessionmaker
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import app as flask_app, CURR_USER_KEY
+from batch import MESSAGE_MAX_LENGTH
+from models import Likes, Message, User
+from pagination import before_key, decode_cursor, page_of
+from replicas import PRIMARY_UNTIL, engine_options
+from stream import async_message_stream
+from timeline import merge_newest
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_url(url, root_path):
+    """Database `url` with its asyncio driver.
+
+    Relative SQLite paths are taken from `root_path`, as Flask-SQLAlchemy does.
+    """
+
+    sa_url = make_url(url)
+    backend = sa_url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend} databases")
+
+    sa_url = sa_url.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == 'sqlite' and sa_url.database not in (None, '', ':memory:'):
+        sa_url = sa_url.set(database=os.path.join(root_path, sa_url.database))
+    return sa_url
+
+
+def int_arg(request, name, default=None):
+    """Querystring param `name` as an int, or `default` if missing or not one."""
+
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+async def insert_or_ignore(session, table, **values):
+    """`models.insert_or_ignore`, on an async session."""
+
+    dialect = session.bind.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}[dialect]
+        result = await session.execute(insert(table).values(**values)
+                                       .on_conflict_do_nothing())
+        return result.rowcount == 1
+
+    try:
+        async with session.begin_nested():
+            await session.execute(table.insert().values(**values))
+    except IntegrityError:
+        return False
+    return True
+
+
+async def toggle_like(session, user, message_id):
+    """`User.toggle_like`, on an async session."""
+
+    unliked = (await session.execute(
+        delete(Likes)
+        .where(Likes.user_id == user.id, Likes.message_id == message_id)
+        .execution_options(synchronize_session=False)
+    )).rowcount
+
+    if unliked:
+        delta = -1
+    elif await insert_or_ignore(session, Likes.__table__,
+                                user_id=user.id, message_id=message_id):
+        delta = 1
+    else:
+        return True
+
+    user.adjust_counts(likes_count=delta)
+    await session.execute(update(Message)
+                          .where(Message.id == message_id)
+                          .values(likes_count=Message.likes_count + delta)
+                          .execution_options(synchronize_session=False))
+    return delta == 1
+
+
+def make_asgi_app(flask_app):
+    """An ASGI app serving the async API and passing the rest to `flask_app`."""
+
+    config = flask_app.config
+    url = async_url(config['SQLALCHEMY_DATABASE_URI'], flask_app.root_path)
+    engine = create_async_engine(url, **engine_options(
+        url, config.get('SQLALCHEMY_ENGINE_OPTIONS', {})))
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    timeline = flask_app.extensions['timeline']
+    pubsub = flask_app.extensions['pubsub']
+    images = flask_app.extensions['images']
+    session_interface = flask_app.session_interface
+    cookies = session_interface.get_signing_serializer(flask_app)
+
+    def session_data(request):
+        """The contents of the Flask session cookie, or {}."""
+
+        cookie = request.cookies.get(config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return {}
+        try:
+            return cookies.loads(cookie, max_age=int(
+                flask_app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return {}
+
+    def login_required(view):
+        @wraps(view)
+        async def decorated_view(request):
+            request.state.session = session_data(request)
+            request.state.user_id = request.state.session.get(CURR_USER_KEY)
+            if request.state.user_id is None:
+                raise HTTPException(401)
+            return await view(request)
+        return decorated_view
+
+    def stick_to_primary(request, response):
+        """As `replicas.connect_replicas` does after a write: have this
+        user's requests read from the primary for a while."""
+
+        if not config.get('DATABASE_REPLICAS'):
+            return response
+
+        data = dict(request.state.session)
+        data[PRIMARY_UNTIL] = time.time() + config['REPLICA_STICKY_SECONDS']
+        expires = None
+        if data.get('_permanent'):
+            expires = datetime.now(timezone.utc) + flask_app.permanent_session_lifetime
+        response.set_cookie(config['SESSION_COOKIE_NAME'], cookies.dumps(data),
+                            expires=expires,
+                            path=session_interface.get_cookie_path(flask_app),
+                            domain=session_interface.get_cookie_domain(flask_app),
+                            secure=session_interface.get_cookie_secure(flask_app),
+                            httponly=session_interface.get_cookie_httponly(flask_app),
+                            samesite=session_interface.get_cookie_samesite(flask_app))
+        return response
+
+    def page_args(request):
+        """The `before` cursor and `limit` page size, as `app.get_page_args`."""
+
+        cursor = request.query_params.get('before')
+        try:
+            before = decode_cursor(cursor) if cursor else None
+        except ValueError:
+            raise HTTPException(400)
+
+        size = int_arg(request, 'limit', config['FEED_PAGE_SIZE'])
+        return before, max(1, min(size, config['FEED_MAX_PAGE_SIZE']))
+
+    @login_required
+    async def messages_feed(request):
+        """A page of the current user's home feed, or of one user's messages."""
+
+        before, size = page_args(request)
+        user_id = int_arg(request, 'user_id')
+
+        async with Session() as session:
+            if user_id is None:
+                feeds = [(await session.scalars(query)).all() for query in
+                         timeline.home_queries(request.state.user_id, size + 1, before)]
+                messages = merge_newest(*feeds, limit=size + 1)
+            else:
+                query = (select(Message)
+                         .options(joinedload(Message.user, innerjoin=True))
+                         .where(Message.user_id == user_id))
+                if before is not None:
+                    query = query.where(before_key(Message.timestamp, Message.id, before))
+                messages = (await session.scalars(
+                    query.order_by(Message.timestamp.desc(), Message.id.desc())
+                    .limit(size + 1))).all()
+
+        messages, next_cursor = page_of(messages, size)
+        return JSONResponse({'messages': [msg.serialize() for msg in messages],
+                             'next': next_cursor})
+
+    @login_required
+    async def add_message(request):
+        """Post a message as the current user."""
+
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        text = body.get('text') if isinstance(body, dict) else None
+        if not isinstance(text, str) or not text.strip() or len(text) > MESSAGE_MAX_LENGTH:
+            raise HTTPException(400)
+
+        async with Session() as session:
+            user = await session.get(User, request.state.user_id)
+            if user is None:
+                raise HTTPException(401)
+
+            msg = Message(text=text, user=user,
+                          fanned_out=not timeline.over_fanout_limit(user.followers_count))
+            session.add(msg)
+            user.adjust_counts(messages_count=1)
+            await session.flush()
+            await session.execute(timeline.delivery(msg.id, fan_out=msg.fanned_out))
+            await session.run_sync(
+                lambda sync_session: pubsub.publish(msg.id, user.id, sync_session))
+            await session.commit()
+            # Reload for the database's timestamp, keeping the author loaded
+            msg = await session.get(Message, msg.id, populate_existing=True,
+                                    options=[joinedload(Message.user, innerjoin=True)])
+
+        return stick_to_primary(request, JSONResponse({'message': msg.serialize()},
+                                                      status_code=201))
+
+    @login_required
+    async def like_message(request):
+        """Toggle the current user's like on a message."""
+
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        message_id = body.get('msg_id') if isinstance(body, dict) else None
+        if not isinstance(message_id, int) or isinstance(message_id, bool):
+            raise HTTPException(400)
+
+        async with Session() as session:
+            message = await session.get(Message, message_id)
+            if message is None:
+                raise HTTPException(404)
+            if message.user_id == request.state.user_id:
+                raise HTTPException(403)
+            user = await session.get(User, request.state.user_id)
+            if user is None:
+                raise HTTPException(401)
+
+            liked = await toggle_like(session, user, message_id)
+            await session.commit()
+
+        return stick_to_primary(
+            request, JSONResponse({'message': "liked" if liked else "unliked"}))
+
+    @login_required
+    async def stream(request):
+        """Server-Sent Events stream of new messages from followed users.
+
+        Resumes after the message id in the Last-Event-ID header or the
+        `after` param, as Flask's `stream_api`.
+        """
+
+        after = request.headers.get('Last-Event-ID') or request.query_params.get('after')
+        if after is not None:
+            try:
+                after = int(after)
+            except ValueError:
+                raise HTTPException(400)
+
+        base_url = str(request.base_url)
+
+        def serialize(msg):
+            data = msg.serialize()
+            with flask_app.test_request_context(base_url=base_url):
+                data["user"]["image_url"] = images.url(msg.user.image_url, "timeline")
+            return data
+
+        events = async_message_stream(pubsub, Session, request.state.user_id, serialize,
+                                      after=after,
+                                      keepalive=config['STREAM_KEEPALIVE'],
+                                      max_seconds=config['STREAM_MAX_SECONDS'],
+                                      backlog=config['STREAM_BACKLOG'])
+        return StreamingResponse(events, media_type='text/event-stream',
+                                 headers={'X-Accel-Buffering': 'no'})
+
+    async def message(request):
+        """A single message."""
+
+        async with Session() as session:
+            msg = await session.get(Message, request.path_params['message_id'],
+                                    options=[joinedload(Message.user, innerjoin=True)])
+        if msg is None:
+            raise HTTPException(404)
+        return JSONResponse({'message': msg.serialize()})
+
+    async def message_likes(request):
+        """A page of the users who like a message, in id order."""
+
+        message_id = request.path_params['message_id']
+        size = int_arg(request, 'limit', config['USERS_PAGE_SIZE'])
+        size = max(1, min(size, config['FEED_MAX_PAGE_SIZE']))
+
+        async with Session() as session:
+            msg = await session.get(Message, message_id)
+            if msg is None:
+                raise HTTPException(404)
+            users = (await session.scalars(Message.likers_query(
+                message_id, after=int_arg(request, 'after'), limit=size + 1))).all()
+
+        next_after = users[size - 1].id if len(users) > size else None
+        return JSONResponse({'likes_count': msg.likes_count,
+                             'users': [{"id": user.id,
+                                        "username": user.username,
+                                        "image_url": user.image_url}
+                                       for user in users[:size]],
+                             'next': next_after})
+
+    async def user(request):
+        """A user's public profile."""
+
+        async with Session() as session:
+            found = await session.get(User, request.path_params['user_id'])
+        if found is None:
+            raise HTTPException(404)
+        return JSONResponse({'user': found.serialize()})
+
+    async def http_error(request, exc):
+        return JSONResponse({'error': exc.detail}, status_code=exc.status_code,
+                            headers=exc.headers)
+
+    @asynccontextmanager
+    async def lifespan(asgi_app):
+        yield
+        await engine.dispose()
+
+    routes = [
+        Route('/api/messages', messages_feed, methods=['GET']),
+        Route('/api/messages', add_message, methods=['POST']),
+        Route('/api/messages/like', like_message, methods=['POST']),
+        Route('/api/messages/{message_id:int}', message, methods=['GET']),
+        Route('/api/messages/{message_id:int}/likes', message_likes, methods=['GET']),
+        Route('/api/users/{user_id:int}', user, methods=['GET']),
+        Route('/api/stream', stream, methods=['GET']),
+        # Everything else, and other methods on the paths above
+        Mount('/', app=WSGIMiddleware(flask_app, workers=config['ASGI_WSGI_THREADS'])),
+    ]
+    asgi_app = Starlette(routes=routes, lifespan=lifespan,
+                         exception_handlers={HTTPException: http_error})
+    asgi_app.state.engine = engine
+    return asgi_app
+
+
+app = make_asgi_app(flask_app)
@@ -0,0 +1,150 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies everything in static/ into static/dist/ under
+content-hashed names (style.css -> style.3f2a9c01d4e5.css), writes gzip
+(and, if the `brotli` package is installed, brotli) versions of text
+files next to them, and records the mapping in static/dist/manifest.json.
+CSS references to /static/... are rewritten to the hashed URLs.
+
+Templates link to assets with `static_url('stylesheets/style.css')`,
+which resolves through the manifest to /assets/<hashed name>. Those URLs
+never change content, so they're served as immutable (see http_cache),
+picking the smallest encoding the browser accepts. Without a build (e.g.
+in development) `static_url` falls back to the plain /static/ URL.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import abort, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+# Already-compressed formats (images, fonts) gain nothing from gzip/brotli
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html'}
+
+# Most preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+CSS_STATIC_URL = re.compile(r"""url\((["']?)/static/([^"')]+)\1\)""")
+
+
+def hashed_name(path, content):
+    """`path` with a hash of `content` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def write_asset(out_dir, name, content):
+    """Write `content` to out_dir/name, plus compressed copies where they help."""
+
+    target = os.path.join(out_dir, name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as f:
+        f.write(content)
+
+    if os.path.splitext(name)[1] not in COMPRESSIBLE:
+        return
+    with open(target + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(target + '.br', 'wb') as f:
+            f.write(brotli.compress(content))
+
+
+def build_assets(static_dir):
+    """Build fingerprinted assets for `static_dir`; returns the manifest."""
+
+    out_dir = os.path.join(static_dir, DIST_DIR)
+    sources = []
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != out_dir]
+        for filename in files:
+            path = os.path.join(root, filename)
+            sources.append(os.path.relpath(path, static_dir).replace(os.sep, '/'))
+
+    manifest = {}
+
+    # Stylesheets last, so the assets they reference already have names
+    for path in sorted(sources, key=lambda path: (path.endswith('.css'), path)):
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            content = f.read()
+
+        if path.endswith('.css'):
+            content = CSS_STATIC_URL.sub(
+                lambda m: (f"url({m.group(1)}/assets/"
+                           f"{manifest.get(m.group(2), m.group(2))}{m.group(1)})"),
+                content.decode()).encode()
+
+        name = hashed_name(path, content)
+        write_asset(out_dir, name, content)
+        manifest[path] = name
+
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_dir):
+    """Read the manifest written by `build_assets`, or {} if there isn't one."""
+
+    try:
+        with open(os.path.join(static_dir, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def connect_assets(app):
+    """Add the `static_url` template helper and the /assets route to `app`.
+
+    Returns the manifest in use.
+    """
+
+    manifest = load_manifest(app.static_folder)
+    dist_dir = os.path.join(app.static_folder, DIST_DIR)
+
+    def static_url(path):
+        """URL for static file `path`: fingerprinted if it's been built."""
+
+        if path in manifest:
+            return url_for('asset', filename=manifest[path])
+        return url_for('static', filename=path)
+
+    @app.route('/assets/<path:filename>', endpoint='asset')
+    def serve_asset(filename):
+        """Serve a built asset, precompressed if the browser accepts it."""
+
+        if filename == MANIFEST:
+            abort(404)
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        for encoding, suffix in ENCODINGS:
+            variant = safe_join(dist_dir, filename + suffix)
+            if (encoding in request.accept_encodings
+                    and variant and os.path.exists(variant)):
+                response = send_from_directory(dist_dir, filename + suffix,
+                                               mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(dist_dir, filename, mimetype=mimetype)
+
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.jinja_env.globals['static_url'] = static_url
+    app.extensions['assets'] = manifest
+    return manifest
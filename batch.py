@@ -0,0 +1,157 @@
+"""Batched writes for the API: post, follow and like many items at once.
+
+Each function validates the whole batch with a handful of set-based
+queries, writes every valid item with one multi-row statement per table,
+and returns one result per input item, in order, so a client can tell
+which items failed and why. Nothing is committed; the caller commits the
+batch as one transaction.
+
+Results are dicts with a "status" (e.g. "created", "followed", "liked")
+or, for items that were skipped, "error" and a message.
+"""
+
+from models import db, Follows, Likes, Message, User
+
+MESSAGE_MAX_LENGTH = Message.__table__.c.text.type.length
+
+
+def _error(message, **fields):
+    """Result for an item that was skipped."""
+
+    return {**fields, 'status': 'error', 'error': message}
+
+
+def post_messages(user, texts, timeline):
+    """Post a message for each of `texts` as `user`."""
+
+    results = [None] * len(texts)
+    valid = []
+    for i, text in enumerate(texts):
+        if not isinstance(text, str) or not text.strip():
+            results[i] = _error("text is required")
+        elif len(text) > MESSAGE_MAX_LENGTH:
+            results[i] = _error(f"text is over {MESSAGE_MAX_LENGTH} characters")
+        else:
+            valid.append(i)
+
+    if not valid:
+        return results
+
+    messages = [Message(text=texts[i], user_id=user.id) for i in valid]
+    db.session.add_all(messages)
+    user.adjust_counts(messages_count=len(messages))
+    timeline.add_messages(messages)
+
+    # Timestamps come from the database; reload them all in one query
+    ids = [message.id for message in messages]
+    loaded = {message.id: message for message in
+              Message.query.filter(Message.id.in_(ids)).populate_existing()}
+    for i, id in zip(valid, ids):
+        results[i] = {'status': 'created', 'message': loaded[id].serialize()}
+    return results
+
+
+def _valid_ids(values):
+    """Indexes of the values in `values` that are ints (not bools)."""
+
+    return [i for i, value in enumerate(values)
+            if isinstance(value, int) and not isinstance(value, bool)]
+
+
+def follow_users(user, user_ids, timeline):
+    """Have `user` follow each of `user_ids`."""
+
+    results = [_error("not a user id", user_id=id) for id in user_ids]
+    candidates = set(user_ids[i] for i in _valid_ids(user_ids))
+
+    found = {id for (id,) in
+             db.session.query(User.id).filter(User.id.in_(candidates))}
+    already = {id for (id,) in
+               db.session.query(Follows.user_being_followed_id)
+               .filter(Follows.user_following_id == user.id,
+                       Follows.user_being_followed_id.in_(candidates))}
+
+    to_follow, seen = [], set()
+    for i in _valid_ids(user_ids):
+        id = user_ids[i]
+        if id == user.id:
+            results[i] = _error("can't follow yourself", user_id=id)
+        elif id not in found:
+            results[i] = _error("no such user", user_id=id)
+        elif id in seen:
+            results[i] = _error("duplicate", user_id=id)
+        elif id in already:
+            results[i] = {'user_id': id, 'status': 'already following'}
+        else:
+            to_follow.append(id)
+            results[i] = {'user_id': id, 'status': 'followed'}
+        seen.add(id)
+
+    if not to_follow:
+        return results
+
+    db.session.execute(db.insert(Follows).values([
+        {'user_following_id': user.id, 'user_being_followed_id': id}
+        for id in to_follow]))
+    user.adjust_counts(following_count=len(to_follow))
+    db.session.execute(db.update(User)
+                       .where(User.id.in_(to_follow))
+                       .values(followers_count=User.followers_count + 1)
+                       .execution_options(synchronize_session=False))
+    db.session.flush()
+    timeline.add_follows(user.id, to_follow)
+    return results
+
+
+def toggle_likes(user, message_ids):
+    """Toggle `user`'s like on each of `message_ids`."""
+
+    results = [_error("not a message id", message_id=id) for id in message_ids]
+    candidates = set(message_ids[i] for i in _valid_ids(message_ids))
+
+    authors = dict(db.session.query(Message.id, Message.user_id)
+                   .filter(Message.id.in_(candidates)))
+    liked = {id for (id,) in
+             db.session.query(Likes.message_id)
+             .filter(Likes.user_id == user.id, Likes.message_id.in_(candidates))}
+
+    to_like, to_unlike, seen = [], [], set()
+    for i in _valid_ids(message_ids):
+        id = message_ids[i]
+        if id not in authors:
+            results[i] = _error("no such message", message_id=id)
+        elif authors[id] == user.id:
+            results[i] = _error("can't like your own message", message_id=id)
+        elif id in seen:
+            results[i] = _error("duplicate", message_id=id)
+        elif id in liked:
+            to_unlike.append(id)
+            results[i] = {'message_id': id, 'status': 'unliked'}
+        else:
+            to_like.append(id)
+            results[i] = {'message_id': id, 'status': 'liked'}
+        seen.add(id)
+
+    if to_unlike:
+        db.session.execute(db.delete(Likes)
+                           .where(Likes.user_id == user.id,
+                                  Likes.message_id.in_(to_unlike))
+                           .execution_options(synchronize_session=False))
+        _adjust_likes_counts(to_unlike, -1)
+    if to_like:
+        db.session.execute(db.insert(Likes).values([
+            {'user_id': user.id, 'message_id': id} for id in to_like]))
+        _adjust_likes_counts(to_like, 1)
+
+    if to_like or to_unlike:
+        user.adjust_counts(likes_count=len(to_like) - len(to_unlike))
+    return results
+
+
+def _adjust_likes_counts(message_ids, delta):
+    """Add `delta` to the like count of every message in `message_ids`."""
+
+    db.session.execute(db.update(Message)
+                       .where(Message.id.in_(message_ids))
+                       .values(likes_count=Message.likes_count + delta)
+                       .execution_options(synchronize_session=False))
@@ -0,0 +1,413 @@
+"""End-to-end load benchmark of Warbler's main routes.
+
+    python -m benchmarks.load [--scale small|medium|large] [--users N] [--messages N]
+                              [--mode in-process|wsgi|asgi|both|all] [--concurrency N]
+                              [--requests N] [--routes home,profile,...]
+                              [--database-url URL] [--reuse-data]
+                              [--output results.json] [--baseline old.json]
+
+Loads a synthetic dataset (see generator/synthetic.py) into a scratch
+database, then for each route has `--concurrency` simulated users, each
+logged in as a random user, make `--requests` requests between them. It
+runs in-process through Flask's test client, through a local threaded
+WSGI server over HTTP, and/or through uvicorn over HTTP with the async
+API (asgi.py); "both" is the first two, "all" all three. Compare the
+WSGI and ASGI modes at high concurrency, e.g. --concurrency 1000, to see
+how many open connections each holds up under.
+
+For every route it reports throughput, p50/p95/p99 latency and the number
+of SQL statements each request ran. `--output` writes the results as
+JSON (with the commit and settings they came from); pass an earlier
+file as `--baseline` to print the change against it.
+
+The scratch database is a temporary SQLite file unless --database-url is
+given. Whatever database you point it at is dropped and recreated,
+unless --reuse-data says it already holds a dataset of this size!
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timezone
+
+# name -> (users, messages)
+SCALES = {
+    'small': (100, 1000),
+    'medium': (5000, 100000),
+    'large': (20000, 1000000),
+}
+
+# `make(rng, users, messages)` returns the (path, JSON body) of one request
+Route = namedtuple('Route', ['name', 'method', 'label', 'make'])
+
+ROUTES = [
+    Route('home', 'GET', '/',
+          lambda rng, users, messages: ('/', None)),
+    Route('profile', 'GET', '/users/<id>',
+          lambda rng, users, messages: (f'/users/{rng.randint(1, users)}', None)),
+    Route('users', 'GET', '/users',
+          lambda rng, users, messages: ('/users', None)),
+    Route('feed_api', 'GET', '/api/messages',
+          lambda rng, users, messages: ('/api/messages', None)),
+    Route('message_api', 'GET', '/api/messages/<id>',
+          lambda rng, users, messages: (f'/api/messages/{rng.randint(1, messages)}', None)),
+    Route('user_api', 'GET', '/api/users/<id>',
+          lambda rng, users, messages: (f'/api/users/{rng.randint(1, users)}', None)),
+    # Any message, so now and then the user's own (a 403)
+    Route('like_api', 'POST', '/api/messages/like',
+          lambda rng, users, messages: ('/api/messages/like',
+                                        {'msg_id': rng.randint(1, messages)})),
+]
+
+QUERY_COUNT_HEADER = 'X-Query-Count'
+
+
+def count_queries(app, engine):
+    """Report how many SQL statements each request ran in a response header."""
+
+    from flask import g, has_request_context
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.benchmark_queries = g.get('benchmark_queries', 0) + 1
+
+    @app.after_request
+    def add_query_count(response):
+        response.headers[QUERY_COUNT_HEADER] = str(g.get('benchmark_queries', 0))
+        return response
+
+
+def count_async_queries(asgi_app, engine):
+    """Wrap `asgi_app` to report the async API's SQL statements the same way.
+
+    Requests passed through to Flask already carry the header.
+    """
+
+    from contextvars import ContextVar
+    from sqlalchemy import event
+
+    queries = ContextVar('benchmark_queries', default=None)
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter = queries.get()
+        if counter is not None:
+            counter[0] += 1
+
+    async def counting_app(scope, receive, send):
+        if scope['type'] != 'http':
+            return await asgi_app(scope, receive, send)
+        counter = [0]
+        queries.set(counter)
+
+        async def send_with_count(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                name = QUERY_COUNT_HEADER.lower().encode()
+                if not any(key.lower() == name for key, _ in headers):
+                    headers.append((name, str(counter[0]).encode()))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        await asgi_app(scope, receive, send_with_count)
+
+    return counting_app
+
+
+def serve_asgi(asgi_app):
+    """Run `asgi_app` under uvicorn on a free local port, in a thread.
+
+    Returns (port, stop).
+    """
+
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(asgi_app, log_level='warning',
+                                           backlog=4096))
+    thread = threading.Thread(target=server.run, kwargs={'sockets': [sock]},
+                              daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+
+    return sock.getsockname()[1], stop
+
+
+class InProcessClient:
+    """Requests through Flask's test client, with a session cookie."""
+
+    def __init__(self, app, cookie_name, cookie):
+        self.client = app.test_client()
+        self.client.set_cookie('localhost', cookie_name, cookie)
+
+    def request(self, method, path, body):
+        response = self.client.open(path, method=method, json=body)
+        response.close()
+        return response.status_code, int(response.headers.get(QUERY_COUNT_HEADER, 0))
+
+
+class HTTPClient:
+    """Requests over a keep-alive HTTP connection, with a session cookie."""
+
+    def __init__(self, host, port, cookie_name, cookie):
+        self.host = host
+        self.port = port
+        self.cookie = f"{cookie_name}={cookie}"
+        self.connection = http.client.HTTPConnection(host, port)
+
+    def request(self, method, path, body):
+        headers = {'Cookie': self.cookie}
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, path, body=data, headers=headers)
+            response = self.connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            self.connection = http.client.HTTPConnection(self.host, self.port)
+            raise
+        response.read()
+        return response.status, int(response.getheader(QUERY_COUNT_HEADER) or 0)
+
+
+def percentile(sorted_values, fraction):
+    """The value `fraction` of the way through `sorted_values` (nearest rank)."""
+
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_route(route, make_client, users, messages, concurrency, requests,
+              warmup, seed):
+    """Have `concurrency` simulated users make `requests` requests to `route`.
+
+    Returns a dict of throughput, latency and query count statistics.
+    """
+
+    samples = []
+    lock = threading.Lock()
+    start = threading.Barrier(concurrency + 1)
+
+    def simulated_user(index, count):
+        rng = random.Random(seed * 1000 + index)
+        client = make_client(rng.randint(1, users))
+        for _ in range(warmup):
+            client.request(route.method, *route.make(rng, users, messages))
+
+        mine = []
+        start.wait()
+        for _ in range(count):
+            path, body = route.make(rng, users, messages)
+            began = time.perf_counter()
+            try:
+                status, queries = client.request(route.method, path, body)
+            except (http.client.HTTPException, OSError):
+                status, queries = None, 0
+            mine.append(((time.perf_counter() - began) * 1000, queries, status))
+
+        with lock:
+            samples.extend(mine)
+
+    counts = [requests // concurrency + (i < requests % concurrency)
+              for i in range(concurrency)]
+    threads = [threading.Thread(target=simulated_user, args=(i, count))
+               for i, count in enumerate(counts)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    latencies = sorted(latency for latency, _, _ in samples)
+    queries = [count for _, count, _ in samples]
+    statuses = Counter(str(status) for _, _, status in samples)
+    return {
+        'route': f"{route.method} {route.label}",
+        'requests': len(samples),
+        'errors': sum(n for status, n in statuses.items()
+                      if status == 'None' or int(status) >= 400),
+        'statuses': dict(sorted(statuses.items())),
+        'throughput_rps': round(len(samples) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'mean_ms': round(statistics.fmean(latencies), 2),
+        'queries_mean': round(statistics.fmean(queries), 2),
+        'queries_max': max(queries),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"\n{'mode':<11}{'route':<26}{'req/s':>9}{'p50':>9}{'p95':>9}"
+          f"{'p99':>9}{'queries':>9}{'errors':>8}")
+    for result in results:
+        print(f"{result['mode']:<11}{result['route']:<26}{result['throughput_rps']:>9}"
+              f"{result['p50_ms']:>9}{result['p95_ms']:>9}{result['p99_ms']:>9}"
+              f"{result['queries_mean']:>9}{result['errors']:>8}")
+
+
+def print_comparison(results, baseline):
+    """Print each result's change against the same mode and route in `baseline`."""
+
+    previous = {(r['mode'], r['route']): r for r in baseline['results']}
+    print(f"\nChange against {baseline['meta'].get('commit') or 'baseline'}:")
+    for result in results:
+        old = previous.get((result['mode'], result['route']))
+        if old is None:
+            continue
+        changes = []
+        for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            if old[key]:
+                changes.append(f"{key} {(result[key] - old[key]) / old[key]:+.0%}")
+        changes.append(f"queries {result['queries_mean'] - old['queries_mean']:+g}")
+        print(f"  {result['mode']:<11}{result['route']:<26}{', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--messages', type=int)
+    parser.add_argument('--mode', choices=['in-process', 'wsgi', 'asgi', 'both', 'all'],
+                        default='both')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--warmup', type=int, default=5,
+                        help="unmeasured requests per simulated user first")
+    parser.add_argument('--routes', default=','.join(route.name for route in ROUTES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url')
+    parser.add_argument('--reuse-data', action='store_true')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    args = parser.parse_args()
+
+    users, messages = SCALES[args.scale]
+    users = args.users or users
+    messages = args.messages or messages
+    routes = [route for route in ROUTES if route.name in args.routes.split(',')]
+
+    scratch = tempfile.mkdtemp()
+
+    # The app reads DATABASE_URL when it's imported
+    os.environ['DATABASE_URL'] = (args.database_url
+                                  or f"sqlite:///{scratch}/load.db")
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    from app import app, CURR_USER_KEY
+    from generator.synthetic import write_dataset
+    from models import db
+    from seed import seed
+
+    if not args.reuse_data:
+        print(f"Loading {users} users and {messages} messages...")
+        write_dataset(scratch, users=users, messages=messages)
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            seed(scratch)
+
+    with app.app_context():
+        count_queries(app, db.engine)
+        dialect = db.engine.dialect.name
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    serializer = app.session_interface.get_signing_serializer(app)
+
+    def cookie(user_id):
+        return serializer.dumps({CURR_USER_KEY: user_id})
+
+    modes = {'both': ['in-process', 'wsgi'],
+             'all': ['in-process', 'wsgi', 'asgi']}.get(args.mode, [args.mode])
+    results = []
+    for mode in modes:
+        stop = None
+        if mode == 'in-process':
+            def make_client(user_id):
+                return InProcessClient(app, cookie_name, cookie(user_id))
+        else:
+            if mode == 'wsgi':
+                WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+                server = make_server('127.0.0.1', 0, app, threaded=True)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                port, stop = server.server_port, server.shutdown
+            else:
+                from asgi import app as asgi_app
+                port, stop = serve_asgi(count_async_queries(asgi_app,
+                                                            asgi_app.state.engine))
+
+            def make_client(user_id, port=port):
+                return HTTPClient('127.0.0.1', port, cookie_name, cookie(user_id))
+
+        try:
+            for route in routes:
+                print(f"{mode}: {route.method} {route.label}...")
+                result = run_route(route, make_client, users, messages,
+                                   args.concurrency, args.requests, args.warmup,
+                                   args.seed)
+                results.append({'mode': mode, **result})
+        finally:
+            if stop is not None:
+                stop()
+
+    print_results(results)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'database': dialect,
+            'users': users,
+            'messages': messages,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
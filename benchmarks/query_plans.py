@@ -0,0 +1,110 @@
+"""Show how the feed, follow and like indexes change their queries' plans.
+
+    python -m benchmarks.query_plans [--users N] [--messages N] [--database-url URL]
+
+Loads a synthetic dataset into a scratch database, then for each index
+prints the EXPLAIN output and median run time of the query it serves,
+first with the index dropped and then with it in place.
+
+The scratch database is a temporary SQLite file unless --database-url is
+given. Whatever database you point it at is dropped and recreated!
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import select
+
+RUNS = 50
+
+
+def explain(conn, statement):
+    """Return the database's query plan for `statement` as a list of lines."""
+
+    sql = str(statement.compile(dialect=conn.dialect,
+                                compile_kwargs={'literal_binds': True}))
+    if conn.dialect.name == 'sqlite':
+        return [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+    return [row[0] for row in conn.exec_driver_sql(f"EXPLAIN {sql}")]
+
+
+def median_ms(conn, statement, runs=RUNS):
+    """Median wall time of executing `statement` and fetching every row."""
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        conn.execute(statement).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def report(conn, label, statement):
+    print(f"  {label}: {median_ms(conn, statement):.3f} ms")
+    for line in explain(conn, statement):
+        print(f"    {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp()
+
+    # The app reads DATABASE_URL when it's imported
+    os.environ['DATABASE_URL'] = (args.database_url
+                                  or f"sqlite:///{scratch}/query_plans.db")
+
+    from app import app
+    from generator.synthetic import write_dataset
+    from models import db, Follows, Likes, Message
+    from seed import seed
+
+    print(f"Loading {args.users} users and {args.messages} messages...")
+    write_dataset(scratch, users=args.users, messages=args.messages)
+    with app.app_context():
+        seed(scratch)
+
+    user_id = args.users // 2
+    message_id = args.messages // 2
+    cases = [
+        ('ix_messages_user_id_timestamp',
+         "Profile page: an author's newest messages",
+         select(Message.id, Message.timestamp)
+         .where(Message.user_id == user_id)
+         .order_by(Message.timestamp.desc(), Message.id.desc())
+         .limit(20)),
+        ('ix_follows_user_following_id',
+         "Following page: who a user follows",
+         select(Follows.user_being_followed_id)
+         .where(Follows.user_following_id == user_id)),
+        ('ix_likes_message_id',
+         "Message likes: the users who liked a message",
+         select(Likes.user_id)
+         .where(Likes.message_id == message_id)),
+    ]
+    indexes = {index.name: index
+               for table in db.metadata.tables.values()
+               for index in table.indexes}
+
+    with app.app_context(), db.engine.connect() as conn:
+        for name, description, statement in cases:
+            print(f"\n{description} ({name})")
+
+            indexes[name].drop(conn)
+            conn.exec_driver_sql("ANALYZE")
+            report(conn, "without index", statement)
+
+            indexes[name].create(conn)
+            conn.exec_driver_sql("ANALYZE")
+            report(conn, "with index", statement)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Streaming export of a user's data as NDJSON.
+
+An export is one JSON object per line: the user's profile first, then
+every message they've written, who they follow, who follows them, and
+what they've liked, each tagged with a "type". Rows are read with
+`yield_per`, which on Postgres uses a server-side cursor, and written
+out as they arrive, so memory use doesn't grow with the account and the
+first bytes go out before the last rows are read.
+"""
+
+import json
+
+from models import db, Follows, Likes, Message, User
+
+PROFILE_FIELDS = ('id', 'username', 'email', 'bio', 'location',
+                  'image_url', 'header_image_url')
+
+
+def export_records(user, batch_size=1000):
+    """Yield a dict for each record in `user`'s export."""
+
+    yield {'type': 'user', **{field: getattr(user, field) for field in PROFILE_FIELDS}}
+
+    messages = (db.session.query(Message.id, Message.text, Message.timestamp,
+                                 Message.likes_count)
+                .filter(Message.user_id == user.id)
+                .order_by(Message.id)
+                .yield_per(batch_size))
+    for id, text, timestamp, likes_count in messages:
+        yield {'type': 'message', 'id': id, 'text': text,
+               'timestamp': timestamp.isoformat(), 'likes_count': likes_count}
+
+    following = (db.session.query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == user.id)
+                 .order_by(Follows.user_being_followed_id)
+                 .yield_per(batch_size))
+    for (user_id,) in following:
+        yield {'type': 'following', 'user_id': user_id}
+
+    followers = (db.session.query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == user.id)
+                 .order_by(Follows.user_following_id)
+                 .yield_per(batch_size))
+    for (user_id,) in followers:
+        yield {'type': 'follower', 'user_id': user_id}
+
+    likes = (db.session.query(Likes.message_id)
+             .filter(Likes.user_id == user.id)
+             .order_by(Likes.message_id)
+             .yield_per(batch_size))
+    for (message_id,) in likes:
+        yield {'type': 'like', 'message_id': message_id}
+
+
+def ndjson(records, batch_size=1000):
+    """Encode `records` as newline-delimited JSON, in chunks of up to `batch_size` lines."""
+
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, separators=(',', ':')))
+        if len(lines) >= batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def export_user(user_id, batch_size=1000):
+    """NDJSON chunks of `user_id`'s export, or None if there's no such user."""
+
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+    return ndjson(export_records(user, batch_size), batch_size)
@@ -0,0 +1,131 @@
+"""Cache of pre-rendered message list items.
+
+Every feed renders the same markup for a message (author avatar and name,
+timestamp, text) whoever is looking at it; only the like button differs
+between viewers. We render that shared part once from
+`messages/_item.html`, cache the HTML, and let feed templates wrap it with
+the per-viewer like button.
+
+Entries are keyed by message id and the author's `profile_version`, so an
+author editing their profile makes their old entries unreachable (they
+age out of the LRU), and deleting a message drops its entry.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from markupsafe import Markup
+
+ITEM_TEMPLATE = 'messages/_item.html'
+
+
+class FragmentStore:
+    """Interface for a store of rendered fragments.
+
+    Keys and values are strings, so a shared backend (e.g. Redis with
+    MGET/MSET/DEL) can implement this directly.
+    """
+
+    def get_many(self, keys):
+        """Return a dict of the cached fragments for whichever of `keys` exist."""
+        raise NotImplementedError
+
+    def set_many(self, fragments):
+        """Store a dict of key -> fragment."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Forget any fragment stored under `key`."""
+        raise NotImplementedError
+
+
+class LRUFragmentStore(FragmentStore):
+    """In-process store holding up to `maxsize` fragments."""
+
+    def __init__(self, maxsize=20000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+        return found
+
+    def set_many(self, fragments):
+        with self._lock:
+            for key, html in fragments.items():
+                self._entries[key] = html
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class MessageFragments:
+    """Render message list items through a `FragmentStore`, counting hits and misses."""
+
+    def __init__(self, store, jinja_env):
+        self.store = store
+        self.jinja_env = jinja_env
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def key(message):
+        # Author and timestamp pin down the row, so a reseeded database
+        # that reuses message ids can't be served another message's markup.
+        return (f"msg:{message.id}:{message.user_id}:{message.timestamp.isoformat()}"
+                f":{message.user.profile_version}")
+
+    def render(self, messages):
+        """Return a dict of message id -> rendered list item markup."""
+
+        keys = {message.id: self.key(message) for message in messages}
+        cached = self.store.get_many(keys.values())
+
+        missing = [message for message in messages if keys[message.id] not in cached]
+        if missing:
+            template = self.jinja_env.get_template(ITEM_TEMPLATE)
+            rendered = {keys[message.id]: template.render(msg=message)
+                        for message in missing}
+            self.store.set_many(rendered)
+            cached.update(rendered)
+
+        with self._lock:
+            self.hits += len(messages) - len(missing)
+            self.misses += len(missing)
+
+        return {id: Markup(cached[key]) for id, key in keys.items()}
+
+    def forget(self, message):
+        """Drop `message`'s cached item, e.g. when it's deleted."""
+
+        self.store.delete(self.key(message))
+
+    def stats(self):
+        """Hit and miss counts since startup."""
+
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def connect_fragments(app, store=None):
+    """Set up the message fragment cache for `app` and return it.
+
+    Pass `store` to use a different `FragmentStore` implementation.
+    """
+
+    if store is None:
+        store = LRUFragmentStore(maxsize=app.config.get('FRAGMENT_CACHE_SIZE', 20000))
+
+    fragments = MessageFragments(store, app.jinja_env)
+    app.extensions['message_fragments'] = fragments
+    return fragments
@@ -0,0 +1,211 @@
+"""Generate large synthetic Warbler datasets for load testing.
+
+Unlike create_csvs.py, this streams rows straight to CSV (memory stays flat
+however many rows you ask for), never touches the network, and is fully
+determined by --seed, so two runs with the same arguments produce the same
+files. Load the result with `python seed.py <out-dir>`.
+
+    python generator/synthetic.py --users 1000000 --messages 10000000 \\
+        --follows-per-user 50 --likes-per-message 2.5 --out /tmp/warbler-10m
+"""
+
+import argparse
+import csv
+import os
+import random
+from datetime import datetime, timedelta
+
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio',
+                     'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
+FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+
+MAX_WARBLER_LENGTH = 140
+
+# Every user's password is "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+WORDS = """
+    able about above across act add after again against age ago agree air
+    all allow almost alone along already also always among animal answer
+    any appear apply area argue arm around arrive art ask attack away back
+    bad bag ball bank bar base beat beautiful become bed begin behind best
+    better big bird black blue board boat body book born both box boy break
+    bring brother build business buy call camera car card care carry case
+    cat catch cause center chair chance change city claim class clear close
+    cold color come common cost could country course cover create cup cut
+    dark data day deal death decide deep degree design detail dog door down
+    draw dream drive drop early east easy eat edge effect egg end energy
+    enjoy enough enter even evening event every example eye face fact fall
+    family far fast father fear feel few field fight fill film find fine
+    fire first fish five floor fly focus follow food foot force forest
+    forget form free friend front full fun game garden gas girl give glass
+    goal good great green ground group grow guess gun hair half hand happy
+    hard head hear heart heat heavy help here high hill history hit hold
+    home hope horse hot hour house huge idea image inside island job join
+    just keep key kid kind king kitchen know lake land large last late
+    laugh law lead learn leave left leg less letter level life light like
+    line list listen little live local long look lose loud love low machine
+    main make man many map mark market matter meet memory middle might mind
+    minute miss moment money moon morning mother mountain move music name
+    nature near need never new news next nice night north note nothing now
+    number ocean offer office often old open order other outside page paint
+    paper park part party pass past path pay peace people perhaps person
+    pick picture piece place plan plant play point poor power present
+    pretty problem pull push put quick quiet rain raise reach read ready
+    real reason red remember rest rich ride right river road rock room rule
+    run safe sail same save say school science sea season seat second see
+    sell send sense serve seven shake share ship shoot short show side sign
+    simple sing sister sit six size skill sky sleep slow small smile snow
+    soft soldier song soon sound south space speak special spring stand
+    star start state stay step still stone stop story street strong study
+    subject summer sun sure surface system table take talk teach team tell
+    ten test thank thing think three through throw time today together
+    tonight top total touch town track trade train travel tree trip true
+    try turn two under until up use usual valley very visit voice wait walk
+    wall want war warm watch water wave way wear weather week weight west
+    wheel white whole wide wild win wind window winter wish woman wonder
+    wood word work world write wrong yard year yellow young
+""".split()
+
+CITIES = ['Springfield', 'Riverside', 'Franklin', 'Greenville', 'Bristol',
+          'Clinton', 'Fairview', 'Salem', 'Madison', 'Georgetown']
+
+
+def sentence(rng, max_length):
+    """A random lowercase sentence of up to `max_length` characters."""
+
+    text = ' '.join(rng.choices(WORDS, k=rng.randint(3, 24))).capitalize()
+    return text[:max_length - 1].rstrip() + '.'
+
+
+def generate_users(rng, count):
+    """Yield `count` user rows with ids 1..count."""
+
+    for id in range(1, count + 1):
+        yield [
+            id,
+            f"user{id}@example.com",
+            f"{rng.choice(WORDS)}{id}",
+            "/static/images/default-pic.png",
+            PASSWORD_HASH,
+            sentence(rng, 80),
+            "/static/images/warbler-hero.jpg",
+            rng.choice(CITIES),
+        ]
+
+
+def generate_messages(rng, count, num_users, end, days):
+    """Yield `count` message rows spread over the `days` before `end`."""
+
+    span = days * 24 * 60 * 60
+    for id in range(1, count + 1):
+        timestamp = end - timedelta(seconds=rng.random() * span)
+        yield [
+            id,
+            sentence(rng, MAX_WARBLER_LENGTH),
+            timestamp.isoformat(sep=' '),
+            rng.randint(1, num_users),
+        ]
+
+
+def generate_follows(rng, num_users, per_user):
+    """Yield follow rows, about `per_user` followees for each user.
+
+    Followees are drawn per user and de-duplicated in a small set, so
+    memory is O(per_user) rather than O(num_users ** 2).
+    """
+
+    if num_users < 2:
+        return
+
+    most = min(num_users - 1, per_user * 2)
+    for follower in range(1, num_users + 1):
+        followees = set()
+        wanted = rng.randint(0, most)
+        while len(followees) < wanted:
+            followed = rng.randint(1, num_users)
+            if followed != follower:
+                followees.add(followed)
+        for followed in sorted(followees):
+            yield [followed, follower]
+
+
+def generate_likes(rng, num_messages, num_users, per_message):
+    """Yield like rows, about `per_message` distinct likers for each message."""
+
+    whole, fraction = divmod(per_message, 1)
+    for message_id in range(1, num_messages + 1):
+        wanted = min(num_users, int(whole) + (rng.random() < fraction))
+        for user_id in sorted(rng.sample(range(1, num_users + 1), wanted)):
+            yield [user_id, message_id]
+
+
+def write_csv(path, headers, rows):
+    """Stream `rows` into a CSV file at `path`; returns the row count."""
+
+    count = 0
+    with open(path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_dataset(out, users=10000, messages=100000, follows_per_user=20,
+                  likes_per_message=1.5, days=730, end=datetime(2023, 1, 1), seed=0):
+    """Write users/messages/follows/likes CSVs into `out`.
+
+    Returns a dict of row counts keyed by file name.
+    """
+
+    os.makedirs(out, exist_ok=True)
+
+    # One generator per file so changing e.g. `messages` doesn't reshuffle users
+    outputs = [
+        ('users.csv', USERS_CSV_HEADERS,
+         generate_users(random.Random(f"{seed}-users"), users)),
+        ('messages.csv', MESSAGES_CSV_HEADERS,
+         generate_messages(random.Random(f"{seed}-messages"), messages,
+                           users, end, days)),
+        ('follows.csv', FOLLOWS_CSV_HEADERS,
+         generate_follows(random.Random(f"{seed}-follows"), users,
+                          follows_per_user)),
+        ('likes.csv', LIKES_CSV_HEADERS,
+         generate_likes(random.Random(f"{seed}-likes"), messages,
+                        users, likes_per_message)),
+    ]
+
+    return {filename: write_csv(os.path.join(out, filename), headers, rows)
+            for filename, headers, rows in outputs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--follows-per-user', type=int, default=20)
+    parser.add_argument('--likes-per-message', type=float, default=1.5,
+                        help="average number of likes on each message")
+    parser.add_argument('--days', type=int, default=730,
+                        help="spread message timestamps over this many days")
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime(2023, 1, 1),
+                        help="newest possible message timestamp")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='generator/synthetic')
+    args = parser.parse_args()
+
+    counts = write_dataset(args.out, users=args.users, messages=args.messages,
+                           follows_per_user=args.follows_per_user,
+                           likes_per_message=args.likes_per_message,
+                           days=args.days, end=args.end, seed=args.seed)
+    for filename, count in counts.items():
+        print(f"Wrote {count} rows to {filename}")
+
+
+if __name__ == '__main__':
+    main()
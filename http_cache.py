@@ -0,0 +1,109 @@
+"""HTTP caching policy.
+
+- Fingerprinted assets (/assets/..., see assets.py) can't change under the
+  same URL, so browsers and proxies may keep them for a year without
+  asking again. A missing asset isn't stored at all.
+- Resized images (/img/..., see images.py) are public for a day; the
+  source behind a URL can change, so they aren't immutable. Errors
+  (e.g. a source that couldn't be fetched) are only kept for a minute.
+- Plain /static/ files must be revalidated; Flask answers with a 304
+  using the file's ETag and Last-Modified when it hasn't changed.
+- Pages that call `not_modified()` get a weak ETag built from the data
+  they show, and a bodiless 304 (skipping the render) when the client's
+  copy is still current.
+- Everything else is marked no-cache, so it's always revalidated.
+
+Pages are `private` when someone is logged in, since they show that
+viewer's nav bar, likes and follows.
+"""
+
+from hashlib import sha1
+
+from flask import current_app, g, request, session
+
+from user_cache import SNAPSHOT_FIELDS
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+IMAGE_MAX_AGE = 24 * 60 * 60
+IMAGE_ERROR_MAX_AGE = 60
+
+
+def weak_etag(*parts):
+    """An opaque validator for a page built from `parts`."""
+
+    return sha1(repr(parts).encode()).hexdigest()[:20]
+
+
+def viewer_state():
+    """What the nav bar and stats show about the logged-in user, if any."""
+
+    if not g.get('user'):
+        return None
+    return tuple(getattr(g.user, field) for field in SNAPSHOT_FIELDS)
+
+
+def not_modified(*parts):
+    """Validate this page against `parts`; returns a 304 response if the client's copy is current.
+
+    `parts` should cover everything the page shows that can change (ids,
+    counts, versions, the viewer's likes/follows on the page); the URL and
+    the logged-in user's own details are included automatically. Call it
+    after loading the page's data but before rendering, and return the
+    304 if there is one.
+    """
+
+    if session.get('_flashes'):
+        # The page will show a one-off flash message
+        return None
+
+    etag = weak_etag(request.full_path, viewer_state(), *parts)
+    g.etag = etag
+
+    if request.if_none_match.contains_weak(etag):
+        return current_app.response_class(status=304)
+    return None
+
+
+def apply_cache_policy(response):
+    """Set Cache-Control (and the ETag from `not_modified`) on `response`."""
+
+    cache_control = response.cache_control
+
+    if request.endpoint == 'asset':
+        if response.status_code not in (200, 304):
+            # e.g. a stale manifest name: the file may yet appear
+            cache_control.no_store = True
+            return response
+        cache_control.no_cache = None
+        cache_control.public = True
+        cache_control.max_age = STATIC_MAX_AGE
+        cache_control.immutable = True
+        return response
+
+    if request.endpoint == 'image':
+        cache_control.no_cache = None
+        cache_control.public = True
+        cache_control.max_age = (IMAGE_MAX_AGE if response.status_code in (200, 304)
+                                 else IMAGE_ERROR_MAX_AGE)
+        return response
+
+    if request.endpoint == 'static':
+        cache_control.public = True
+        cache_control.no_cache = True
+        return response
+
+    etag = g.get('etag')
+    if etag:
+        response.set_etag(etag, weak=True)
+
+    cache_control.no_cache = True
+    if g.get('user'):
+        cache_control.private = True
+    response.vary.add('Cookie')
+    return response
+
+
+def connect_http_cache(app):
+    """Apply the caching policy to every response from `app`."""
+
+    app.after_request(apply_cache_policy)
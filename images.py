@@ -0,0 +1,385 @@
+"""Resizing image proxy.
+
+Users' avatars and header images are arbitrary URLs, often to
+multi-megabyte originals that a timeline shows at 48 pixels. Templates
+link to them with `image_url(url, size)` instead, which points at
+/img/<size>/<key>: the key is the source URL, signed so the proxy only
+fetches URLs our own pages asked for. The first request for a size
+fetches the original (from the web, or from our static folder for
+/static/... URLs), resizes it, and stores the result in a disk cache;
+after that it's served straight from disk. Web sources are only fetched
+from public addresses, and redirects are checked the same way.
+
+The cache is content-addressed: resized images are stored under the
+hash of their bytes (so e.g. everyone on the default avatar shares one
+file), with a small ref file mapping each (source URL, size) to its
+blob. Blobs are evicted least-recently-served first once the cache
+grows past its byte limit; a ref to an evicted blob is just a miss.
+Sources that can't be fetched or decoded are remembered for a few
+minutes, so a dead link isn't fetched again by every page that shows it.
+
+Resizing needs Pillow; without it `image_url` returns source URLs
+unchanged.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import urllib.parse
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from flask import abort, current_app, send_file, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from werkzeug.security import safe_join
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# name -> (width, height, crop): cropped sizes fill the box exactly,
+# the rest are shrunk to fit inside it. Roughly 2x the CSS size.
+SIZES = {
+    'avatar': (200, 200, True),
+    'timeline': (96, 96, True),
+    'header': (1200, 400, False),
+}
+
+MIMETYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 3
+
+
+class ImageError(Exception):
+    """The source image couldn't be fetched or decoded."""
+
+
+def is_public_address(address):
+    """Whether the proxy may fetch from `address`, an ipaddress address."""
+
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+
+def resolve_public(host, port):
+    """An address to connect to for `host`, if all its addresses are public.
+
+    Profile URLs are user input: without this they could point the proxy
+    at loopback, the private network or a cloud metadata service.
+    """
+
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError) as e:
+        raise ImageError(f"couldn't resolve {host}: {e}") from e
+
+    addresses = [ipaddress.ip_address(info[4][0].split('%')[0]) for info in infos]
+    if not addresses or not all(is_public_address(a) for a in addresses):
+        raise ImageError(f"{host} isn't a public address")
+    return str(addresses[0])
+
+
+def fetch_url(url, timeout, max_bytes):
+    """GET an http(s) URL, connecting only to public addresses.
+
+    Each connection goes to the address that was checked, so a second DNS
+    lookup can't swap in another, and every redirect is checked again.
+    """
+
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ImageError(f"unsupported image URL {url}")
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        address = resolve_public(parts.hostname, port)
+
+        connection_class = http.client.HTTPSConnection if https else http.client.HTTPConnection
+        connection = connection_class(parts.hostname, port, timeout=timeout)
+        connection._create_connection = (
+            lambda _, *args: socket.create_connection((address, port), *args))
+        try:
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            connection.request('GET', path)
+            response = connection.getresponse()
+
+            location = response.getheader('Location')
+            if response.status in REDIRECTS and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if response.status != 200:
+                raise ImageError(f"{url} answered {response.status}")
+            return response.read(max_bytes + 1)
+        finally:
+            connection.close()
+
+    raise ImageError(f"too many redirects from {url}")
+
+
+def fetch_source(url, static_folder, timeout=5, max_bytes=10 * 1024 * 1024):
+    """Return the bytes of the image at `url`.
+
+    /static/... URLs are read from `static_folder`; anything else must be
+    http(s) on a public address. Raises ImageError if it can't be read or
+    is over `max_bytes`.
+    """
+
+    if url.startswith('/static/'):
+        path = safe_join(static_folder, url[len('/static/'):])
+        if not path or not os.path.isfile(path):
+            raise ImageError(f"no static file for {url}")
+        with open(path, 'rb') as f:
+            data = f.read(max_bytes + 1)
+
+    elif url.startswith(('http://', 'https://')):
+        try:
+            data = fetch_url(url, timeout, max_bytes)
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            raise ImageError(f"couldn't fetch {url}: {e}") from e
+
+    else:
+        raise ImageError(f"unsupported image URL {url}")
+
+    if len(data) > max_bytes:
+        raise ImageError(f"{url} is over {max_bytes} bytes")
+    return data
+
+
+def resize(data, size):
+    """Resize image bytes to one of the SIZES; returns (bytes, mimetype)."""
+
+    width, height, crop = SIZES[size]
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageError(f"couldn't decode image: {e}") from e
+
+    # Palette images can only be resized with nearest-neighbour
+    if image.mode == 'P':
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    if crop:
+        image = ImageOps.fit(image, (width, height), Image.Resampling.LANCZOS)
+    else:
+        image.thumbnail((width, height), Image.Resampling.LANCZOS)
+
+    # Keep transparency as PNG, flatten everything else to JPEG
+    out = io.BytesIO()
+    if image.mode in ('RGBA', 'LA'):
+        image.save(out, 'PNG', optimize=True)
+        return out.getvalue(), MIMETYPES['PNG']
+    image.convert('RGB').save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+    return out.getvalue(), MIMETYPES['JPEG']
+
+
+class DiskImageCache:
+    """Content-addressed store of resized images, capped at `max_bytes`."""
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'refs'), exist_ok=True)
+
+    def _ref_path(self, url, size):
+        digest = hashlib.sha256(f"{size}\0{url}".encode()).hexdigest()
+        return os.path.join(self.directory, 'refs', digest)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest)
+
+    def get(self, url, size):
+        """Return (path, mimetype) of the cached image, or None."""
+
+        try:
+            with open(self._ref_path(url, size)) as f:
+                digest, mimetype = f.read().split()
+        except (FileNotFoundError, ValueError):
+            return None
+
+        path = self._blob_path(digest)
+        try:
+            # Eviction goes by mtime, so touching marks it recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path, mimetype
+
+    def put(self, url, size, data, mimetype):
+        """Store resized `data` for (url, size); returns its path."""
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+
+        # Write-then-rename so readers never see a partial file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        ref = self._ref_path(url, size)
+        with open(f"{ref}.tmp", 'w') as f:
+            f.write(f"{digest} {mimetype}")
+        os.replace(f"{ref}.tmp", ref)
+
+        self.evict()
+        return path
+
+    def evict(self):
+        """Delete least recently used blobs until we're under max_bytes."""
+
+        with self._lock:
+            blobs = [entry for entry in os.scandir(os.path.join(self.directory, 'blobs'))
+                     if entry.is_file() and not entry.name.endswith('.tmp')]
+            stats = [(entry.stat(), entry.path) for entry in blobs]
+            total = sum(stat.st_size for stat, _ in stats)
+
+            for stat, path in sorted(stats, key=lambda s: s[0].st_mtime):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= stat.st_size
+
+    def size(self):
+        """Total bytes of cached images."""
+
+        return sum(entry.stat().st_size
+                   for entry in os.scandir(os.path.join(self.directory, 'blobs'))
+                   if entry.is_file())
+
+
+class ImageProxy:
+    """Sign image URLs for templates and serve resized copies of them.
+
+    Failures are remembered for `failure_ttl` seconds, for up to
+    `max_failures` images.
+    """
+
+    def __init__(self, cache, secret_key, fetch, failure_ttl=300, max_failures=10000):
+        self.cache = cache
+        self.fetch = fetch
+        self.signer = URLSafeSerializer(secret_key, salt='image-proxy')
+        self.failure_ttl = failure_ttl
+        self.max_failures = max_failures
+        self._locks = {}
+        self._failures = OrderedDict()
+        self._locks_lock = Lock()
+
+    def url(self, source, size):
+        """URL of `source` resized to `size`, for use in templates."""
+
+        if not source or Image is None:
+            return source
+        return url_for('image', size=size, key=self.signer.dumps(source))
+
+    def _lock_for(self, source, size):
+        # One fetch per image at a time, however many pages ask for it
+        with self._locks_lock:
+            return self._locks.setdefault((source, size), Lock())
+
+    def _recent_failure(self, source, size):
+        """The error from a recent failed attempt at this image, or None."""
+
+        with self._locks_lock:
+            failure = self._failures.get((source, size))
+            if failure is None:
+                return None
+            expires, error = failure
+            if expires < monotonic():
+                del self._failures[(source, size)]
+                return None
+            return error
+
+    def _remember_failure(self, source, size, error):
+        with self._locks_lock:
+            self._failures[(source, size)] = (monotonic() + self.failure_ttl, str(error))
+            self._failures.move_to_end((source, size))
+            while len(self._failures) > self.max_failures:
+                self._failures.popitem(last=False)
+
+    def get(self, size, key):
+        """Return (path, mimetype) of the resized image for a signed `key`.
+
+        Raises ImageError if it can't be produced.
+        """
+
+        try:
+            source = self.signer.loads(key)
+        except BadSignature as e:
+            raise ImageError("bad image key") from e
+
+        cached = self.cache.get(source, size)
+        if cached:
+            return cached
+
+        lock = self._lock_for(source, size)
+        try:
+            with lock:
+                cached = self.cache.get(source, size)
+                if cached:
+                    return cached
+
+                error = self._recent_failure(source, size)
+                if error is not None:
+                    raise ImageError(f"failed recently: {error}")
+                try:
+                    data, mimetype = resize(self.fetch(source), size)
+                except ImageError as e:
+                    self._remember_failure(source, size, e)
+                    raise
+                return self.cache.put(source, size, data, mimetype), mimetype
+        finally:
+            with self._locks_lock:
+                self._locks.pop((source, size), None)
+
+
+def connect_images(app, fetch=None):
+    """Add the `image_url` template helper and the /img route to `app`.
+
+    Returns the ImageProxy. Pass `fetch(url)` to change how sources are read.
+    """
+
+    cache = DiskImageCache(
+        app.config.get('IMAGE_CACHE_DIR') or os.path.join(app.instance_path, 'image-cache'),
+        max_bytes=app.config.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+    if fetch is None:
+        def fetch(url):
+            return fetch_source(
+                url, app.static_folder,
+                timeout=app.config.get('IMAGE_FETCH_TIMEOUT', 5),
+                max_bytes=app.config.get('IMAGE_MAX_SOURCE_BYTES', 10 * 1024 * 1024))
+
+    images = ImageProxy(cache, app.config['SECRET_KEY'], fetch=fetch,
+                        failure_ttl=app.config.get('IMAGE_FAILURE_TTL', 300))
+
+    @app.route('/img/<size>/<key>', endpoint='image')
+    def serve_image(size, key):
+        """Serve the image behind `key` at `size`, resizing it on first use."""
+
+        if size not in SIZES or Image is None:
+            abort(404)
+        try:
+            path, mimetype = images.get(size, key)
+        except ImageError as e:
+            current_app.logger.info("image proxy: %s", e)
+            abort(404)
+        return send_file(path, mimetype=mimetype, conditional=True)
+
+    app.jinja_env.globals['image_url'] = images.url
+    app.extensions['images'] = images
+    return images
@@ -0,0 +1,297 @@
+"""Request instrumentation and a Prometheus-style /metrics endpoint.
+
+Every request records its latency by endpoint, how many SQL statements
+it ran and how long they took, and how long its templates took to
+render; bcrypt hashes and checks are timed too. Everything is kept in
+this process and served as Prometheus text from /metrics (each worker
+process reports its own numbers, as with any multi-process exporter).
+
+If SLOW_REQUEST_MS is set, requests slower than that are logged with the
+SQL statements they ran, to show which queries an endpoint regressed on.
+
+Set METRICS_TOKEN to require `Authorization: Bearer <token>` on /metrics.
+"""
+
+import bisect
+import hmac
+import math
+from threading import Lock
+from time import perf_counter
+
+from flask import (abort, before_render_template, current_app, g,
+                   has_request_context, request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+# Slow-request logs keep at most this many statements, this long each
+SLOW_LOG_STATEMENTS = 100
+SLOW_LOG_STATEMENT_LENGTH = 500
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count, per combination of label values."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name + _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Counts of observations in cumulative buckets, plus their sum."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        labelnames = self.labelnames + ('le',)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (f"{self.name}_bucket"
+                       f"{_format_labels(labelnames, key + (_format_value(bound),))}",
+                       cumulative)
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)}", total
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)}", cumulative
+
+
+class Callback:
+    """A value read when metrics are scraped, e.g. a cache's hit count.
+
+    `read()` returns a number, or a dict of label value tuples -> number.
+    """
+
+    def __init__(self, name, help, type, read, labelnames=()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.read = read
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        value = self.read()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for key, number in sorted(value.items()):
+            yield self.name + _format_labels(self.labelnames, key), number
+
+
+class Registry:
+    """The set of metrics served from /metrics."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, read, type='gauge', labelnames=()):
+        return self.register(Callback(name, help, type, read, labelnames))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+class Metrics:
+    """The app's request, SQL, template and bcrypt metrics."""
+
+    def __init__(self, registry=None):
+        self.registry = registry or Registry()
+        r = self.registry
+
+        self.requests = r.counter(
+            'warbler_http_requests_total', "Requests handled.",
+            ['endpoint', 'method', 'status'])
+        self.latency = r.histogram(
+            'warbler_http_request_duration_seconds', "Time to build a response.",
+            ['endpoint', 'method'])
+        self.queries = r.histogram(
+            'warbler_db_queries_per_request', "SQL statements run per request.",
+            ['endpoint'], buckets=QUERY_COUNT_BUCKETS)
+        self.query_time = r.histogram(
+            'warbler_db_seconds_per_request', "Time spent in SQL per request.",
+            ['endpoint'])
+        self.render_time = r.histogram(
+            'warbler_template_render_seconds', "Time to render a template.",
+            ['template'])
+        self.bcrypt_time = r.histogram(
+            'warbler_bcrypt_seconds', "Time to hash or check a password.",
+            ['operation'])
+        self.slow_requests = r.counter(
+            'warbler_slow_requests_total', "Requests slower than SLOW_REQUEST_MS.",
+            ['endpoint'])
+
+    def observe_bcrypt(self, operation, seconds):
+        self.bcrypt_time.observe(seconds, operation=operation)
+
+
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def connect_metrics(app, hasher=None):
+    """Instrument `app` (and `hasher`, if given) and add the /metrics route.
+
+    Returns the `Metrics`; add app-specific values with
+    `metrics.registry.callback(...)`.
+    """
+
+    metrics = Metrics()
+
+    @app.before_request
+    def start_timing():
+        g.metrics_start = perf_counter()
+        g.metrics_queries = 0
+        g.metrics_query_seconds = 0.0
+        slow_ms = current_app.config.get('SLOW_REQUEST_MS')
+        g.metrics_statements = [] if slow_ms is not None else None
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+
+        elapsed = perf_counter() - start
+        endpoint = _endpoint()
+        metrics.requests.inc(endpoint=endpoint, method=request.method,
+                             status=response.status_code)
+        metrics.latency.observe(elapsed, endpoint=endpoint, method=request.method)
+        metrics.queries.observe(g.metrics_queries, endpoint=endpoint)
+        metrics.query_time.observe(g.metrics_query_seconds, endpoint=endpoint)
+
+        slow_ms = current_app.config.get('SLOW_REQUEST_MS')
+        if (slow_ms is not None and g.metrics_statements is not None
+                and elapsed * 1000 >= slow_ms):
+            metrics.slow_requests.inc(endpoint=endpoint)
+            statements = '\n'.join(f"  {seconds * 1000:8.2f} ms  {statement}"
+                                   for statement, seconds in g.metrics_statements)
+            app.logger.warning(
+                "slow request: %s %s (%s) took %.0f ms, %d queries in %.0f ms\n%s",
+                request.method, request.full_path, endpoint, elapsed * 1000,
+                g.metrics_queries, g.metrics_query_seconds * 1000, statements)
+        return response
+
+    # Listen on every Engine, so replicas or other binds are counted too
+    def query_started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(perf_counter())
+
+    def query_finished(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_query_start')
+        if not starts or not has_request_context() or 'metrics_start' not in g:
+            if starts:
+                starts.pop()
+            return
+        seconds = perf_counter() - starts.pop()
+        g.metrics_queries += 1
+        g.metrics_query_seconds += seconds
+        if (g.metrics_statements is not None
+                and len(g.metrics_statements) < SLOW_LOG_STATEMENTS):
+            g.metrics_statements.append((statement[:SLOW_LOG_STATEMENT_LENGTH], seconds))
+
+    def query_failed(context):
+        starts = context.connection.info.get('metrics_query_start') if context.connection else None
+        if starts:
+            starts.pop()
+
+    event.listen(Engine, 'before_cursor_execute', query_started)
+    event.listen(Engine, 'after_cursor_execute', query_finished)
+    event.listen(Engine, 'handle_error', query_failed)
+
+    def render_started(sender, template, context, **extra):
+        g.setdefault('metrics_render_starts', []).append(perf_counter())
+
+    def render_finished(sender, template, context, **extra):
+        starts = g.get('metrics_render_starts')
+        if starts:
+            metrics.render_time.observe(perf_counter() - starts.pop(),
+                                        template=template.name or 'unknown')
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+    if hasher is not None:
+        hasher.observers.append(metrics.observe_bcrypt)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        """Serve the metrics as Prometheus text."""
+
+        token = current_app.config.get('METRICS_TOKEN')
+        if token and not hmac.compare_digest(
+                request.headers.get('Authorization', ''), f"Bearer {token}"):
+            abort(401)
+        return (metrics.registry.render(), 200,
+                {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app.extensions['metrics'] = metrics
+    return metrics
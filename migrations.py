@@ -0,0 +1,223 @@
+"""Schema migrations for databases created by older versions of Warbler.
+
+`db.create_all()` creates missing tables but never changes existing ones,
+so a database made before a model gained a column or index won't get it.
+Each migration here brings such a database up to date. They check for the
+change before making it, so they're harmless against a schema that already
+has it (e.g. one made by a current `create_all()`). The versions that have
+run are recorded in the `schema_migrations` table.
+
+    flask db-upgrade
+
+Index builds lock their table for writes while they run; on a large
+production database, run this during a quiet period.
+"""
+
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import MetaData, inspect, select, text
+from sqlalchemy.schema import CreateColumn
+
+from models import db, Likes, Message, User, TimelineEntry, USERNAME_TRGM_INDEX
+from search import reindex
+
+# Kept out of db.metadata so create_all()/drop_all() leave the history alone
+schema_migrations = db.Table(
+    'schema_migrations',
+    MetaData(),
+    db.Column('version', db.String(64), primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False, default=datetime.utcnow),
+)
+
+MIGRATIONS = []
+
+
+def migration(version):
+    """Register the decorated function as the migration `version`.
+
+    Migrations run in the order they're registered, each given the
+    session's connection.
+    """
+
+    def register(fn):
+        MIGRATIONS.append((version, fn))
+        return fn
+    return register
+
+
+def add_missing_columns(conn, table, names):
+    """Add the model columns `names` to `table` where the database lacks them.
+
+    Returns the names that were added.
+    """
+
+    existing = {col['name'] for col in inspect(conn).get_columns(table.name)}
+    added = [name for name in names if name not in existing]
+    for name in added:
+        spec = CreateColumn(table.c[name]).compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {spec}"))
+    return added
+
+
+def create_missing_indexes(conn, names):
+    """Create the model indexes `names` where the database lacks them."""
+
+    indexes = {index.name: index
+               for table in db.metadata.tables.values()
+               for index in table.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+
+@migration('0001_timelines')
+def add_timelines(conn):
+    """Home timelines (fan-out on write); filled by 0011."""
+
+    if not inspect(conn).has_table(TimelineEntry.__tablename__):
+        TimelineEntry.__table__.create(conn)
+
+
+@migration('0002_user_counters')
+def add_user_counters(conn):
+    """Denormalized message/follow/like counts on users."""
+
+    added = add_missing_columns(conn, User.__table__, [
+        'messages_count', 'following_count', 'followers_count', 'likes_count',
+    ])
+    if added:
+        User.reconcile_counts()
+
+
+@migration('0003_username_trigram_index')
+def add_username_trigram_index(conn):
+    """Trigram index backing username substring search (Postgres only)."""
+
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text(USERNAME_TRGM_INDEX))
+
+
+@migration('0004_message_search')
+def add_message_search(conn):
+    """Full-text search over message text."""
+
+    reindex()
+
+
+@migration('0005_feed_indexes')
+def add_feed_indexes(conn):
+    """Indexes for per-author feeds and followees."""
+
+    create_missing_indexes(conn, [
+        'ix_messages_user_id_timestamp',
+        'ix_follows_user_following_id',
+    ])
+
+
+@migration('0006_likes_composite_key')
+def key_likes_by_user_and_message(conn):
+    """Key likes on (user_id, message_id) so many users can like a message."""
+
+    columns = {col['name'] for col in inspect(conn).get_columns('likes')}
+    if 'id' in columns:
+        conn.execute(text("DROP INDEX IF EXISTS ix_likes_user_id"))
+        conn.execute(text("DELETE FROM likes "
+                          "WHERE user_id IS NULL OR message_id IS NULL"))
+
+        if conn.dialect.name == 'postgresql':
+            # Constraint names are Postgres's defaults for the old model
+            conn.execute(text("ALTER TABLE likes "
+                              "DROP CONSTRAINT likes_pkey, "
+                              "DROP CONSTRAINT likes_message_id_key, "
+                              "DROP COLUMN id, "
+                              "ADD PRIMARY KEY (user_id, message_id)"))
+        else:
+            # SQLite can't change a primary key in place, so copy the table
+            conn.execute(text("ALTER TABLE likes RENAME TO likes_old"))
+            Likes.__table__.create(conn)
+            conn.execute(text("INSERT INTO likes (user_id, message_id) "
+                              "SELECT DISTINCT user_id, message_id FROM likes_old"))
+            conn.execute(text("DROP TABLE likes_old"))
+
+    create_missing_indexes(conn, ['ix_likes_message_id'])
+
+
+@migration('0007_message_likes_count')
+def add_message_likes_count(conn):
+    """Denormalized like count on messages."""
+
+    if add_missing_columns(conn, Message.__table__, ['likes_count']):
+        Message.reconcile_counts()
+
+
+@migration('0008_user_profile_version')
+def add_user_profile_version(conn):
+    """Profile version used to key cached message fragments."""
+
+    add_missing_columns(conn, User.__table__, ['profile_version'])
+
+
+@migration('0009_sqlite_timestamp_precision')
+def pad_sqlite_timestamps(conn):
+    """Store SQLite message times with microseconds, as cursors compare them."""
+
+    if conn.dialect.name == 'sqlite':
+        for table in (Message.__table__, TimelineEntry.__table__):
+            conn.execute(text(f"UPDATE {table.name} "
+                              "SET timestamp = timestamp || '.000000' "
+                              "WHERE length(timestamp) = 19"))
+
+
+@migration('0010_message_fanned_out')
+def add_message_fanned_out(conn):
+    """Record which messages were fanned out to followers' timelines."""
+
+    if add_missing_columns(conn, Message.__table__, ['fanned_out']):
+        # Until now, authors over the limit were never fanned out
+        limit = current_app.config.get('TIMELINE_FANOUT_LIMIT')
+        if limit is not None:
+            conn.execute(db.update(Message)
+                         .where(Message.user_id.in_(
+                             select(User.id).where(User.followers_count > limit)))
+                         .values(fanned_out=False))
+    create_missing_indexes(conn, ['ix_messages_unfanned_user_id_timestamp'])
+
+
+@migration('0011_fill_timelines')
+def fill_timelines(conn):
+    """Fill home timelines left empty by 0001.
+
+    Backfilling reads columns added by later migrations (follower counts,
+    fanned_out), so it runs after all of them. Keep this one last.
+    """
+
+    has_entries = conn.execute(select(TimelineEntry.user_id).limit(1)).first()
+    has_messages = conn.execute(select(Message.id).limit(1)).first()
+    if has_messages and not has_entries:
+        current_app.extensions['timeline'].backfill()
+
+
+def applied_versions(conn):
+    """The set of migration versions already applied to this database."""
+
+    schema_migrations.create(conn, checkfirst=True)
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def upgrade():
+    """Apply every pending migration in order; returns their versions.
+
+    Runs in the current session's transaction; the caller commits.
+    """
+
+    conn = db.session.connection()
+    done = applied_versions(conn)
+
+    applied = []
+    for version, fn in MIGRATIONS:
+        if version not in done:
+            fn(conn)
+            conn.execute(schema_migrations.insert().values(version=version))
+            applied.append(version)
+    return applied
@@ -2,15 +2,18 @@
 
 from datetime import datetime
 
-from sqlalchemy.sql import expression
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.sql import expression, func
 from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, joinedload
 from sqlalchemy.types import DateTime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from passwords import hasher
+from replicas import RoutingSQLAlchemy
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 class utcnow(expression.FunctionElement):
     type = DateTime()
@@ -20,14 +23,48 @@ class utcnow(expression.FunctionElement):
 def pg_utcnow(element, compiler, **kw):
     return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
 
+@compiles(utcnow, 'sqlite')
+def sqlite_utcnow(element, compiler, **kw):
+    # SQLite keeps datetimes as text: store them in the format SQLAlchemy
+    # binds them in (with microseconds), so feed cursors compare correctly
+    return "STRFTIME('%Y-%m-%d %H:%M:%f000', 'now')"
+
 @compiles(utcnow, 'mssql')
 def ms_utcnow(element, compiler, **kw):
     return "GETUTCDATE()"
 
+
+def insert_or_ignore(table, **values):
+    """Insert a row into `table` unless one with the same key exists.
+
+    Runs a single INSERT ... ON CONFLICT DO NOTHING where the database
+    supports it (or a savepointed INSERT elsewhere). Returns whether a row
+    was inserted.
+    """
+
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}[dialect]
+        result = db.session.execute(insert(table).values(**values)
+                                    .on_conflict_do_nothing())
+        return result.rowcount == 1
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(table).values(**values))
+    except IntegrityError:
+        return False
+    return True
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # The primary key serves "who follows X"; this serves "who does X follow".
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -45,22 +82,55 @@ class Follows(db.Model):
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
+    __table_args__ = (
+        # The primary key serves "what did X like"; this serves "who liked X".
+        db.Index('ix_likes_message_id', 'message_id', 'user_id'),
+    )
 
-    id = db.Column(
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
         db.Integer,
-        primary_key=True
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline (fan-out on write)."""
+
+    __tablename__ = 'timelines'
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timelines_author_id', 'author_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
     )
 
 
@@ -109,6 +179,46 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized sizes of the relationships below, kept up to date by
+    # the views that change them so stats don't have to load collections.
+    # `reconcile_counts` recomputes them if they ever drift.
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped on every profile edit; cached renderings of the user's
+    # messages are keyed on it so edits show up immediately.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', cascade="all, delete-orphan")
 
     followers = db.relationship(
@@ -131,20 +241,269 @@ class User(db.Model):
         secondary="likes"
     )
 
+    # Per-instance caches filled by cache_following/cache_likes.
+    _following_ids = None
+    _liked_ids = None
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def serialize(self):
+        return {
+            "id": self.id,
+            "username": self.username,
+            "image_url": self.image_url,
+            "header_image_url": self.header_image_url,
+            "bio": self.bio,
+            "location": self.location,
+            "messages_count": self.messages_count,
+            "following_count": self.following_count,
+            "followers_count": self.followers_count,
+            "likes_count": self.likes_count,
+        }
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_use`?
+
+        Uses the set from `cache_following` if it's been loaded, otherwise
+        asks the database with an EXISTS on the follows primary key.
+        """
+
+        if self._following_ids is not None:
+            return other_user.id in self._following_ids
+
+        return db.session.query(
+            Follows.query
+            .filter_by(user_following_id=self.id,
+                       user_being_followed_id=other_user.id)
+            .exists()
+        ).scalar()
+
+    def cache_following(self):
+        """Load the ids of users this user follows into a set and return it.
+
+        Pages that check follow state for many users call this first, so
+        each `is_following` check is a set lookup. The cache lives as long
+        as this instance, which for `g.user` is the current request.
+        """
+
+        self._following_ids = {
+            followed_id for (followed_id,) in
+            db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == self.id)
+        }
+        return self._following_ids
+
+    def cache_likes(self):
+        """Load the ids of messages this user likes into a set and return it."""
+
+        self._liked_ids = {
+            message_id for (message_id,) in
+            db.session.query(Likes.message_id)
+            .filter(Likes.user_id == self.id)
+        }
+        return self._liked_ids
+
+    def following_page(self, viewer_id, after=None, limit=24):
+        """List up to `limit` users this user follows, in id order after id `after`.
+
+        Returns (user, is_following) pairs, where `is_following` says
+        whether `viewer_id` follows that user. It's one statement: a range
+        of the follows index, joined to the users and to the viewer's own
+        follows.
+        """
+
+        return self._follow_page(Follows.user_following_id,
+                                 Follows.user_being_followed_id,
+                                 viewer_id, after, limit)
+
+    def followers_page(self, viewer_id, after=None, limit=24):
+        """List up to `limit` of this user's followers; see `following_page`."""
+
+        return self._follow_page(Follows.user_being_followed_id,
+                                 Follows.user_following_id,
+                                 viewer_id, after, limit)
+
+    def _follow_page(self, own_column, other_column, viewer_id, after, limit):
+        viewer = aliased(Follows)
+        query = (db.session.query(User, viewer.user_following_id.isnot(None))
+                 .join(Follows, other_column == User.id)
+                 .outerjoin(viewer, (viewer.user_being_followed_id == User.id)
+                            & (viewer.user_following_id == viewer_id))
+                 .filter(own_column == self.id))
+        if after is not None:
+            query = query.filter(other_column > after)
+        return [(user, bool(is_following)) for user, is_following in
+                query.order_by(other_column).limit(limit)]
+
+    def liked_messages(self, viewer_id, before=None, limit=20):
+        """List up to `limit` messages this user likes, newest first, before id `before`.
+
+        Returns (message, liked) pairs, where `liked` says whether
+        `viewer_id` likes the message too. Authors come in the same
+        statement.
+        """
+
+        viewer = aliased(Likes)
+        query = (db.session.query(Message, viewer.user_id.isnot(None))
+                 .options(joinedload(Message.user, innerjoin=True))
+                 .join(Likes, Likes.message_id == Message.id)
+                 .outerjoin(viewer, (viewer.message_id == Message.id)
+                            & (viewer.user_id == viewer_id))
+                 .filter(Likes.user_id == self.id))
+        if before is not None:
+            query = query.filter(Likes.message_id < before)
+        return [(message, bool(liked)) for message, liked in
+                query.order_by(Likes.message_id.desc()).limit(limit)]
+
+    def toggle_like(self, message_id):
+        """Like `message_id`, or unlike it if already liked; returns True if now liked.
+
+        Costs one keyed DELETE and at most one INSERT, however many likes
+        the user has, and keeps the user's and message's `likes_count` in
+        step.
+        """
+
+        unliked = db.session.execute(
+            db.delete(Likes)
+            .where(Likes.user_id == self.id, Likes.message_id == message_id)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+        if unliked:
+            self.adjust_counts(likes_count=-1)
+            Message.adjust_likes_count(message_id, -1)
+            return False
+
+        if insert_or_ignore(Likes.__table__, user_id=self.id, message_id=message_id):
+            self.adjust_counts(likes_count=1)
+            Message.adjust_likes_count(message_id, 1)
+        return True
+
+    def adjust_counts(self, **deltas):
+        """Add `deltas` to this user's counter columns.
+
+        e.g. user.adjust_counts(followers_count=1). The change is applied in
+        SQL (count = count + 1) when the session flushes, so concurrent
+        requests can't overwrite each other's updates.
+        """
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        for name, delta in deltas.items():
+            setattr(self, name, getattr(User, name) + delta)
+
+    def remove_from_counts(self):
+        """Decrement other users' counters that include this user.
+
+        Call before deleting the user: the people they follow lose a
+        follower, their followers follow one fewer account, and anyone who
+        liked their messages loses those likes, as does every message
+        they liked.
+        """
+
+        followed = (db.select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == self.id))
+        followers = (db.select(Follows.user_following_id)
+                     .where(Follows.user_being_followed_id == self.id))
+        liked = (db.select(func.count())
+                 .select_from(Likes)
+                 .join(Message, Message.id == Likes.message_id)
+                 .where(Likes.user_id == User.id)
+                 .where(Message.user_id == self.id)
+                 .scalar_subquery())
+
+        db.session.execute(db.update(User)
+                           .where(User.id.in_(followed))
+                           .values(followers_count=User.followers_count - 1)
+                           .execution_options(synchronize_session=False))
+        db.session.execute(db.update(User)
+                           .where(User.id.in_(followers))
+                           .values(following_count=User.following_count - 1)
+                           .execution_options(synchronize_session=False))
+        db.session.execute(db.update(User)
+                           .where(User.id != self.id)
+                           .where(User.id.in_(db.select(Likes.user_id)
+                                              .join(Message, Message.id == Likes.message_id)
+                                              .where(Message.user_id == self.id)))
+                           .values(likes_count=User.likes_count - liked)
+                           .execution_options(synchronize_session=False))
+        db.session.execute(db.update(Message)
+                           .where(Message.id.in_(db.select(Likes.message_id)
+                                                 .where(Likes.user_id == self.id)))
+                           .values(likes_count=Message.likes_count - 1)
+                           .execution_options(synchronize_session=False))
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counter columns from the source tables.
+
+        Returns the number of users whose counts had drifted.
+        """
+
+        actual = {
+            'messages_count': (db.select(func.count())
+                               .select_from(Message)
+                               .where(Message.user_id == cls.id)),
+            'following_count': (db.select(func.count())
+                                .select_from(Follows)
+                                .where(Follows.user_following_id == cls.id)),
+            'followers_count': (db.select(func.count())
+                                .select_from(Follows)
+                                .where(Follows.user_being_followed_id == cls.id)),
+            'likes_count': (db.select(func.count())
+                            .select_from(Likes)
+                            .where(Likes.user_id == cls.id)),
+        }
+        actual = {name: query.scalar_subquery() for name, query in actual.items()}
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(db.or_(*(getattr(cls, name) != count
+                            for name, count in actual.items())))
+            .values(**actual)
+            .execution_options(synchronize_session=False))
+        return result.rowcount
+
+    @classmethod
+    def directory(cls, after=None, limit=24):
+        """List up to `limit` users in id order, starting after id `after`."""
+
+        query = cls.query
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def search(cls, term, offset=0, limit=24):
+        """Find users whose username contains `term`, best matches first.
+
+        Exact matches rank first, then prefix matches, then the rest. On
+        Postgres the rest are ordered by trigram similarity and the match is
+        served by the pg_trgm GIN index; elsewhere shorter names rank higher.
+        """
+
+        escaped = (term.replace('!', '!!')
+                       .replace('%', '!%')
+                       .replace('_', '!_'))
+        ranking = [
+            (func.lower(cls.username) == term.lower()).desc(),
+            cls.username.ilike(f"{escaped}%", escape='!').desc(),
+        ]
+        if db.engine.dialect.name == 'postgresql':
+            ranking.append(func.similarity(cls.username, term).desc())
+        else:
+            ranking.append(func.length(cls.username))
+
+        return (cls.query
+                .filter(cls.username.ilike(f"%{escaped}%", escape='!'))
+                .order_by(*ranking, cls.id)
+                .offset(offset)
+                .limit(limit)
+                .all())
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -153,7 +512,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -174,18 +533,40 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash used a different work factor than is configured
+        now, the password is rehashed; the caller commits the new hash.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
 
+# Substring search on usernames can't use a btree index; on Postgres, back
+# it with a trigram GIN index instead.
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql'),
+)
+USERNAME_TRGM_INDEX = ("CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+                       "ON users USING gin (username gin_trgm_ops)")
+
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL(USERNAME_TRGM_INDEX).execute_if(dialect='postgresql'),
+)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -201,9 +582,12 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Also set by the INSERT itself, for SQLite databases whose column
+    # default predates the current utcnow()
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
+        default=utcnow(),
         server_default=utcnow()
     )
 
@@ -213,17 +597,97 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Number of users who like this message, kept up to date by
+    # `User.toggle_like` so feeds can show it without counting likes.
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Whether the message was copied into its followers' timelines when it
+    # was posted; if not (its author was over the fan-out limit), home
+    # feeds pull it in when they're read. See timeline.py.
+    fanned_out = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+        server_default=db.true(),
+    )
+
+    # Loaded lazily; queries for pages that show the author (feeds, search,
+    # a single message) add joinedload(Message.user) themselves.
     user = db.relationship('User', overlaps="messages")
 
     def __repr__(self):
         return f"<Message #{self.id}: {self.text}, User#{self.user_id}>"
 
+    def remove_from_counts(self):
+        """Decrement the counters that include this message.
+
+        Call before deleting it: the author has one fewer message and
+        everyone who liked it has one fewer like.
+        """
+
+        self.user.adjust_counts(messages_count=-1)
+        db.session.execute(db.update(User)
+                           .where(User.id.in_(db.select(Likes.user_id)
+                                              .where(Likes.message_id == self.id)))
+                           .values(likes_count=User.likes_count - 1)
+                           .execution_options(synchronize_session=False))
+
+    def likers(self, after=None, limit=24):
+        """List up to `limit` users who like this message, in id order after id `after`."""
+
+        return db.session.scalars(self.likers_query(self.id, after, limit)).all()
+
+    @staticmethod
+    def likers_query(message_id, after=None, limit=24):
+        """Statement selecting the users who like `message_id`; see `likers`."""
+
+        query = (db.select(User)
+                 .join(Likes, Likes.user_id == User.id)
+                 .where(Likes.message_id == message_id))
+        if after is not None:
+            query = query.where(Likes.user_id > after)
+        return query.order_by(Likes.user_id).limit(limit)
+
+    @classmethod
+    def adjust_likes_count(cls, message_id, delta):
+        """Add `delta` to a message's like count, in SQL so concurrent likes don't collide."""
+
+        db.session.execute(db.update(cls)
+                           .where(cls.id == message_id)
+                           .values(likes_count=cls.likes_count + delta)
+                           .execution_options(synchronize_session=False))
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every message's like count from the likes table.
+
+        Returns the number of messages whose count had drifted.
+        """
+
+        actual = (db.select(func.count())
+                  .select_from(Likes)
+                  .where(Likes.message_id == cls.id)
+                  .scalar_subquery())
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(cls.likes_count != actual)
+            .values(likes_count=actual)
+            .execution_options(synchronize_session=False))
+        return result.rowcount
+
     def serialize(self):
         return {
             "id": self.id,
             "text": self.text,
             "user_id": self.user_id,
             "timestamp": self.timestamp.strftime('%d %B %Y'),
+            "likes_count": self.likes_count,
             "user": {
                 "id": self.user.id,
                 "image_url": self.user.image_url,
@@ -232,6 +696,18 @@ class Message(db.Model):
         }
 
 
+# Profile pages and the feed API page through one author's messages newest
+# first; this serves them straight from the index, with no sort.
+db.Index('ix_messages_user_id_timestamp',
+         Message.user_id, Message.timestamp.desc(), Message.id.desc())
+
+# Home feeds pull in the few messages that weren't fanned out
+db.Index('ix_messages_unfanned_user_id_timestamp',
+         Message.user_id, Message.timestamp.desc(), Message.id.desc(),
+         postgresql_where=~Message.fanned_out,
+         sqlite_where=~Message.fanned_out)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
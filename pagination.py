@@ -0,0 +1,98 @@
+"""Keyset (cursor) pagination helpers.
+
+Feeds are ordered newest-first on (timestamp, id). Rather than OFFSET,
+each page ends with an opaque cursor naming its last row; the next page
+asks for rows strictly "before" that key, which the database answers
+straight from an index no matter how deep into history the client is.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def _pack(*parts):
+    raw = '|'.join(parts).encode('UTF-8')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _unpack(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return urlsafe_b64decode(padded).decode('UTF-8').split('|')
+
+
+def encode_cursor(timestamp, id):
+    """Return an opaque cursor pointing at the row (timestamp, id)."""
+
+    return _pack(timestamp.isoformat(), str(id))
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into a (timestamp, id) tuple.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    try:
+        timestamp, id = _unpack(cursor)
+        return datetime.fromisoformat(timestamp), int(id)
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def encode_rank_cursor(rank, id):
+    """Return an opaque cursor pointing at the search result (rank, id)."""
+
+    return _pack(repr(float(rank)), str(id))
+
+
+def decode_rank_cursor(cursor):
+    """Turn a search cursor back into a (rank, id) tuple.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    try:
+        rank, id = _unpack(cursor)
+        return float(rank), int(id)
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def before_key(timestamp_col, id_col, before):
+    """Filter clause for rows that sort after `before` in newest-first order."""
+
+    return tuple_(timestamp_col, id_col) < tuple_(*before)
+
+
+def page_of(items, size):
+    """Split a fetch of up to `size + 1` items into (page, next_cursor).
+
+    Items must have `timestamp` and `id` attributes. `next_cursor` is None
+    when there's nothing older than this page.
+    """
+
+    if len(items) <= size:
+        return items, None
+
+    items = items[:size]
+    last = items[-1]
+    return items, encode_cursor(last.timestamp, last.id)
+
+
+def paginate(query, timestamp_col, id_col, before, size):
+    """Fetch one newest-first page of `query` starting after `before`.
+
+    Returns (items, next_cursor), as `page_of`.
+    """
+
+    if before is not None:
+        query = query.filter(before_key(timestamp_col, id_col, before))
+
+    items = (query
+             .order_by(timestamp_col.desc(), id_col.desc())
+             .limit(size + 1)
+             .all())
+    return page_of(items, size)
@@ -0,0 +1,114 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow (~250ms at cost 12) and releases the GIL while
+it works, so a dedicated pool (one thread per core by default) can hash on
+every core at once while capping how much CPU a burst of logins can take;
+set PASSWORD_HASH_WORKERS lower to keep cores free for pages. `queue_depth` shows how many hashes are waiting or running, and
+each function in `observers` is called with the operation ('hash' or
+'check') and the seconds it took.
+
+The pool bounds CPU, not request threads: `hash` and `check` block their
+caller until the result is ready, so a request worker that logs someone
+in is still tied up for the whole wait, queueing included. Under a login
+burst, size the web server's worker pool with that in mind.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+
+from flask_bcrypt import Bcrypt
+
+
+class PasswordHasher:
+    """Hash and check passwords with bcrypt on a pool of worker threads.
+
+    rounds: bcrypt work factor for new hashes (BCRYPT_LOG_ROUNDS).
+    workers: pool size (PASSWORD_HASH_WORKERS), defaulting to the CPU count.
+    """
+
+    def __init__(self, rounds=12, workers=None):
+        self.rounds = rounds
+        self.workers = workers or default_workers()
+        self.queue_depth = 0
+        self.observers = []
+        self._bcrypt = Bcrypt()
+        self._pool = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """Read the work factor and pool size from `app`'s config."""
+
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS') or self.workers
+        app.extensions['password_hasher'] = self
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='bcrypt')
+            return self._pool
+
+    def _submit(self, operation, fn, *args):
+        with self._lock:
+            self.queue_depth += 1
+        return self.pool.submit(self._run, operation, fn, *args)
+
+    def _run(self, operation, fn, *args):
+        start = perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = perf_counter() - start
+            with self._lock:
+                self.queue_depth -= 1
+            for observer in self.observers:
+                observer(operation, elapsed)
+
+    def submit_hash(self, password):
+        """Start hashing `password`; returns a Future of the hash string."""
+
+        return self._submit('hash', self._hash, password, self.rounds)
+
+    def submit_check(self, hashed, password):
+        """Start checking `password` against `hashed`; returns a Future of a bool."""
+
+        return self._submit('check', self._bcrypt.check_password_hash, hashed, password)
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured work factor.
+
+        Blocks until a pool worker has made it.
+        """
+
+        return self.submit_hash(password).result()
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?
+
+        Blocks until a pool worker has checked it.
+        """
+
+        return self.submit_check(hashed, password).result()
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different work factor than configured?"""
+
+        # bcrypt hashes look like $2b$<rounds>$<salt+checksum>
+        return int(hashed.split('$')[2]) != self.rounds
+
+    def _hash(self, password, rounds):
+        return self._bcrypt.generate_password_hash(password, rounds).decode('UTF-8')
+
+
+def default_workers():
+    """The CPU count, and at least one."""
+
+    return os.cpu_count() or 1
+
+
+hasher = PasswordHasher()
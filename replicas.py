@@ -0,0 +1,102 @@
+"""Read replicas and connection pool settings.
+
+Views decorated with `@read_replica` only read, so their GET requests
+may be served from a replica (one of DATABASE_REPLICAS, which are binds
+in SQLALCHEMY_BINDS). Everything else goes to the primary, and so does
+any statement that writes: flushes and INSERT/UPDATE/DELETE statements
+always use the primary, and once a session has written, the rest of its
+reads do too.
+
+Replicas lag behind the primary, so after a user makes a request that
+can write (anything but GET/HEAD/OPTIONS) their own requests read from
+the primary for REPLICA_STICKY_SECONDS. That way people see their own
+posts, follows and likes straight away; other people's changes may show
+up a moment later.
+"""
+
+import random
+import time
+
+from flask import request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+# session.info key holding the bind name of the replica to read from
+REPLICA = 'replica'
+
+# Flask session key: read from the primary until this (epoch) time
+PRIMARY_UNTIL = '_primary_until'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the replica named in `info['replica']`."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = self.info.get(REPLICA)
+        if replica is not None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                # Writes go to the primary, and later reads should see them
+                self.info[REPLICA] = None
+            else:
+                return get_state(self.app).db.get_engine(self.app, bind=replica)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with replica routing and per-driver pool options."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        return super().create_engine(sa_url, engine_options(sa_url, engine_opts))
+
+
+def engine_options(sa_url, options):
+    """`options` for an engine on `sa_url`, leaving out pool sizes for SQLite."""
+
+    if sa_url.drivername.startswith('sqlite'):
+        # SQLite doesn't use a sized connection pool
+        options = {name: value for name, value in options.items()
+                   if name not in ('pool_size', 'max_overflow')}
+    return options
+
+
+def replica_binds(urls):
+    """SQLALCHEMY_BINDS entries for a comma-separated list of replica URLs."""
+
+    urls = [url.strip() for url in urls.split(',') if url.strip()]
+    return {f"replica{i}": url for i, url in enumerate(urls)}
+
+
+def read_replica(view):
+    """Mark `view` as read-only, so its GET requests may use a replica."""
+
+    view.read_replica = True
+    return view
+
+
+def connect_replicas(app, db):
+    """Route `app`'s read-only views to its replicas, if it has any."""
+
+    @app.before_request
+    def choose_database():
+        replicas = app.config.get('DATABASE_REPLICAS')
+        if not replicas:
+            return
+        view = app.view_functions.get(request.endpoint)
+        if (request.method in SAFE_METHODS
+                and getattr(view, 'read_replica', False)
+                and session.get(PRIMARY_UNTIL, 0) <= time.time()):
+            db.session.info[REPLICA] = random.choice(replicas)
+        else:
+            db.session.info.pop(REPLICA, None)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if app.config.get('DATABASE_REPLICAS') and request.method not in SAFE_METHODS:
+            session[PRIMARY_UNTIL] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+        return response
@@ -0,0 +1,127 @@
+"""Full-text search over messages.
+
+On Postgres, messages get a generated `search_vector` tsvector column with
+a GIN index. On SQLite (handy for local development) an FTS5 table mirrors
+message text and is kept in sync by triggers. Both are created alongside
+the messages table; `reindex` (re)builds them for existing rows.
+"""
+
+from sqlalchemy import (DDL, Float, cast, column, event, func, literal_column, table,
+                        text, tuple_)
+from sqlalchemy.orm import joinedload
+
+from models import db, Message
+from pagination import encode_rank_cursor
+
+PG_SEARCH_INDEX = ("CREATE INDEX IF NOT EXISTS ix_messages_search_vector "
+                   "ON messages USING gin (search_vector)")
+
+PG_SEARCH_DDL = [
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('english', text)) STORED",
+    PG_SEARCH_INDEX,
+]
+
+SQLITE_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+    "USING fts5(text, content='messages', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END",
+]
+
+for statement in PG_SEARCH_DDL:
+    event.listen(Message.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+
+for statement in SQLITE_SEARCH_DDL:
+    event.listen(Message.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+
+messages_fts = table('messages_fts', column('rowid'), column('messages_fts'))
+
+event.listen(Message.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'))
+
+
+def _fts5_query(term):
+    """Quote each word of `term` so FTS5 treats it as plain text."""
+
+    words = term.split()
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def search_messages(term, before=None, limit=20):
+    """Find messages matching `term`, best first.
+
+    Returns (messages, next_cursor). Pages are keyed on (rank, id), so pass
+    a decoded cursor as `before` to get the next page.
+    """
+
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        vector = literal_column('messages.search_vector')
+        tsquery = func.websearch_to_tsquery('english', term)
+        # ts_rank() is a float4; compared with the (float8) cursor value
+        # it would never equal itself, and ties would be skipped
+        rank = cast(func.ts_rank(vector, tsquery), Float(53))
+        query = (db.session
+                 .query(Message, rank.label('rank'))
+                 .filter(vector.op('@@')(tsquery)))
+
+    elif dialect == 'sqlite':
+        words = _fts5_query(term)
+        if not words:
+            return [], None
+        # bm25() scores better matches lower, so negate it to rank them first
+        rank = -func.bm25(messages_fts.c.messages_fts)
+        query = (db.session
+                 .query(Message, rank.label('rank'))
+                 .join(messages_fts, messages_fts.c.rowid == Message.id)
+                 .filter(messages_fts.c.messages_fts.match(words)))
+
+    else:
+        raise NotImplementedError(f"Full-text search isn't supported on {dialect}")
+
+    query = query.options(joinedload(Message.user, innerjoin=True))
+    if before is not None:
+        query = query.filter(tuple_(rank, Message.id) < tuple_(*before))
+
+    rows = (query
+            .order_by(rank.desc(), Message.id.desc())
+            .limit(limit + 1)
+            .all())
+
+    messages = [msg for msg, _ in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last, last_rank = rows[limit - 1]
+        next_cursor = encode_rank_cursor(last_rank, last.id)
+
+    return messages, next_cursor
+
+
+def reindex():
+    """Create any missing search structures and rebuild them from messages."""
+
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        for statement in PG_SEARCH_DDL:
+            db.session.execute(text(statement))
+        db.session.execute(text("REINDEX INDEX ix_messages_search_vector"))
+
+    elif dialect == 'sqlite':
+        for statement in SQLITE_SEARCH_DDL:
+            db.session.execute(text(statement))
+        db.session.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+
+    else:
+        raise NotImplementedError(f"Full-text search isn't supported on {dialect}")
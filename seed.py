@@ -1,20 +1,127 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py                 # the small sample data in generator/
+    python seed.py <dataset-dir>   # e.g. the output of generator/synthetic.py
 
+Tables are loaded with COPY on Postgres (batched executemany elsewhere).
+Foreign keys and secondary indexes are dropped for the load and rebuilt
+once at the end, which is much faster than maintaining them row by row.
+"""
 
-db.drop_all()
-db.create_all()
+import csv
+import os
+import sys
+from contextlib import contextmanager
+from itertools import islice
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from sqlalchemy import text
+from sqlalchemy.schema import AddConstraint
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from app import db, timeline
+from models import Message, User, USERNAME_TRGM_INDEX
+from search import PG_SEARCH_INDEX
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+LOAD_ORDER = ['users', 'messages', 'follows', 'likes']
+BATCH_SIZE = 10000
 
-db.session.commit()
+# Indexes created with raw DDL rather than declared on the models
+POSTGRES_INDEXES = {
+    'ix_users_username_trgm': USERNAME_TRGM_INDEX,
+    'ix_messages_search_vector': PG_SEARCH_INDEX,
+}
+
+
+def copy_csv(conn, table, path):
+    """Load a CSV file into `table` with Postgres COPY."""
+
+    with open(path, newline='') as rows:
+        columns = next(csv.reader([rows.readline()]))
+        with conn.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                rows)
+
+
+def insert_csv(conn, table, path):
+    """Load a CSV file into `table` in batches of executemany INSERTs."""
+
+    with open(path, newline='') as rows:
+        reader = csv.DictReader(rows)
+        columns = reader.fieldnames
+        insert = text(f"INSERT INTO {table} ({', '.join(columns)}) "
+                      f"VALUES ({', '.join(':' + col for col in columns)})")
+        while True:
+            batch = [{col: value or None for col, value in row.items()}
+                     for row in islice(reader, BATCH_SIZE)]
+            if not batch:
+                break
+            conn.execute(insert, batch)
+
+
+@contextmanager
+def deferred_constraints(conn):
+    """Drop foreign keys and secondary indexes, then rebuild them after the block."""
+
+    postgres = conn.dialect.name == 'postgresql'
+    tables = db.metadata.sorted_tables
+    indexes = [index for table in tables for index in table.indexes]
+    foreign_keys = [fk for table in tables for fk in table.foreign_key_constraints]
+
+    if postgres:
+        existing = conn.execute(text(
+            "SELECT conrelid::regclass, conname FROM pg_constraint WHERE contype = 'f'"))
+        for table, name in existing.fetchall():
+            conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+        for name in POSTGRES_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    for index in indexes:
+        index.drop(conn)
+
+    yield
+
+    for index in indexes:
+        index.create(conn)
+    if postgres:
+        for create in POSTGRES_INDEXES.values():
+            conn.execute(text(create))
+        for fk in foreign_keys:
+            conn.execute(AddConstraint(fk))
+
+
+def reset_sequences(conn):
+    """Point Postgres id sequences past the ids loaded from CSV."""
+
+    for table in ['users', 'messages']:
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE(MAX(id), 0) + 1, false) FROM {table}"))
+
+
+def seed(directory):
+    db.drop_all()
+    db.create_all()
+
+    with db.engine.begin() as conn:
+        postgres = conn.dialect.name == 'postgresql'
+        if conn.dialect.name == 'sqlite':
+            conn.execute(text("PRAGMA synchronous = OFF"))
+
+        with deferred_constraints(conn):
+            for table in LOAD_ORDER:
+                path = os.path.join(directory, f"{table}.csv")
+                if os.path.exists(path):
+                    (copy_csv if postgres else insert_csv)(conn, table, path)
+                    print(f"Loaded {path}")
+
+        if postgres:
+            reset_sequences(conn)
+
+    User.reconcile_counts()
+    Message.reconcile_counts()
+    timeline.backfill()
+
+    db.session.commit()
+
+
+if __name__ == '__main__':
+    seed(sys.argv[1] if len(sys.argv) > 1 else 'generator')
@@ -1,6 +1,8 @@
 const newMsgForm = document.getElementById("newMsgForm");
 const messages = document.getElementById("messages");
 const userId = document.getElementById("profileLink").dataset.id;
+// New messages are always ours, so reuse the resized avatar in the nav bar
+const userThumb = document.querySelector("#profileLink img").src;
 
 newMsgForm.addEventListener("submit", (e) => {
   e.preventDefault();
@@ -14,19 +16,35 @@ newMsgForm.addEventListener("submit", (e) => {
   $("#newMsgModal").modal("hide");
 });
 
-function generateMsg(msg) {
+function escapeHtml(text) {
+  const div = document.createElement("div");
+  div.textContent = text;
+  // Serialized text escapes <, > and & but not quotes, which attributes need
+  return div.innerHTML.replace(/"/g, "&quot;").replace(/'/g, "&#39;");
+}
+
+function generateMsg(msg, thumb = userThumb) {
+  const likes = String(msg.user_id) === userId
+    ? `<span class="text-muted"><i class="fa fa-thumbs-up"></i> ${msg.likes_count}</span>`
+    : `<button data-id="${msg.id}" class="btn btn-sm btn-secondary">
+        <i class="fa fa-thumbs-up"></i>
+        <span class="like-count">${msg.likes_count}</span>
+      </button>`;
   return `
     <li class="list-group-item">
     <a href="/messages/${msg.id}" class="message-link" />
     <a href="/users/${msg.user.id}">
-      <img src="${msg.user.image_url}" alt="" class="timeline-image" />
+      <img src="${escapeHtml(thumb)}" alt="" class="timeline-image" />
     </a>
     <div class="message-area">
-      <a href="/users/${msg.user.id}">@${msg.user.username}</a>
+      <a href="/users/${msg.user.id}">@${escapeHtml(msg.user.username)}</a>
       <span class="text-muted"
-        >${msg.timestamp}</span
+        >${escapeHtml(msg.timestamp)}</span
       >
-      <p class="mt-2">${msg.text}</p>
+      <p class="mt-2">${escapeHtml(msg.text)}</p>
+    </div>
+    <div class="messages-form">
+      ${likes}
     </div>
   </li>
     `;
@@ -38,7 +56,6 @@ async function addMsg() {
   const newMsgRes = await axios.post("/api/messages", { text });
   let newMsg = newMsgRes.data.message;
   if (window.location.pathname === "/" || window.location.pathname === `/users/${userId}`) {
-    generateMsg(newMsg);
     $("#messages").prepend(generateMsg(newMsg));
     let msgCount = document.getElementById("msgCount");
     msgCount.innerText = parseInt(msgCount.innerHTML) + 1;
@@ -54,15 +71,24 @@ $("#newMsgModal").on("hidden.bs.modal", () => {
 });
 
 messages.addEventListener("click", async (e) => {
-  if (e.target.tagName === "BUTTON") {
-    let msg_id = e.target.dataset.id
+  let button = e.target.closest("button");
+  if (button) {
+    let msg_id = button.dataset.id
     const likeRes = await axios.post("/api/messages/like", { msg_id });
-    e.target.classList.toggle("btn-primary")
-    e.target.classList.toggle("btn-secondary")
+    button.classList.toggle("btn-primary")
+    button.classList.toggle("btn-secondary")
     handleLikeRes(likeRes.data.message)
+    updateMsgLikeCount(button, likeRes.data.message)
   }
 })
 
+function updateMsgLikeCount(button, res) {
+  let count = button.querySelector(".like-count");
+  if (count) {
+    count.innerText = parseInt(count.innerText) + (res === "liked" ? 1 : -1);
+  }
+}
+
 function handleLikeRes(res) {
   let likeCount = document.getElementById("likeCount");
   if (window.location.pathname === "/" || window.location.pathname === `/users/${userId}/likes`) {
@@ -72,4 +98,15 @@ function handleLikeRes(res) {
       likeCount.innerText = parseInt(likeCount.innerHTML) - 1;
     }
   }
-}
\ No newline at end of file
+}
+
+// The first page of the home feed has new warbles from followed users
+// pushed to it; the browser reconnects (resuming from the last message
+// it got) whenever the stream ends.
+if (messages && messages.dataset.streamAfter !== undefined) {
+  const stream = new EventSource(`/api/stream?after=${messages.dataset.streamAfter}`);
+  stream.addEventListener("message", (e) => {
+    const msg = JSON.parse(e.data);
+    $("#messages").prepend(generateMsg(msg, msg.user.image_url));
+  });
+}
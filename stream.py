@@ -0,0 +1,375 @@
+"""Live feed updates over Server-Sent Events.
+
+Views that post messages call `pubsub.publish(message_id, author_id)`
+before committing. The event only goes out if the transaction commits:
+
+- `LocalPubSub` keeps events on the session and hands them to this
+  process's subscribers after commit. That's enough for one process, and
+  for development and tests.
+- `PostgresPubSub` sends them with pg_notify inside the transaction, so
+  Postgres delivers them on commit. Every process LISTENs on the channel
+  and passes what it hears on to its own subscribers.
+
+Each open /api/stream holds a `Subscription` and sends the logged-in
+user the new messages of people they follow. Event ids are message ids;
+a reconnecting client sends the last one it saw (Last-Event-ID), and
+anything newer from the people it follows is sent first. Subscribers
+that fall behind are dropped rather than buffered without limit; their
+stream ends and the browser reconnects and catches up the same way.
+
+Under WSGI each stream ties up a worker thread, so run the app with
+threaded workers (or gevent) when streams are in use. Under ASGI
+(asgi.py) streams are served by `async_message_stream`, which waits on
+the event loop and holds no thread.
+"""
+
+import asyncio
+import json
+import logging
+import select
+import time
+from collections import namedtuple
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session, joinedload
+
+from models import db, Follows, Message
+
+logger = logging.getLogger(__name__)
+
+PENDING_EVENTS = 'pending_message_events'
+
+MessageEvent = namedtuple('MessageEvent', ['message_id', 'author_id'])
+
+
+class Subscription:
+    """A subscriber's queue of events, holding at most `maxsize`."""
+
+    def __init__(self, pubsub, maxsize=1000):
+        self.pubsub = pubsub
+        self.queue = Queue(maxsize)
+        self.overflowed = False
+        # (loop, asyncio.Event) to wake up `get_async`, once it's been called
+        self._wakeup = None
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.overflowed = True
+        if self._wakeup is not None:
+            loop, wakeup = self._wakeup
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                # The loop has closed; nobody is waiting
+                pass
+
+    def _drain(self):
+        events = []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except Empty:
+                return events
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for events; returns all that are queued."""
+
+        try:
+            events = [self.queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        return events + self._drain()
+
+    async def get_async(self, timeout):
+        """`get`, waiting on the running event loop instead of a thread."""
+
+        if self._wakeup is None:
+            self._wakeup = (asyncio.get_running_loop(), asyncio.Event())
+        wakeup = self._wakeup[1]
+        wakeup.clear()
+        events = self._drain()
+        if not events:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+            events = self._drain()
+        return events
+
+    def close(self):
+        self.pubsub.unsubscribe(self)
+
+
+class LocalPubSub:
+    """In-process pub/sub of new message events, delivered on commit."""
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._subscriptions = set()
+        self._lock = Lock()
+
+    def publish(self, message_id, author_id, session=None):
+        """Announce a new message once the current transaction commits.
+
+        Call once the message has been flushed (so it has an id). The
+        transaction is `session`'s, by default `db.session`.
+        """
+
+        session = db.session if session is None else session
+        session.info.setdefault(PENDING_EVENTS, []).append(
+            MessageEvent(message_id, author_id))
+
+    def subscribe(self):
+        subscription = Subscription(self, self.queue_size)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def deliver(self, events):
+        """Hand `events` to every subscriber in this process."""
+
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            for event in events:
+                subscription.put(event)
+
+    def drop_subscribers(self):
+        """End every stream, e.g. after events may have been missed."""
+
+        with self._lock:
+            for subscription in self._subscriptions:
+                subscription.overflowed = True
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+
+class PostgresPubSub(LocalPubSub):
+    """Pub/sub over Postgres LISTEN/NOTIFY, shared by every app process.
+
+    The listener thread (with its own connection) starts with the first
+    subscriber.
+    """
+
+    def __init__(self, engine, channel='warbler_messages', queue_size=1000):
+        super().__init__(queue_size)
+        self.engine = engine
+        self.channel = channel
+        self._listener = None
+
+    def publish(self, message_id, author_id, session=None):
+        session = db.session if session is None else session
+        session.execute(db.select(func.pg_notify(self.channel,
+                                                 f"{message_id}:{author_id}")))
+
+    def subscribe(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = Thread(target=self._listen, daemon=True,
+                                        name='pubsub-listener')
+                self._listener.start()
+        return super().subscribe()
+
+    def _listen(self):
+        while True:
+            try:
+                connection = self.engine.raw_connection()
+                connection.detach()
+                dbapi_connection = connection.connection
+                # Detached, so the pool won't close it: we must
+                try:
+                    dbapi_connection.autocommit = True
+                    dbapi_connection.cursor().execute(f'LISTEN "{self.channel}"')
+
+                    while True:
+                        if select.select([dbapi_connection], [], [], 5) == ([], [], []):
+                            continue
+                        dbapi_connection.poll()
+                        events = []
+                        while dbapi_connection.notifies:
+                            payload = dbapi_connection.notifies.pop(0).payload
+                            message_id, author_id = map(int, payload.split(':'))
+                            events.append(MessageEvent(message_id, author_id))
+                        self.deliver(events)
+                finally:
+                    dbapi_connection.close()
+
+            except Exception:
+                logger.exception("pubsub listener lost its connection; reconnecting")
+                # Anything sent while we were away is lost; make clients
+                # reconnect and catch up from their last event.
+                self.drop_subscribers()
+                time.sleep(1)
+
+
+def sse(data, id=None, event=None):
+    """Format one Server-Sent Event."""
+
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in data.splitlines())
+    return '\n'.join(lines) + '\n\n'
+
+
+def followed_ids_query(user_id):
+    return (db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id))
+
+
+def followed_ids(user_id):
+    return set(db.session.scalars(followed_ids_query(user_id)))
+
+
+def missed_query(user_id, after, backlog):
+    """Up to `backlog` messages from people `user_id` follows, newer than `after`."""
+
+    return (db.select(Message)
+            .options(joinedload(Message.user, innerjoin=True))
+            .join(Follows, Follows.user_being_followed_id == Message.user_id)
+            .where(Follows.user_following_id == user_id, Message.id > after)
+            .order_by(Message.id)
+            .limit(backlog))
+
+
+def new_ids(events, following, sent):
+    """Ids of the messages in `events` that a stream should send."""
+
+    return [event.message_id for event in events
+            if event.author_id in following and event.message_id not in sent]
+
+
+def message_stream(pubsub, user_id, serialize, after=None, keepalive=15,
+                   max_seconds=300, backlog=100):
+    """Yield SSE chunks of new messages from the people `user_id` follows.
+
+    Starts with up to `backlog` messages newer than message id `after`,
+    then sends messages as they're published, with a comment every
+    `keepalive` seconds. Ends after `max_seconds` (the browser reconnects)
+    or if the subscriber falls behind. `serialize(message)` builds each
+    event's JSON data.
+    """
+
+    # Subscribe before catching up, so nothing posted in between is lost
+    subscription = pubsub.subscribe()
+    try:
+        yield "retry: 3000\n\n"
+
+        following = followed_ids(user_id)
+        sent = set()
+        if after is not None and following:
+            for message in db.session.scalars(missed_query(user_id, after, backlog)):
+                sent.add(message.id)
+                yield sse(json.dumps(serialize(message)), id=message.id, event='message')
+        # Don't hold a connection (or transaction) open while we wait
+        db.session.close()
+
+        deadline = time.monotonic() + max_seconds
+        while time.monotonic() < deadline and not subscription.overflowed:
+            events = subscription.get(timeout=min(keepalive, max(0, deadline - time.monotonic())))
+            if not events:
+                # Quiet period: pick up follows/unfollows made meanwhile
+                following = followed_ids(user_id)
+                db.session.close()
+                yield ": keepalive\n\n"
+                continue
+
+            ids = new_ids(events, following, sent)
+            if not ids:
+                continue
+            for message in (Message.query
+                            .options(joinedload(Message.user, innerjoin=True))
+                            .filter(Message.id.in_(ids))
+                            .order_by(Message.id)):
+                yield sse(json.dumps(serialize(message)), id=message.id, event='message')
+            db.session.close()
+    finally:
+        subscription.close()
+
+
+async def async_message_stream(pubsub, Session, user_id, serialize, after=None,
+                               keepalive=15, max_seconds=300, backlog=100):
+    """`message_stream` for asyncio, querying through async sessions from `Session`."""
+
+    subscription = pubsub.subscribe()
+    try:
+        yield "retry: 3000\n\n"
+
+        async with Session() as session:
+            following = set(await session.scalars(followed_ids_query(user_id)))
+            missed = []
+            if after is not None and following:
+                missed = (await session.scalars(missed_query(user_id, after, backlog))).all()
+        sent = set()
+        for message in missed:
+            sent.add(message.id)
+            yield sse(json.dumps(serialize(message)), id=message.id, event='message')
+
+        deadline = time.monotonic() + max_seconds
+        while time.monotonic() < deadline and not subscription.overflowed:
+            events = await subscription.get_async(
+                timeout=min(keepalive, max(0, deadline - time.monotonic())))
+            if not events:
+                async with Session() as session:
+                    following = set(await session.scalars(followed_ids_query(user_id)))
+                yield ": keepalive\n\n"
+                continue
+
+            ids = new_ids(events, following, sent)
+            if not ids:
+                continue
+            async with Session() as session:
+                messages = (await session.scalars(db.select(Message)
+                                                     .options(joinedload(Message.user,
+                                                                         innerjoin=True))
+                                                     .where(Message.id.in_(ids))
+                                                     .order_by(Message.id))).all()
+            for message in messages:
+                yield sse(json.dumps(serialize(message)), id=message.id, event='message')
+    finally:
+        subscription.close()
+
+
+def connect_pubsub(app, pubsub=None):
+    """Set up message pub/sub for `app` and return it.
+
+    Uses LISTEN/NOTIFY when the database is Postgres (unless PUBSUB_BACKEND
+    is 'local'); pass `pubsub` to use something else.
+    """
+
+    if pubsub is None:
+        backend = app.config.get('PUBSUB_BACKEND') or (
+            'postgres' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres')
+            else 'local')
+        queue_size = app.config.get('PUBSUB_QUEUE_SIZE', 1000)
+        if backend == 'postgres':
+            with app.app_context():
+                pubsub = PostgresPubSub(db.engine, queue_size=queue_size)
+        else:
+            pubsub = LocalPubSub(queue_size=queue_size)
+
+    def deliver_pending(session):
+        events = session.info.pop(PENDING_EVENTS, None)
+        if events:
+            pubsub.deliver(events)
+
+    def discard_pending(session, previous_transaction):
+        session.info.pop(PENDING_EVENTS, None)
+
+    event.listen(Session, 'after_commit', deliver_pending)
+    event.listen(Session, 'after_soft_rollback', discard_pending)
+
+    app.extensions['pubsub'] = pubsub
+    return pubsub
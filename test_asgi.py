@@ -0,0 +1,219 @@
+"""Async API tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_asgi.py
+
+
+import os
+import threading
+import time
+from datetime import datetime
+from unittest import TestCase
+
+from starlette.testclient import TestClient
+
+from models import db, User, Message, Likes, TimelineEntry
+from replicas import PRIMARY_UNTIL
+from test_stream import parse_events
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, timeline, CURR_USER_KEY
+from asgi import app as asgi_app
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class AsyncAPITestCase(TestCase):
+    """Test that the async API answers as the Flask views do."""
+
+    def setUp(self):
+        """Create test clients, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.testuser = User.signup("testuser", "test@test.com", "testuser", None)
+        self.u1 = User.signup("abc", "test1@test.com", "password", None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+        self.u1_id = self.u1.id
+
+        self.testuser.following.append(self.u1)
+        self.testuser.adjust_counts(following_count=1)
+        db.session.commit()
+        for day, text in enumerate(("one", "two", "three"), start=1):
+            msg = Message(text=text, user_id=self.u1_id, timestamp=datetime(2022, 1, day))
+            db.session.add(msg)
+            timeline.add_message(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+        cookie_name = app.config['SESSION_COOKIE_NAME']
+        cookie = app.session_interface.get_signing_serializer(app).dumps(
+            {CURR_USER_KEY: self.testuser_id})
+
+        self.flask = app.test_client()
+        self.flask.set_cookie('localhost', cookie_name, cookie)
+        self.client = TestClient(asgi_app)
+        self.client.__enter__()
+        self.client.cookies.set(cookie_name, cookie)
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        db.session.remove()
+        app.config['STREAM_KEEPALIVE'] = 15
+        app.config['STREAM_MAX_SECONDS'] = 300
+        app.config['DATABASE_REPLICAS'] = []
+
+    def session_cookie(self, resp):
+        """The Flask session set by `resp`, or None."""
+
+        cookie = resp.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if cookie is None:
+            return None
+        return app.session_interface.get_signing_serializer(app).loads(cookie)
+
+    def assertSameJSON(self, path):
+        """Does `path` give the same JSON from the async API and from Flask?"""
+
+        resp = self.client.get(path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), self.flask.get(path).json)
+        return resp.json()
+
+    def test_feed(self):
+        """Are feed pages and cursors the same as Flask's?"""
+
+        page = self.assertSameJSON("/api/messages?limit=2")
+        self.assertEqual([m["text"] for m in page["messages"]], ["three", "two"])
+
+        page = self.assertSameJSON(f"/api/messages?limit=2&before={page['next']}")
+        self.assertEqual([m["text"] for m in page["messages"]], ["one"])
+        self.assertIsNone(page["next"])
+
+        self.assertSameJSON(f"/api/messages?user_id={self.u1_id}&limit=1")
+        self.assertEqual(self.client.get("/api/messages?before=nope").status_code, 400)
+
+    def test_read_apis(self):
+        """Are messages, likers and profiles the same as Flask's?"""
+
+        self.assertSameJSON(f"/api/messages/{self.msg_id}")
+        self.assertSameJSON(f"/api/messages/{self.msg_id}/likes")
+        user = self.assertSameJSON(f"/api/users/{self.u1_id}")
+        self.assertEqual(user["user"]["messages_count"], 0)
+        self.assertEqual(user["user"]["followers_count"], 0)
+
+        resp = self.client.get("/api/users/9999")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json()["error"], "Not Found")
+
+    def test_like(self):
+        """Does liking toggle, keep counts in step and refuse bad requests?"""
+
+        resp = self.client.post("/api/messages/like", json={"msg_id": self.msg_id})
+        self.assertEqual(resp.json(), {"message": "liked"})
+        self.assertEqual(Likes.query.filter_by(user_id=self.testuser_id).one().message_id,
+                         self.msg_id)
+        self.assertEqual(User.query.get(self.testuser_id).likes_count, 1)
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 1)
+
+        resp = self.client.post("/api/messages/like", json={"msg_id": self.msg_id})
+        self.assertEqual(resp.json(), {"message": "unliked"})
+        db.session.expire_all()
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(User.query.get(self.testuser_id).likes_count, 0)
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 0)
+
+        own = Message(text="mine", user_id=self.testuser_id)
+        db.session.add(own)
+        db.session.commit()
+        self.assertEqual(self.client.post("/api/messages/like",
+                                          json={"msg_id": own.id}).status_code, 403)
+        self.assertEqual(self.client.post("/api/messages/like",
+                                          json={"msg_id": 9999}).status_code, 404)
+        self.assertEqual(self.client.post("/api/messages/like",
+                                          json={"msg_id": "x"}).status_code, 400)
+
+        self.client.cookies.clear()
+        self.assertEqual(self.client.post("/api/messages/like",
+                                          json={"msg_id": self.msg_id}).status_code, 401)
+
+    def test_add_message(self):
+        """Does posting count, deliver and announce the message?"""
+
+        subscription = app.extensions['pubsub'].subscribe()
+        try:
+            resp = self.client.post("/api/messages", json={"text": "async warble"})
+            self.assertEqual(resp.status_code, 201)
+            message = resp.json()["message"]
+            self.assertEqual(message["text"], "async warble")
+            self.assertEqual(message["user"]["username"], "testuser")
+            self.assertEqual(subscription.get(timeout=1),
+                             [(message["id"], self.testuser_id)])
+        finally:
+            subscription.close()
+
+        self.assertEqual(User.query.get(self.testuser_id).messages_count, 1)
+        self.assertEqual(TimelineEntry.query.filter_by(message_id=message["id"]).count(), 1)
+        self.assertIsNone(self.session_cookie(resp))
+
+        for body in ({}, {"text": " "}, {"text": "x" * 141}, ["x"]):
+            self.assertEqual(self.client.post("/api/messages", json=body).status_code, 400)
+
+    def test_writes_stick_to_primary(self):
+        """With replicas, do writes keep the user on the primary, as in Flask?"""
+
+        app.config['DATABASE_REPLICAS'] = ['replica0']
+        resp = self.client.post("/api/messages/like", json={"msg_id": self.msg_id})
+        session = self.session_cookie(resp)
+        self.assertEqual(session[CURR_USER_KEY], self.testuser_id)
+        self.assertGreater(session[PRIMARY_UNTIL], time.time())
+
+    def test_stream(self):
+        """Does the async stream catch up, then push new messages?"""
+
+        app.config['STREAM_KEEPALIVE'] = 0.05
+        app.config['STREAM_MAX_SECONDS'] = 0
+        resp = self.client.get(f"/api/stream?after={self.msg_id - 1}")
+        self.assertEqual(resp.headers["content-type"], "text/event-stream; charset=utf-8")
+        events = parse_events([resp.text])
+        self.assertEqual([data["text"] for id, data in events], ["three"])
+        self.assertTrue(events[0][1]["user"]["image_url"].startswith("/img/timeline/"))
+
+        app.config['STREAM_MAX_SECONDS'] = 5
+
+        def post_later():
+            time.sleep(0.2)
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+                client.post("/api/messages/batch", json={"messages": [{"text": "live"}]})
+
+        chunks = []
+        poster = threading.Thread(target=post_later)
+        poster.start()
+        try:
+            with self.client.stream("GET", "/api/stream") as resp:
+                for chunk in resp.iter_text():
+                    chunks.append(chunk)
+                    if parse_events(chunks):
+                        break
+        finally:
+            poster.join()
+        self.assertEqual([data["text"] for id, data in parse_events(chunks)], ["live"])
+
+    def test_other_requests_reach_flask(self):
+        """Are other paths and methods served by the Flask app?"""
+
+        resp = self.client.post("/api/messages/batch",
+                                json={"messages": [{"text": "via flask"}]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["results"][0]["status"], "created")
+
+        resp = self.client.get(f"/users/{self.u1_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@abc", resp.text)
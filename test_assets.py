@@ -0,0 +1,74 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+from unittest import TestCase
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from assets import DIST_DIR, build_assets
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        self.dist_dir = os.path.join(app.static_folder, DIST_DIR)
+        self.manifest = app.extensions['assets']
+        self.manifest.update(build_assets(app.static_folder))
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.manifest.clear()
+        shutil.rmtree(self.dist_dir)
+
+    def test_build(self):
+        """Are files renamed by content hash, and CSS links rewritten?"""
+        css = self.manifest["stylesheets/style.css"]
+        self.assertRegex(css, r"^stylesheets/style\.[0-9a-f]{12}\.css$")
+        self.assertTrue(os.path.exists(os.path.join(self.dist_dir, css + ".gz")))
+        self.assertFalse(os.path.exists(os.path.join(
+            self.dist_dir, self.manifest["images/warbler-hero.jpg"] + ".gz")))
+
+        with open(os.path.join(self.dist_dir, css)) as f:
+            stylesheet = f.read()
+        self.assertNotIn("/static/images/", stylesheet)
+        self.assertIn(f"/assets/{self.manifest['images/nav-bg.png']}", stylesheet)
+
+    def test_templates_use_fingerprinted_urls(self):
+        """Do pages link to the built assets?"""
+        resp = self.client.get("/")
+        self.assertIn(f'/assets/{self.manifest["app.js"]}', str(resp.data))
+
+    def test_serves_precompressed(self):
+        """Is the gzip variant served to browsers that accept it?"""
+        url = f"/assets/{self.manifest['app.js']}"
+        resp = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("javascript", resp.content_type)
+        self.assertTrue(resp.cache_control.immutable)
+        with open(os.path.join(app.static_folder, "app.js"), "rb") as f:
+            self.assertEqual(gzip.decompress(resp.data), f.read())
+
+        resp = self.client.get(url)
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_missing_asset_not_cached(self):
+        """Is a 404 for an unknown asset kept out of caches?"""
+        resp = self.client.get("/assets/app.000000000000.js")
+        self.assertEqual(resp.status_code, 404)
+        self.assertFalse(resp.cache_control.immutable)
+        self.assertTrue(resp.cache_control.no_store)
+        self.assertIsNone(resp.cache_control.max_age)
@@ -0,0 +1,126 @@
+"""Batch write API tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_batch.py
+
+
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, timeline, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BatchAPITestCase(TestCase):
+    """Test posting, following and liking in batches."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.u1 = User.signup("abc", "test1@test.com", "password", None)
+        self.u2 = User.signup("efg", "test2@test.com", "password", None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+    def test_post_messages(self):
+        """Are valid messages posted together, and bad ones reported per item?"""
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post("/api/messages/batch", json={"messages": [
+                {"text": "one"}, {"text": " "}, {"text": "x" * 141}, "three", {"text": "two"}]})
+        self.assertEqual(resp.status_code, 200)
+        results = resp.json["results"]
+
+        self.assertEqual([r["status"] for r in results],
+                         ["created", "error", "error", "error", "created"])
+        self.assertEqual(results[0]["message"]["text"], "one")
+        self.assertEqual(results[0]["message"]["user"]["id"], self.testuser_id)
+        self.assertIn("140", results[2]["error"])
+
+        self.assertEqual(User.query.get(self.testuser_id).messages_count, 2)
+        self.assertEqual({m.text for m in timeline.home_messages(self.u1_id)}, {"one", "two"})
+
+    def test_follow_users(self):
+        """Are follows, counts and timelines written for every valid id?"""
+        db.session.add(Message(text="from u1", user_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post("/api/follows/batch", json={"user_ids": [
+                self.u1_id, self.testuser_id, 9999, "abc", self.u2_id, self.u1_id]})
+        results = resp.json["results"]
+
+        self.assertEqual([r["status"] for r in results],
+                         ["followed", "error", "error", "error", "followed", "error"])
+        self.assertEqual(results[3]["error"], "not a user id")
+
+        testuser = User.query.get(self.testuser_id)
+        self.assertEqual(testuser.following_count, 2)
+        self.assertEqual(User.query.get(self.u1_id).followers_count, 1)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+        self.assertEqual(Follows.query.filter_by(user_following_id=self.testuser_id).count(), 2)
+        self.assertEqual([m.text for m in timeline.home_messages(self.testuser_id)], ["from u1"])
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post("/api/follows/batch", json={"user_ids": [self.u1_id]})
+        self.assertEqual(resp.json["results"][0]["status"], "already following")
+
+    def test_toggle_likes(self):
+        """Are likes toggled together, with counts kept in step?"""
+        m1 = Message(text="m1", user_id=self.u1_id)
+        m2 = Message(text="m2", user_id=self.u2_id)
+        own = Message(text="own", user_id=self.testuser_id)
+        db.session.add_all([m1, m2, own])
+        db.session.commit()
+        m1_id, m2_id, own_id = m1.id, m2.id, own.id
+
+        self.testuser.toggle_like(m1_id)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post("/api/likes/batch", json={"message_ids": [m1_id, m2_id, own_id, 9999]})
+        self.assertEqual([r["status"] for r in resp.json["results"]],
+                         ["unliked", "liked", "error", "error"])
+
+        self.assertEqual(Likes.query.filter_by(user_id=self.testuser_id).one().message_id, m2_id)
+        self.assertEqual(User.query.get(self.testuser_id).likes_count, 1)
+        self.assertEqual(Message.query.get(m1_id).likes_count, 0)
+        self.assertEqual(Message.query.get(m2_id).likes_count, 1)
+
+    def test_rejects_bad_batches(self):
+        """Are empty, non-list and oversized batches a 400?"""
+        with self.client as c:
+            self.login(c)
+            self.assertEqual(c.post("/api/likes/batch", json={"message_ids": []}).status_code, 400)
+            self.assertEqual(c.post("/api/likes/batch", json={"message_ids": 1}).status_code, 400)
+            too_many = list(range(app.config['BATCH_MAX_ITEMS'] + 1))
+            self.assertEqual(c.post("/api/follows/batch", json={"user_ids": too_many}).status_code, 400)
@@ -0,0 +1,89 @@
+"""User export tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_export.py
+
+
+import json
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExportTestCase(TestCase):
+    """Test streaming a user's data as NDJSON."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.other = User.signup(username="other",
+                                 email="other@test.com",
+                                 password="password",
+                                 image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+        self.other_id = self.other.id
+
+        for i in range(5):
+            db.session.add(Message(text=f"warble {i}", user_id=self.testuser_id))
+        other_msg = Message(text="liked", user_id=self.other_id)
+        db.session.add(other_msg)
+        db.session.add(Follows(user_being_followed_id=self.other_id,
+                               user_following_id=self.testuser_id))
+        db.session.commit()
+        self.other_msg_id = other_msg.id
+
+        self.testuser.toggle_like(self.other_msg_id)
+        db.session.commit()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_export(self):
+        """Does the export stream the user's profile, messages, follows and likes?"""
+        app.config['EXPORT_BATCH_SIZE'] = 2
+        try:
+            with self.client as c:
+                self.login(c, self.testuser_id)
+                resp = c.get(f"/api/users/{self.testuser_id}/export")
+                self.assertTrue(resp.is_streamed)
+                self.assertEqual(resp.mimetype, "application/x-ndjson")
+                records = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        finally:
+            app.config['EXPORT_BATCH_SIZE'] = 1000
+
+        self.assertEqual(records[0]["type"], "user")
+        self.assertEqual(records[0]["username"], "testuser")
+        self.assertNotIn("password", records[0])
+
+        messages = [r for r in records if r["type"] == "message"]
+        self.assertEqual([m["text"] for m in messages], [f"warble {i}" for i in range(5)])
+        self.assertIn({"type": "following", "user_id": self.other_id}, records)
+        self.assertIn({"type": "like", "message_id": self.other_msg_id}, records)
+        self.assertEqual([r for r in records if r["type"] == "follower"], [])
+
+    def test_export_other_user(self):
+        """Are users kept from exporting someone else's data?"""
+        with self.client as c:
+            self.login(c, self.other_id)
+            resp = c.get(f"/api/users/{self.testuser_id}/export")
+        self.assertEqual(resp.status_code, 403)
@@ -0,0 +1,102 @@
+"""Message fragment cache tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_fragments.py
+
+
+import os
+from unittest import TestCase
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, fragments, CURR_USER_KEY
+from fragments import LRUFragmentStore
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LRUFragmentStoreTestCase(TestCase):
+    """Test the in-process fragment store."""
+
+    def test_get_set_delete(self):
+        store = LRUFragmentStore()
+        store.set_many({"a": "<p>a</p>", "b": "<p>b</p>"})
+        self.assertEqual(store.get_many(["a", "c"]), {"a": "<p>a</p>"})
+        store.delete("a")
+        self.assertEqual(store.get_many(["a"]), {})
+
+    def test_evicts_least_recently_used(self):
+        store = LRUFragmentStore(maxsize=2)
+        store.set_many({"a": "a", "b": "b"})
+        store.get_many(["a"])
+        store.set_many({"c": "c"})
+        self.assertEqual(set(store.get_many(["a", "b", "c"])), {"a", "c"})
+
+
+class MessageFragmentsTestCase(TestCase):
+    """Test rendering feeds from cached message fragments."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+        msg = Message(text="Cached warble", user_id=self.testuser_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def test_hits_and_misses(self):
+        """Is a message rendered once, then served from the cache?"""
+        before = fragments.stats()
+        with self.client as c:
+            c.get(f"/users/{self.testuser_id}")
+            resp = c.get(f"/users/{self.testuser_id}")
+        self.assertIn("Cached warble", str(resp.data))
+
+        after = fragments.stats()
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertEqual(after["hits"] - before["hits"], 1)
+
+    def test_profile_edit_invalidates(self):
+        """Does editing the profile re-render the author's messages?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.get(f"/users/{self.testuser_id}")
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser",
+                                           "image_url": "",
+                                           "header_image_url": "",
+                                           "bio": "",
+                                           "location": ""})
+            resp = c.get(f"/users/{self.testuser_id}")
+        self.assertIn(f'<a href="/users/{self.testuser_id}">@renamed</a>', str(resp.data))
+
+    def test_delete_forgets(self):
+        """Does deleting a message drop its cached fragment?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.get(f"/users/{self.testuser_id}")
+            msg = Message.query.get(self.msg_id)
+            key = fragments.key(msg)
+            self.assertTrue(fragments.store.get_many([key]))
+
+            c.post(f"/messages/{self.msg_id}/delete")
+        self.assertFalse(fragments.store.get_many([key]))
@@ -0,0 +1,98 @@
+"""HTTP caching policy tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_http_cache.py
+
+
+import os
+from unittest import TestCase
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HTTPCacheTestCase(TestCase):
+    """Test Cache-Control headers and conditional GETs."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.author = User.signup(username="author",
+                                  email="author@test.com",
+                                  password="password",
+                                  image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+        self.author_id = self.author.id
+
+        msg = Message(text="First", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def test_static_revalidates(self):
+        """Do plain static URLs revalidate with a 304?"""
+        resp = self.client.get("/static/stylesheets/style.css")
+        self.assertTrue(resp.cache_control.no_cache)
+        etag = resp.headers["ETag"]
+
+        resp = self.client.get("/static/stylesheets/style.css",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_profile_not_modified(self):
+        """Is an unchanged profile page answered with a 304?"""
+        resp = self.client.get(f"/users/{self.author_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.cache_control.no_cache)
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith("W/"))
+
+        resp = self.client.get(f"/users/{self.author_id}",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+
+        db.session.add(Message(text="Second", user_id=self.author_id))
+        db.session.commit()
+        resp = self.client.get(f"/users/{self.author_id}",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Second", str(resp.data))
+
+    def test_like_changes_etag(self):
+        """Does liking a message change the viewer's ETag, privately?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            resp = c.get(f"/users/{self.author_id}")
+            self.assertTrue(resp.cache_control.private)
+            etag = resp.headers["ETag"]
+
+            c.post("/api/messages/like", json={"msg_id": self.msg_id})
+            resp = c.get(f"/users/{self.author_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_message_not_modified(self):
+        """Is an unchanged message page answered with a 304?"""
+        etag = self.client.get(f"/messages/{self.msg_id}").headers["ETag"]
+        resp = self.client.get(f"/messages/{self.msg_id}",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
@@ -0,0 +1,227 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_images.py
+
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest import TestCase
+
+from PIL import Image
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import images as images_module
+from app import app, images
+from images import DiskImageCache, ImageError, fetch_source
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DiskImageCacheTestCase(TestCase):
+    """Test the on-disk store of resized images."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_content_addressed(self):
+        """Do identical images from different URLs share one file?"""
+        cache = DiskImageCache(self.directory)
+        first = cache.put("http://a/1.png", "avatar", b"same", "image/png")
+        second = cache.put("http://b/2.png", "avatar", b"same", "image/png")
+        self.assertEqual(first, second)
+        self.assertEqual(cache.get("http://b/2.png", "avatar"), (first, "image/png"))
+        self.assertIsNone(cache.get("http://b/2.png", "header"))
+
+    def test_evicts_least_recently_used(self):
+        """Are the least recently served images dropped past the size limit?"""
+        cache = DiskImageCache(self.directory, max_bytes=20)
+        cache.put("a", "avatar", b"a" * 10, "image/jpeg")
+        os.utime(cache.get("a", "avatar")[0], (1, 1))
+        cache.put("b", "avatar", b"b" * 10, "image/jpeg")
+        os.utime(cache.get("b", "avatar")[0], (2, 2))
+
+        cache.get("a", "avatar")
+        cache.put("c", "avatar", b"c" * 10, "image/jpeg")
+
+        self.assertIsNotNone(cache.get("a", "avatar"))
+        self.assertIsNone(cache.get("b", "avatar"))
+        self.assertIsNotNone(cache.get("c", "avatar"))
+        self.assertLessEqual(cache.size(), 20)
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    """Serves a tiny image, and a redirect to the cloud metadata address."""
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "http://169.254.169.254/latest/meta-data/")
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b"image")
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchSourceTestCase(TestCase):
+    """Test that sources are only fetched from public addresses."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SourceHandler)
+        self.server.paths = []
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_rejects_loopback(self):
+        """Are loopback URLs refused without connecting?"""
+        for host in ("127.0.0.1", "localhost"):
+            with self.assertRaises(ImageError):
+                fetch_source(f"http://{host}:{self.server.server_port}/image.png",
+                             app.static_folder, timeout=1)
+        self.assertEqual(self.server.paths, [])
+
+    def test_checks_redirects(self):
+        """Is a redirect from a public host to a private address refused?"""
+        original = images_module.is_public_address
+        # Let the local server stand in for a public host
+        images_module.is_public_address = lambda address: (
+            address.is_loopback or original(address))
+        try:
+            self.assertEqual(fetch_source(f"{self.base}/image.png", app.static_folder),
+                             b"image")
+            with self.assertRaisesRegex(ImageError, "169.254.169.254"):
+                fetch_source(f"{self.base}/redirect", app.static_folder, timeout=1)
+        finally:
+            images_module.is_public_address = original
+        self.assertEqual(self.server.paths, ["/image.png", "/redirect"])
+
+
+class ImageProxyTestCase(TestCase):
+    """Test serving resized images through /img."""
+
+    def setUp(self):
+        """Create test client and user, and an empty image cache."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+        self.directory = tempfile.mkdtemp()
+        self.original_cache = images.cache
+        images.cache = DiskImageCache(self.directory)
+
+    def tearDown(self):
+        images.cache = self.original_cache
+        shutil.rmtree(self.directory)
+
+    def image_urls(self, html):
+        return re.findall(r'src="(/img/[^"]+)"', html)
+
+    def test_profile_uses_resized_images(self):
+        """Does a profile page link to resized copies of the user's images?"""
+        resp = self.client.get(f"/users/{self.testuser_id}")
+        html = resp.get_data(as_text=True)
+        self.assertNotIn('src="/static/images/default-pic.png"', html)
+        self.assertIn("url(/img/header/", html)
+
+        avatar = self.image_urls(html)[0]
+        self.assertTrue(avatar.startswith("/img/avatar/"))
+
+        resp = self.client.get(avatar)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        self.assertTrue(resp.cache_control.public)
+        self.assertEqual(Image.open(BytesIO(resp.data)).size, (200, 200))
+
+    def test_header_is_smaller(self):
+        """Is the header served far smaller than the original?"""
+        html = self.client.get(f"/users/{self.testuser_id}").get_data(as_text=True)
+        header = re.search(r"url\((/img/header/[^)]+)\)", html).group(1)
+
+        resp = self.client.get(header)
+        self.assertEqual(resp.status_code, 200)
+        original = os.path.getsize(os.path.join(app.static_folder, "images", "warbler-hero.jpg"))
+        self.assertLess(len(resp.data), original / 4)
+        self.assertLessEqual(Image.open(BytesIO(resp.data)).size[0], 1200)
+
+    def test_fetches_once(self):
+        """Is the original fetched only on the first request?"""
+        fetched = []
+        original_fetch = images.fetch
+        images.fetch = lambda url: fetched.append(url) or original_fetch(url)
+        try:
+            with app.test_request_context():
+                url = images.url("/static/images/default-pic.png", "timeline")
+            self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertEqual(self.client.get(url).status_code, 200)
+        finally:
+            images.fetch = original_fetch
+        self.assertEqual(fetched, ["/static/images/default-pic.png"])
+
+    def test_rejects_bad_requests(self):
+        """Are unsigned keys, unknown sizes and unreadable sources a 404?"""
+        with app.test_request_context():
+            url = images.url("/static/images/default-pic.png", "avatar")
+            missing = images.url("/static/images/missing.png", "avatar")
+            local = images.url("file:///etc/passwd", "avatar")
+
+        self.assertEqual(self.client.get(url + "x").status_code, 404)
+        self.assertEqual(self.client.get(url.replace("/avatar/", "/huge/")).status_code, 404)
+        self.assertEqual(self.client.get(missing).status_code, 404)
+        self.assertEqual(self.client.get(local).status_code, 404)
+
+    def test_failures_cached_briefly(self):
+        """Is a failed source kept for a minute, and not fetched again meanwhile?"""
+        fetched = []
+
+        def fetch(url):
+            fetched.append(url)
+            raise ImageError("timed out")
+
+        original_fetch = images.fetch
+        images.fetch = fetch
+        try:
+            with app.test_request_context():
+                url = images.url("http://example.com/dead.png", "avatar")
+            for i in range(2):
+                resp = self.client.get(url)
+                self.assertEqual(resp.status_code, 404)
+                self.assertEqual(resp.cache_control.max_age, 60)
+        finally:
+            images.fetch = original_fetch
+        self.assertEqual(fetched, ["http://example.com/dead.png"])
+
+        resp = self.client.get(self.image_urls(
+            self.client.get(f"/users/{self.testuser_id}").get_data(as_text=True))[0])
+        self.assertEqual(resp.cache_control.max_age, 86400)
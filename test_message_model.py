@@ -74,4 +74,30 @@ class MessageModelTestCase(TestCase):
         db.session.commit()
         self.assertEqual(len(self.u2.likes), 1)
 
+    def test_toggle_like_counts(self):
+        """Does toggling a like keep the message's like count in step?"""
+        m = Message(text="Test Message", user_id=self.u1.id)
+        db.session.add(m)
+        db.session.commit()
+
+        self.assertTrue(self.u2.toggle_like(m.id))
+        db.session.commit()
+        self.assertEqual(m.likes_count, 1)
+
+        self.assertFalse(self.u2.toggle_like(m.id))
+        db.session.commit()
+        self.assertEqual(m.likes_count, 0)
+
+    def test_reconcile_counts(self):
+        """Does reconcile_counts repair drifted like counts?"""
+        m = Message(text="Test Message", user_id=self.u1.id)
+        self.u2.likes.append(m)
+        db.session.commit()
+        self.assertEqual(m.likes_count, 0)
+
+        self.assertEqual(Message.reconcile_counts(), 1)
+        db.session.commit()
+        self.assertEqual(m.likes_count, 1)
+        self.assertEqual(Message.reconcile_counts(), 0)
+
 
@@ -7,8 +7,9 @@
 
 import os
 from unittest import TestCase
+from datetime import datetime
 from werkzeug import exceptions
-from models import db, connect_db, Message, User
+from models import db, connect_db, Likes, Message, User
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +21,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, timeline, CURR_USER_KEY
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -117,6 +118,51 @@ class MessageViewTestCase(TestCase):
             likes_after = User.query.get(self.testuser.id).likes
             self.assertEqual(len(likes_after), 0)
 
+    def test_many_users_like_message(self):
+        """Can several users like the same message, and toggle it back?"""
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        m = Message(text="Test Message", user_id=author.id)
+        db.session.add(m)
+        db.session.commit()
+        msg_id = m.id
+        user_ids = [self.testuser.id, self.testuser2.id]
+        with self.client as c:
+            for user_id in user_ids:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                resp = c.post("/api/messages/like", json={"msg_id": msg_id})
+                self.assertEqual(resp.json["message"], "liked")
+
+            self.assertEqual(Likes.query.filter_by(message_id=msg_id).count(), 2)
+
+            resp = c.post("/api/messages/like", json={"msg_id": msg_id})
+            self.assertEqual(resp.json["message"], "unliked")
+            self.assertEqual(Likes.query.filter_by(message_id=msg_id).count(), 1)
+            self.assertEqual(User.query.get(user_ids[1]).likes_count, 0)
+
+    def test_message_counts(self):
+        """Do posting, liking and deleting keep the counters in step?"""
+        user_id = self.testuser.id
+        other_id = self.testuser2.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            c.post("/messages/new", data={"text": "Hello"})
+            msg_id = Message.query.one().id
+            self.assertEqual(User.query.get(other_id).messages_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post("/api/messages/like", json={"msg_id": msg_id})
+            self.assertEqual(User.query.get(user_id).likes_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertEqual(User.query.get(other_id).messages_count, 0)
+            self.assertEqual(User.query.get(user_id).likes_count, 0)
+
     def test_delete_message(self):
         """Can user delete a message?"""
         m = Message(text="Test Message", user_id=self.testuser.id)
@@ -174,3 +220,132 @@ class MessageViewTestCase(TestCase):
                 sess[CURR_USER_KEY] = self.testuser.id
             resp = c.get("/messages/404")
             self.assertEqual(resp.status_code, 404)
+
+    def test_messages_feed_api_pages(self):
+        """Does the feed API return pages linked by a `next` cursor?"""
+        for day in range(1, 4):
+            db.session.add(Message(text=f"Message {day}",
+                                   timestamp=datetime(2022, 1, day),
+                                   user_id=self.testuser2.id))
+        db.session.commit()
+        user_id = self.testuser2.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            resp = c.get(f"/api/messages?user_id={user_id}&limit=2")
+            self.assertEqual(resp.status_code, 200)
+            page = resp.json
+            self.assertEqual([m["text"] for m in page["messages"]],
+                             ["Message 3", "Message 2"])
+
+            resp = c.get(f"/api/messages?user_id={user_id}&limit=2&before={page['next']}")
+            page = resp.json
+            self.assertEqual([m["text"] for m in page["messages"]], ["Message 1"])
+            self.assertIsNone(page["next"])
+
+    def test_messages_feed_api_tied_timestamps(self):
+        """Do pages of messages posted in the same instant each come once?"""
+        user_id = self.testuser.id
+        messages = [Message(text=f"Message {i}", user_id=user_id) for i in range(3)]
+        db.session.add_all(messages)
+        for msg in messages:
+            timeline.add_message(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            for query in (f"user_id={user_id}&", ""):
+                texts = []
+                page = c.get(f"/api/messages?{query}limit=1").json
+                while page["next"] and len(texts) < 5:
+                    texts.extend(m["text"] for m in page["messages"])
+                    page = c.get(f"/api/messages?{query}limit=1&before={page['next']}").json
+                texts.extend(m["text"] for m in page["messages"])
+                self.assertEqual(texts, ["Message 2", "Message 1", "Message 0"])
+
+    def test_messages_feed_api_home(self):
+        """Does the feed API default to the user's home timeline?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.post("/api/messages", json={"text": "Hello API"})
+            resp = c.get("/api/messages")
+            self.assertEqual(resp.json["messages"][0]["text"], "Hello API")
+
+    def test_messages_feed_api_bad_cursor(self):
+        """Does a malformed cursor return 400?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            resp = c.get("/api/messages?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_search_page(self):
+        """Does the search page show matching messages only?"""
+        db.session.add(Message(text="Warbling about birds", user_id=self.testuser.id))
+        db.session.add(Message(text="Something else", user_id=self.testuser.id))
+        db.session.commit()
+        with self.client as c:
+            resp = c.get("/search?q=birds")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Warbling about birds", str(resp.data))
+            self.assertNotIn("Something else", str(resp.data))
+
+    def test_search_api_pages(self):
+        """Does the search API return ranked pages linked by a cursor?"""
+        db.session.add(Message(text="bird", user_id=self.testuser.id))
+        db.session.add(Message(text="bird bird bird and more", user_id=self.testuser.id))
+        db.session.commit()
+        with self.client as c:
+            page = c.get("/api/search?q=bird&limit=1").json
+            self.assertEqual(len(page["messages"]), 1)
+            second = c.get(f"/api/search?q=bird&limit=1&before={page['next']}").json
+            self.assertEqual(len(second["messages"]), 1)
+            self.assertNotEqual(page["messages"][0]["id"], second["messages"][0]["id"])
+            self.assertIsNone(second["next"])
+
+    def test_message_likes_api_pages(self):
+        """Does the likes API page through the users who like a message?"""
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        m = Message(text="Test Message", user_id=author.id)
+        db.session.add(m)
+        db.session.commit()
+        msg_id = m.id
+        user_ids = [self.testuser.id, self.testuser2.id]
+        for user_id in user_ids:
+            User.query.get(user_id).toggle_like(msg_id)
+        db.session.commit()
+
+        with self.client as c:
+            page = c.get(f"/api/messages/{msg_id}/likes?limit=1").json
+            self.assertEqual(page["likes_count"], 2)
+            self.assertEqual([u["id"] for u in page["users"]], user_ids[:1])
+
+            page = c.get(f"/api/messages/{msg_id}/likes?limit=1&after={page['next']}").json
+            self.assertEqual([u["id"] for u in page["users"]], user_ids[1:])
+            self.assertIsNone(page["next"])
+
+            resp = c.get(f"/api/messages/{msg_id}/likes/404")
+            self.assertEqual(resp.status_code, 404)
+            resp = c.get("/api/messages/404/likes")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_feed_shows_like_counts(self):
+        """Do feeds and serialized messages carry each message's like count?"""
+        m = Message(text="Test Message", user_id=self.testuser2.id)
+        db.session.add(m)
+        db.session.commit()
+        msg_id = m.id
+        user_id = self.testuser.id
+        author_id = self.testuser2.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post("/api/messages/like", json={"msg_id": msg_id})
+
+            page = c.get(f"/api/messages?user_id={author_id}").json
+            self.assertEqual(page["messages"][0]["likes_count"], 1)
+            resp = c.get(f"/users/{author_id}")
+            self.assertIn('<span class="like-count">1</span>', str(resp.data))
@@ -0,0 +1,101 @@
+"""Instrumentation and /metrics tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_metrics.py
+
+
+import os
+import re
+from unittest import TestCase
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from metrics import Registry
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def sample(text, name):
+    """The value of the sample line `name` (with its labels) in `text`, or None."""
+
+    match = re.search(rf"^{re.escape(name)} (\S+)$", text, re.MULTILINE)
+    return float(match.group(1)) if match else None
+
+
+class RegistryTestCase(TestCase):
+    """Test rendering metrics as Prometheus text."""
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram("latency_seconds", "Latency.", ["route"],
+                                       buckets=(0.1, 1))
+        histogram.observe(0.05, route="a")
+        histogram.observe(0.5, route="a")
+        text = registry.render()
+
+        self.assertIn("# TYPE latency_seconds histogram", text)
+        self.assertEqual(sample(text, 'latency_seconds_bucket{route="a",le="0.1"}'), 1)
+        self.assertEqual(sample(text, 'latency_seconds_bucket{route="a",le="1"}'), 2)
+        self.assertEqual(sample(text, 'latency_seconds_bucket{route="a",le="+Inf"}'), 2)
+        self.assertEqual(sample(text, 'latency_seconds_count{route="a"}'), 2)
+        self.assertAlmostEqual(sample(text, 'latency_seconds_sum{route="a"}'), 0.55)
+
+
+class MetricsEndpointTestCase(TestCase):
+    """Test the app's request instrumentation."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+    def tearDown(self):
+        app.config['METRICS_TOKEN'] = None
+        app.config['SLOW_REQUEST_MS'] = None
+
+    def metrics(self):
+        return self.client.get("/metrics").get_data(as_text=True)
+
+    def test_request_metrics(self):
+        """Are requests, their queries, templates and bcrypt recorded?"""
+        name = 'warbler_http_requests_total{endpoint="users_show",method="GET",status="200"}'
+        before = sample(self.metrics(), name) or 0
+        self.client.get(f"/users/{self.testuser_id}")
+        text = self.metrics()
+
+        self.assertEqual(sample(text, name), before + 1)
+        self.assertGreater(sample(text, 'warbler_db_queries_per_request_count{endpoint="users_show"}'), 0)
+        self.assertGreater(sample(text, 'warbler_db_queries_per_request_sum{endpoint="users_show"}'), 0)
+        self.assertGreater(sample(text, 'warbler_template_render_seconds_count{template="users/show.html"}'), 0)
+        self.assertGreater(sample(text, 'warbler_bcrypt_seconds_count{operation="hash"}'), 0)
+        self.assertIsNotNone(sample(text, 'warbler_fragment_cache_misses_total'))
+
+    def test_token(self):
+        """Does METRICS_TOKEN keep /metrics private?"""
+        app.config['METRICS_TOKEN'] = "s3cret"
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        resp = self.client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_slow_request_log(self):
+        """Are slow requests logged with their SQL?"""
+        app.config['SLOW_REQUEST_MS'] = 0
+        with self.assertLogs(app.logger, "WARNING") as logs:
+            self.client.get(f"/users/{self.testuser_id}")
+        self.assertIn("slow request: GET /users/", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
@@ -0,0 +1,163 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_migrations.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+from sqlalchemy import (Column, DateTime, ForeignKey, Integer, MetaData, String,
+                        Table, Text, inspect, text)
+from models import db, User, Message, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, timeline
+from migrations import MIGRATIONS, schema_migrations, upgrade
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def create_original_schema(conn):
+    """Create the tables as the first version of Warbler made them."""
+
+    metadata = MetaData()
+    users = Table('users', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('email', Text, nullable=False, unique=True),
+                  Column('username', Text, nullable=False, unique=True),
+                  Column('image_url', Text),
+                  Column('header_image_url', Text),
+                  Column('bio', Text),
+                  Column('location', Text),
+                  Column('password', Text, nullable=False))
+    follows = Table('follows', metadata,
+                    Column('user_being_followed_id', Integer,
+                           ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+                    Column('user_following_id', Integer,
+                           ForeignKey('users.id', ondelete='cascade'), primary_key=True))
+    messages = Table('messages', metadata,
+                     Column('id', Integer, primary_key=True),
+                     Column('text', String(140), nullable=False),
+                     Column('timestamp', DateTime, nullable=False),
+                     Column('user_id', Integer,
+                            ForeignKey('users.id', ondelete='CASCADE'), nullable=False))
+    likes = Table('likes', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade')),
+                  Column('message_id', Integer,
+                         ForeignKey('messages.id', ondelete='cascade'), unique=True))
+    metadata.create_all(conn)
+    return users, follows, messages, likes
+
+
+class MigrationsTestCase(TestCase):
+    """Test bringing older databases up to date."""
+
+    def setUp(self):
+        """Start from a current schema with no migration history."""
+
+        db.drop_all()
+        db.create_all()
+        schema_migrations.drop(db.engine, checkfirst=True)
+
+        u = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Message(text="hello", user_id=u.id))
+        db.session.commit()
+        self.uid = u.id
+
+        # As `flask db-upgrade` runs them
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+
+    def test_upgrade_current_schema(self):
+        """Does a schema made by create_all() just get every version recorded?"""
+
+        self.assertEqual(upgrade(), [version for version, fn in MIGRATIONS])
+        db.session.commit()
+        self.assertEqual(upgrade(), [])
+
+    def test_upgrade_adds_missing(self):
+        """Are dropped counter columns and feed indexes restored?"""
+
+        db.session.execute(text("DROP INDEX ix_messages_user_id_timestamp"))
+        db.session.execute(text("ALTER TABLE users DROP COLUMN messages_count"))
+        db.session.commit()
+
+        upgrade()
+        db.session.commit()
+
+        inspector = inspect(db.engine)
+        self.assertIn("messages_count",
+                      [col["name"] for col in inspector.get_columns("users")])
+        self.assertIn("ix_messages_user_id_timestamp",
+                      [index["name"] for index in inspector.get_indexes("messages")])
+        self.assertEqual(User.query.get(self.uid).messages_count, 1)
+
+    def test_upgrade_pads_sqlite_timestamps(self):
+        """Are SQLite message times stored without microseconds padded?"""
+
+        if db.engine.dialect.name != 'sqlite':
+            self.skipTest("SQLite only")
+        db.session.execute(text("UPDATE messages SET timestamp = '2022-01-01 12:00:00'"))
+        db.session.commit()
+
+        upgrade()
+        db.session.commit()
+
+        stored = db.session.execute(text("SELECT timestamp FROM messages")).scalar()
+        self.assertEqual(stored, "2022-01-01 12:00:00.000000")
+
+
+class OriginalSchemaTestCase(TestCase):
+    """Test upgrading a database made by the first version of Warbler."""
+
+    def setUp(self):
+        db.drop_all()
+        schema_migrations.drop(db.engine, checkfirst=True)
+
+        users, follows, messages, likes = create_original_schema(db.session.connection())
+        db.session.execute(users.insert(), [
+            {'id': 1, 'email': "a@test.com", 'username': "a", 'password': "x"},
+            {'id': 2, 'email': "b@test.com", 'username': "b", 'password': "x"}])
+        db.session.execute(follows.insert().values(user_being_followed_id=2,
+                                                   user_following_id=1))
+        db.session.execute(messages.insert(), [
+            {'id': 1, 'text': "from a", 'user_id': 1, 'timestamp': datetime(2022, 1, 1)},
+            {'id': 2, 'text': "from b", 'user_id': 2, 'timestamp': datetime(2022, 1, 2)}])
+        db.session.execute(likes.insert().values(id=1, user_id=1, message_id=2))
+        db.session.commit()
+
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+        db.drop_all()
+        db.create_all()
+
+    def test_upgrade_original_schema(self):
+        """Does every migration apply, leaving counts and timelines filled?"""
+
+        self.assertEqual(upgrade(), [version for version, fn in MIGRATIONS])
+        db.session.commit()
+
+        a, b = User.query.get(1), User.query.get(2)
+        self.assertEqual((a.messages_count, a.following_count, a.likes_count), (1, 1, 1))
+        self.assertEqual((b.messages_count, b.followers_count), (1, 1))
+        self.assertEqual(Message.query.get(2).likes_count, 1)
+        self.assertTrue(all(m.fanned_out for m in Message.query))
+
+        self.assertEqual(TimelineEntry.query.count(), 3)
+        self.assertEqual([m.text for m in timeline.home_messages(1)], ["from b", "from a"])
+        self.assertEqual([m.text for m in timeline.home_messages(2)], ["from b"])
@@ -0,0 +1,121 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_replicas.py
+#
+# A second database stands in for the replica; it's created if needed.
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from models import db, User, Message
+from replicas import PRIMARY_UNTIL, RoutingSQLAlchemy
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test that read-only pages read from the replica, and writes don't."""
+
+    def setUp(self):
+        """Set up a primary and a replica holding different data."""
+
+        app.config['SQLALCHEMY_BINDS'] = {'replica0': REPLICA_URL}
+        app.config['DATABASE_REPLICAS'] = ['replica0']
+
+        db.drop_all()
+        db.create_all()
+        self.replica = db.get_engine(app, bind='replica0')
+        db.Model.metadata.drop_all(self.replica)
+        db.Model.metadata.create_all(self.replica)
+
+        self.client = app.test_client()
+
+        testuser = User.signup("testuser", "test@test.com", "testuser", None)
+        u1 = User.signup("abc", "test1@test.com", "password", None)
+        db.session.commit()
+        self.testuser_id = testuser.id
+        self.u1_id = u1.id
+
+        # The same users, under other names, on the replica
+        with Session(self.replica) as replica:
+            replica.add_all([
+                User(id=self.testuser_id, username="testuser", email="test@test.com",
+                     password=testuser.password),
+                User(id=self.u1_id, username="abc-on-replica", email="test1@test.com",
+                     password=u1.password)])
+            replica.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        app.config['SQLALCHEMY_BINDS'] = {}
+        app.config['DATABASE_REPLICAS'] = []
+
+    def replica_messages(self):
+        with Session(self.replica) as replica:
+            return [m.text for m in replica.query(Message)]
+
+    def test_read_only_pages_use_replica(self):
+        """Are read-only pages read from the replica, and other pages not?"""
+
+        resp = self.client.get(f"/users/{self.u1_id}")
+        self.assertIn("abc-on-replica", str(resp.data))
+
+        resp = self.client.get("/users")
+        self.assertIn("abc-on-replica", str(resp.data))
+
+        # Not marked read-only
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            resp = c.get("/users/profile")
+        self.assertIn('value="abc"', str(resp.data))
+
+    def test_writes_use_primary_and_stick(self):
+        """Do writes go to the primary, and the writer's reads follow them?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post("/messages/new", data={"text": "written"})
+
+            self.assertEqual([m.text for m in Message.query], ["written"])
+            self.assertEqual(self.replica_messages(), [])
+
+            # Just wrote: read from the primary
+            resp = c.get(f"/users/{self.testuser_id}")
+            self.assertIn("written", str(resp.data))
+
+            # Later, back to the replica
+            with c.session_transaction() as sess:
+                sess[PRIMARY_UNTIL] = 0
+            resp = c.get(f"/users/{self.testuser_id}")
+            self.assertNotIn("written", str(resp.data))
+
+    def test_pool_options(self):
+        """Are the pool options used, leaving out sizes for SQLite?"""
+
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+        if db.engine.dialect.name == 'sqlite':
+            self.assertFalse(hasattr(db.engine.pool, 'size'))
+        else:
+            self.assertEqual(db.engine.pool.size(), options['pool_size'])
+            self.assertEqual(db.engine.pool._max_overflow, options['max_overflow'])
+        self.assertEqual(db.engine.pool._pre_ping, options['pool_pre_ping'])
+        self.assertEqual(db.engine.pool._recycle, options['pool_recycle'])
+
+        lite = RoutingSQLAlchemy().create_engine(make_url("sqlite://"), dict(options))
+        self.assertEqual(lite.pool._recycle, options['pool_recycle'])
@@ -0,0 +1,246 @@
+"""Live feed stream tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_stream.py
+
+
+import json
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from stream import LocalPubSub, PostgresPubSub
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def parse_events(chunks):
+    """The (id, data) of each message event in SSE `chunks`."""
+
+    events = []
+    for block in "".join(chunks).split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines()
+                      if not line.startswith(":") and ": " in line)
+        if fields.get("event") == "message":
+            events.append((int(fields["id"]), json.loads(fields["data"])))
+    return events
+
+
+class LocalPubSubTestCase(TestCase):
+    """Test delivering message events on commit."""
+
+    def test_delivered_on_commit(self):
+        """Are events held until commit, and dropped on rollback?"""
+        db.drop_all()
+        db.create_all()
+        user = User.signup("testuser", "test@test.com", "testuser", None)
+        db.session.commit()
+        user_id = user.id
+
+        pubsub = app.extensions['pubsub']
+        subscription = pubsub.subscribe()
+        try:
+            msg = Message(text="rolled back", user_id=user_id)
+            db.session.add(msg)
+            db.session.flush()
+            pubsub.publish(msg.id, user_id)
+            self.assertEqual(subscription.get(timeout=0), [])
+            db.session.rollback()
+            db.session.commit()
+            self.assertEqual(subscription.get(timeout=0), [])
+
+            msg = Message(text="committed", user_id=user_id)
+            db.session.add(msg)
+            db.session.flush()
+            pubsub.publish(msg.id, user_id)
+            db.session.commit()
+            self.assertEqual(subscription.get(timeout=1), [(msg.id, user_id)])
+        finally:
+            subscription.close()
+
+    def test_overflow(self):
+        """Does a subscriber that falls behind get dropped?"""
+        pubsub = LocalPubSub(queue_size=1)
+        subscription = pubsub.subscribe()
+        pubsub.deliver([(1, 1), (2, 1)])
+        self.assertTrue(subscription.overflowed)
+        subscription.close()
+        self.assertEqual(pubsub.subscriber_count(), 0)
+
+
+Notify = namedtuple('Notify', ['payload'])
+
+
+class StopListening(BaseException):
+    """Ends a `_listen` loop under test (it only catches Exception)."""
+
+
+class StubDBAPIConnection:
+    """A psycopg2-like connection that hears one notification, then fails."""
+
+    def __init__(self):
+        self._readable, self._writer = socket.socketpair()
+        self._writer.send(b"x")
+        self.autocommit = False
+        self.executed = []
+        self.notifies = []
+        self.polls = 0
+        self.closed = False
+
+    def fileno(self):
+        return self._readable.fileno()
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def poll(self):
+        self.polls += 1
+        if self.polls > 1:
+            raise OSError("server closed the connection")
+        self.notifies.append(Notify("5:7"))
+
+    def close(self):
+        self.closed = True
+        self._readable.close()
+        self._writer.close()
+
+
+class StubEngine:
+    """Hands out one stub connection, then stops the listener."""
+
+    def __init__(self):
+        self.connections = []
+
+    def raw_connection(self):
+        if self.connections:
+            raise StopListening()
+        dbapi_connection = StubDBAPIConnection()
+        self.connections.append(dbapi_connection)
+        return namedtuple('PooledConnection', ['connection', 'detach'])(
+            dbapi_connection, lambda: None)
+
+
+class PostgresPubSubTestCase(TestCase):
+    """Test the LISTEN/NOTIFY listener loop against a stub connection."""
+
+    def test_listen(self):
+        """Are notifications delivered, and a failed connection closed and
+        its subscribers dropped?"""
+        engine = StubEngine()
+        pubsub = PostgresPubSub(engine)
+        # Listen in this thread rather than the one subscribe() would start
+        pubsub._listener = object()
+        subscription = pubsub.subscribe()
+
+        with patch("stream.time.sleep"), self.assertRaises(StopListening):
+            pubsub._listen()
+
+        connection = engine.connections[0]
+        self.assertEqual(connection.executed, ['LISTEN "warbler_messages"'])
+        self.assertTrue(connection.autocommit)
+        self.assertTrue(connection.closed)
+        self.assertEqual(subscription.get(timeout=0), [(5, 7)])
+        self.assertTrue(subscription.overflowed)
+
+
+class StreamTestCase(TestCase):
+    """Test the /api/stream Server-Sent Events endpoint."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.followed = User.signup("followed", "followed@test.com", "password", None)
+        self.stranger = User.signup("stranger", "stranger@test.com", "password", None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+        self.followed_id = self.followed.id
+        self.stranger_id = self.stranger.id
+
+        db.session.add(Follows(user_being_followed_id=self.followed_id,
+                               user_following_id=self.testuser_id))
+        db.session.commit()
+
+        app.config['STREAM_KEEPALIVE'] = 0.05
+        app.config['STREAM_MAX_SECONDS'] = 0
+
+    def tearDown(self):
+        app.config['STREAM_KEEPALIVE'] = 15
+        app.config['STREAM_MAX_SECONDS'] = 300
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_catch_up(self):
+        """Does a resuming client get missed messages from followed users only?"""
+        old = Message(text="seen already", user_id=self.followed_id)
+        db.session.add(old)
+        db.session.commit()
+        old_id = old.id
+        db.session.add_all([Message(text="missed", user_id=self.followed_id),
+                            Message(text="stranger's", user_id=self.stranger_id)])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.testuser_id)
+            resp = c.get("/api/stream", headers={"Last-Event-ID": str(old_id)})
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            events = parse_events([resp.get_data(as_text=True)])
+
+        self.assertEqual([data["text"] for id, data in events], ["missed"])
+        self.assertGreater(events[0][0], old_id)
+        self.assertTrue(events[0][1]["user"]["image_url"].startswith("/img/timeline/"))
+
+    def test_live(self):
+        """Are messages posted while streaming pushed to followers?"""
+        app.config['STREAM_MAX_SECONDS'] = 5
+
+        def post(user_id, text):
+            client = app.test_client()
+            self.login(client, user_id)
+            client.post("/api/messages", json={"text": text})
+
+        def post_later():
+            time.sleep(0.2)
+            post(self.stranger_id, "not for you")
+            post(self.followed_id, "live warble")
+
+        self.login(self.client, self.testuser_id)
+        resp = self.client.get("/api/stream", buffered=False)
+        chunks = []
+        poster = threading.Thread(target=post_later)
+        poster.start()
+        try:
+            for chunk in resp.response:
+                chunks.append(chunk.decode() if isinstance(chunk, bytes) else chunk)
+                if parse_events(chunks):
+                    break
+        finally:
+            resp.close()
+            poster.join()
+
+        self.assertEqual([data["text"] for id, data in parse_events(chunks)], ["live warble"])
+        self.assertEqual(app.extensions['pubsub'].subscriber_count(), 0)
@@ -0,0 +1,179 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_timeline.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+from models import db, Message, User, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, timeline, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out of messages into home timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+
+        self.testuser2 = User.signup(username="testuser2",
+                                     email="test2@test.com",
+                                     password="testuser2",
+                                     image_url=None)
+
+        db.session.commit()
+
+        self.testuser_id = self.testuser.id
+        self.testuser2_id = self.testuser2.id
+
+    def tearDown(self):
+        db.session.rollback()
+        timeline.fanout_limit = None
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_post_fans_out_to_followers(self):
+        """Does a new message reach the author's and followers' timelines?"""
+        self.testuser.following.append(self.testuser2)
+        db.session.commit()
+        with self.client as c:
+            self.login(c, self.testuser2_id)
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+        msg = Message.query.one()
+        readers = {e.user_id for e in TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(readers, {self.testuser_id, self.testuser2_id})
+        self.assertEqual(timeline.home_messages(self.testuser_id), [msg])
+
+    def test_homepage_shows_timeline(self):
+        """Does the homepage render messages from the timeline?"""
+        with self.client as c:
+            self.login(c, self.testuser2_id)
+            c.post("/messages/new", data={"text": "Hello followers"})
+            self.login(c, self.testuser_id)
+            c.post(f"/users/follow/{self.testuser2_id}")
+            resp = c.get("/")
+            self.assertIn("Hello followers", str(resp.data))
+
+    def test_unfollow_trims_timeline(self):
+        """Does unfollowing remove that author's messages from the timeline?"""
+        with self.client as c:
+            self.login(c, self.testuser_id)
+            c.post(f"/users/follow/{self.testuser2_id}")
+            self.login(c, self.testuser2_id)
+            c.post("/messages/new", data={"text": "Soon gone"})
+            self.assertEqual(len(timeline.home_messages(self.testuser_id)), 1)
+            self.login(c, self.testuser_id)
+            c.post(f"/users/stop-following/{self.testuser2_id}")
+        self.assertEqual(timeline.home_messages(self.testuser_id), [])
+
+    def test_delete_message_trims_timeline(self):
+        """Does deleting a message remove it from every timeline?"""
+        self.testuser.following.append(self.testuser2)
+        db.session.commit()
+        with self.client as c:
+            self.login(c, self.testuser2_id)
+            c.post("/messages/new", data={"text": "Deleted soon"})
+            msg = Message.query.one()
+            c.post(f"/messages/{msg.id}/delete")
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_backfill(self):
+        """Does backfill rebuild timelines from existing data?"""
+        self.testuser.following.append(self.testuser2)
+        db.session.add(Message(text="Old message", user_id=self.testuser2.id))
+        db.session.commit()
+
+        written = timeline.backfill()
+        db.session.commit()
+        self.assertEqual(written, 2)
+        self.assertEqual(len(timeline.home_messages(self.testuser_id)), 1)
+
+    def test_backfill_caps_each_reader(self):
+        """Does backfill write only each reader's latest entries?"""
+        self.testuser.following.append(self.testuser2)
+        for day in range(1, 4):
+            db.session.add(Message(text=f"Message {day}", user_id=self.testuser2_id,
+                                   timestamp=datetime(2022, 1, day)))
+        db.session.add(Message(text="Own", user_id=self.testuser_id,
+                               timestamp=datetime(2022, 1, 2, 12)))
+        db.session.commit()
+
+        timeline.follow_backfill = 2
+        try:
+            self.assertEqual(timeline.backfill(), 4)
+            db.session.commit()
+        finally:
+            timeline.follow_backfill = app.config['TIMELINE_FOLLOW_BACKFILL']
+
+        self.assertEqual([m.text for m in timeline.home_messages(self.testuser_id)],
+                         ["Message 3", "Own"])
+        self.assertEqual([m.text for m in timeline.home_messages(self.testuser2_id)],
+                         ["Message 3", "Message 2"])
+
+    def test_high_follower_pulled_at_read_time(self):
+        """Are high-follower authors merged in at read time, not fanned out?"""
+        timeline.fanout_limit = 0
+        with self.client as c:
+            self.login(c, self.testuser_id)
+            c.post(f"/users/follow/{self.testuser2_id}")
+            self.login(c, self.testuser2_id)
+            c.post("/messages/new", data={"text": "Popular"})
+
+        msg = Message.query.one()
+        readers = {e.user_id for e in TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(readers, {self.testuser2_id})
+        self.assertEqual(timeline.home_messages(self.testuser_id), [msg])
+        self.assertEqual(timeline.home_messages(self.testuser2_id), [msg])
+
+    def test_author_drops_under_fanout_limit(self):
+        """Do messages posted over the limit stay in feeds once it's raised past them?"""
+        timeline.fanout_limit = 0
+        with self.client as c:
+            self.login(c, self.testuser_id)
+            c.post(f"/users/follow/{self.testuser2_id}")
+            self.login(c, self.testuser2_id)
+            c.post("/messages/new", data={"text": "Posted while popular"})
+            timeline.fanout_limit = 1
+            c.post("/messages/new", data={"text": "Posted since"})
+
+        popular, since = Message.query.order_by(Message.id).all()
+        self.assertFalse(popular.fanned_out)
+        self.assertTrue(since.fanned_out)
+        self.assertEqual(timeline.home_messages(self.testuser_id), [since, popular])
+
+    def test_add_follows_backfills_recent(self):
+        """Does a batch follow copy only each author's latest messages?"""
+        for i in range(3):
+            db.session.add(Message(text=f"Message {i}", user_id=self.testuser2_id))
+        db.session.commit()
+
+        timeline.follow_backfill = 2
+        try:
+            timeline.add_follows(self.testuser_id, [self.testuser2_id])
+            db.session.commit()
+        finally:
+            timeline.follow_backfill = app.config['TIMELINE_FOLLOW_BACKFILL']
+
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.testuser_id).count(), 2)
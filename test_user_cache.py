@@ -0,0 +1,148 @@
+"""Current user cache tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=production python -m unittest test_user_cache.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, Likes, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, user_cache, CURR_USER_KEY
+from user_cache import LRUUserCache, load_current_user
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LRUUserCacheTestCase(TestCase):
+    """Test the in-process snapshot cache."""
+
+    def test_get_set_delete(self):
+        cache = LRUUserCache()
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {"id": 1})
+        self.assertEqual(cache.get(1), {"id": 1})
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUUserCache(maxsize=2)
+        cache.set(1, {"id": 1})
+        cache.set(2, {"id": 2})
+        cache.get(1)
+        cache.set(3, {"id": 3})
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+
+    def test_expires(self):
+        cache = LRUUserCache(ttl=10)
+        with patch("user_cache.monotonic", return_value=100):
+            cache.set(1, {"id": 1})
+        with patch("user_cache.monotonic", return_value=111):
+            self.assertIsNone(cache.get(1))
+
+
+class CurrentUserTestCase(TestCase):
+    """Test building g.user from cached snapshots."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+    def test_snapshot_cached(self):
+        """Is the user loaded from the database only on a cache miss?"""
+        user_cache.delete(self.testuser_id)
+        current = load_current_user(user_cache, self.testuser_id)
+        self.assertEqual(current.username, "testuser")
+        self.assertEqual(user_cache.get(self.testuser_id)["username"], "testuser")
+
+        with patch.object(User, "query") as query:
+            current = load_current_user(user_cache, self.testuser_id)
+            query.get.assert_not_called()
+        self.assertEqual(current.id, self.testuser_id)
+
+    def test_missing_user(self):
+        """Is a deleted user's session treated as logged out?"""
+        self.assertIsNone(load_current_user(user_cache, 404))
+
+    def test_profile_edit_invalidates(self):
+        """Does editing the profile drop the cached snapshot?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.get("/")
+            self.assertIsNotNone(user_cache.get(self.testuser_id))
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser",
+                                           "image_url": "",
+                                           "header_image_url": "",
+                                           "bio": "",
+                                           "location": ""})
+            self.assertIsNone(user_cache.get(self.testuser_id))
+            resp = c.get("/")
+            self.assertIn("@renamed", str(resp.data))
+
+    def test_delete_user_invalidates(self):
+        """Does deleting the user drop the cached snapshot?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.get("/")
+            c.post("/users/delete")
+            self.assertIsNone(user_cache.get(self.testuser_id))
+
+    def test_bulk_counter_updates_invalidate(self):
+        """Do counters changed by bulk UPDATEs drop the users' snapshots?"""
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        other_id = other.id
+        msg = Message(text="liked", user_id=other_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        db.session.add(Likes(user_id=self.testuser_id, message_id=msg_id))
+        db.session.execute(db.update(User).where(User.id == self.testuser_id)
+                           .values(likes_count=1))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.get("/")
+            self.assertEqual(user_cache.get(self.testuser_id)["likes_count"], 1)
+
+            # Deleting the message takes the like off the liker's count
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertIsNone(user_cache.get(self.testuser_id))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.get("/")
+            self.assertEqual(user_cache.get(self.testuser_id)["likes_count"], 0)
+
+            # So does a batch follow for the followed users' follower counts
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            c.post("/api/follows/batch", json={"user_ids": [self.testuser_id]})
+            self.assertIsNone(user_cache.get(self.testuser_id))
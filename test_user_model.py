@@ -7,8 +7,10 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 from sqlalchemy import exc
-from models import db, User
+from models import db, User, Message
+from passwords import hasher, PasswordHasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -88,6 +90,38 @@ class UserModelTestCase(TestCase):
         self.assertFalse(User.authenticate(
             "wrong_username", "HASHED_PASSWORD"))
 
+    def test_rehash_on_login(self):
+        """Is the hash upgraded when the work factor has changed?"""
+        old_hash = self.u1.password
+        rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            self.assertEqual(User.authenticate(self.u1.username, "HASHED_PASSWORD"), self.u1)
+            self.assertNotEqual(self.u1.password, old_hash)
+            self.assertFalse(hasher.needs_rehash(self.u1.password))
+            self.assertEqual(User.authenticate(self.u1.username, "HASHED_PASSWORD"), self.u1)
+        finally:
+            hasher.rounds = rounds
+
+    def test_hasher_queue_depth(self):
+        """Does the queue depth return to zero once hashes finish?"""
+        futures = [hasher.submit_check(self.u1.password, "HASHED_PASSWORD") for i in range(3)]
+        self.assertTrue(all(future.result() for future in futures))
+        self.assertEqual(hasher.queue_depth, 0)
+
+    def test_hasher_workers(self):
+        """Does the pool default to one worker per core, unless configured?"""
+        self.assertEqual(PasswordHasher().workers, os.cpu_count() or 1)
+        self.assertEqual(PasswordHasher(workers=3).workers, 3)
+
+        configured = PasswordHasher()
+        try:
+            with patch.dict(app.config, PASSWORD_HASH_WORKERS=2):
+                configured.init_app(app)
+        finally:
+            app.extensions['password_hasher'] = hasher
+        self.assertEqual(configured.workers, 2)
+
     def test_is_following(self):
         self.assertFalse(self.u1.is_following(self.u2))
         self.u1.following.append(self.u2)
@@ -100,6 +134,43 @@ class UserModelTestCase(TestCase):
         db.session.commit()
         self.assertTrue(self.u1.is_followed_by(self.u2))
 
+    def test_cache_following(self):
+        """Does is_following use the cached set once it's loaded?"""
+        self.u1.following.append(self.u2)
+        db.session.commit()
+        self.assertEqual(self.u1.cache_following(), {self.u2.id})
+        self.u1.following.remove(self.u2)
+        db.session.commit()
+        self.assertTrue(self.u1.is_following(self.u2))
+
+    def test_cache_likes(self):
+        """Does cache_likes return the ids of liked messages?"""
+        m = Message(text="Test Message", user_id=self.u2.id)
+        self.u1.likes.append(m)
+        db.session.commit()
+        self.assertEqual(self.u1.cache_likes(), {m.id})
+
+    def test_search_ranking(self):
+        """Are exact and prefix matches ranked ahead of substrings?"""
+        for username in ["mytestuser", "testuser", "testuser10"]:
+            User.signup(email=f"{username}@test.com", username=username,
+                        password="HASHED_PASSWORD", image_url=None)
+        db.session.commit()
+        found = [u.username for u in User.search("testuser")]
+        self.assertEqual(found[0], "testuser")
+        self.assertEqual(found[-1], "mytestuser")
+        self.assertEqual(len(found), 5)
+
+    def test_search_escapes_wildcards(self):
+        """Are LIKE wildcards in the search term matched literally?"""
+        self.assertEqual(User.search("%"), [])
+        self.assertEqual(User.search("test_ser1"), [])
+
+    def test_directory(self):
+        """Does directory page through users by id?"""
+        self.assertEqual(User.directory(limit=1), [self.u1])
+        self.assertEqual(User.directory(after=self.u1.id), [self.u2])
+
     def test_valid_signup(self):
         self.assertTrue(str(User.signup(email="test4@test4.com", username="testuser4",
                         password="HASHED_PASSWORD", image_url=None)), "<User #None: testuser4, test4@test4.com>")
@@ -108,3 +179,15 @@ class UserModelTestCase(TestCase):
         User.signup(email="test1@test1.com", username="testuser1", password="HASHED_PASSWORD", image_url=None)
         with self.assertRaises(exc.IntegrityError) as context:
             db.session.commit()
+
+    def test_reconcile_counts(self):
+        """Does reconcile_counts repair drifted counters?"""
+        self.u1.following.append(self.u2)
+        self.u1.messages.append(Message(text="Test Message"))
+        db.session.commit()
+        self.assertEqual(User.reconcile_counts(), 2)
+        db.session.commit()
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u1.messages_count, 1)
+        self.assertEqual(self.u2.followers_count, 1)
+        self.assertEqual(User.reconcile_counts(), 0)
@@ -7,16 +7,38 @@
 
 import os
 from unittest import TestCase
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import event
 from models import db, connect_db, Message, User
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
-from app import app, CURR_USER_KEY
+from app import app, timeline, CURR_USER_KEY
 
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Most queries a feed page may run, however many authors it shows.
+FEED_QUERY_BUDGET = 8
+
+
+@contextmanager
+def count_queries():
+    """Collect every SQL statement run inside the block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
 
 class UserViewTestCase(TestCase):
     """Test views for messages."""
@@ -51,6 +73,22 @@ class UserViewTestCase(TestCase):
             self.assertIn("testuser", str(resp.data))
             self.assertIn("testuser2", str(resp.data))
 
+    def test_list_users_paginated(self):
+        """Does the directory link to the next page of users?"""
+        app.config['USERS_PAGE_SIZE'] = 1
+        try:
+            with self.client as c:
+                resp = c.get("/users")
+                self.assertIn("@testuser<", str(resp.data))
+                self.assertNotIn("@testuser2", str(resp.data))
+                self.assertIn(f"/users?after={self.testuser.id}", str(resp.data))
+
+                resp = c.get(f"/users?after={self.testuser.id}")
+                self.assertIn("@testuser2", str(resp.data))
+                self.assertNotIn("More users", str(resp.data))
+        finally:
+            app.config['USERS_PAGE_SIZE'] = 24
+
     def test_users_show(self):
         """Test users_show view function"""
 
@@ -60,6 +98,112 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("@testuser", str(resp.data))
 
+    def test_users_show_paginated(self):
+        """Does users_show link to older messages past the first page?"""
+        for day in range(1, 4):
+            db.session.add(Message(text=f"Message {day}",
+                                   timestamp=datetime(2022, 1, day),
+                                   user_id=self.testuser.id))
+        db.session.commit()
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser.id}?limit=2")
+            self.assertIn("Message 3", str(resp.data))
+            self.assertNotIn("Message 1", str(resp.data))
+            self.assertIn("Older warbles", str(resp.data))
+
+    def add_authors(self, count):
+        """Make `count` users who each post a message testuser can see."""
+        for i in range(count):
+            author = User.signup(username=f"author{i}",
+                                 email=f"author{i}@test.com",
+                                 password="password",
+                                 image_url=None)
+            author.messages.append(Message(text=f"Message by author{i}"))
+            self.testuser.following.append(author)
+        db.session.commit()
+        timeline.backfill()
+        db.session.commit()
+
+    def test_homepage_query_budget(self):
+        """Does the home feed load all authors without one query each?"""
+        self.add_authors(12)
+        user_id = self.testuser.id
+        db.session.expunge_all()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            with count_queries() as statements:
+                resp = c.get("/")
+            self.assertIn("author11", str(resp.data))
+            self.assertLessEqual(len(statements), FEED_QUERY_BUDGET)
+
+    def test_feed_api_query_budget(self):
+        """Does serializing a feed page load all authors in one go?"""
+        self.add_authors(12)
+        user_id = self.testuser.id
+        db.session.expunge_all()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            with count_queries() as statements:
+                resp = c.get("/api/messages")
+            self.assertEqual(len(resp.json["messages"]), 12)
+            self.assertLessEqual(len(statements), FEED_QUERY_BUDGET)
+
+    def test_users_show_query_budget(self):
+        """Does a profile page run a fixed number of queries?"""
+        self.add_authors(1)
+        user_id = self.testuser.id
+        for i in range(8):
+            db.session.add(Message(text=f"Message {i}", user_id=user_id))
+        db.session.commit()
+        db.session.expunge_all()
+        with self.client as c:
+            with count_queries() as statements:
+                resp = c.get(f"/users/{user_id}")
+            self.assertIn("Message 7", str(resp.data))
+            self.assertLessEqual(len(statements), FEED_QUERY_BUDGET)
+
+    def test_list_users_query_budget(self):
+        """Does the user directory check follow state without a query per card?"""
+        self.add_authors(12)
+        user_id = self.testuser.id
+        db.session.expunge_all()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            with count_queries() as statements:
+                resp = c.get("/users")
+            self.assertEqual(str(resp.data).count("Unfollow"), 12)
+            self.assertLessEqual(len(statements), FEED_QUERY_BUDGET)
+
+    def test_search_query_budget(self):
+        """Does the search page load the matching messages' authors in one go?"""
+        self.add_authors(12)
+        db.session.expunge_all()
+        with self.client as c:
+            with count_queries() as statements:
+                resp = c.get("/search?q=message")
+            self.assertIn("author11", str(resp.data))
+            self.assertLessEqual(len(statements), FEED_QUERY_BUDGET)
+
+    def test_likes_query_budget(self):
+        """Does the likes page load the liked messages' authors in one go?"""
+        self.add_authors(12)
+        user = User.query.get(self.testuser.id)
+        for msg in Message.query.all():
+            user.toggle_like(msg.id)
+        db.session.commit()
+        user_id = user.id
+        db.session.expunge_all()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            with count_queries() as statements:
+                resp = c.get(f"/users/{user_id}/likes")
+            self.assertIn("author11", str(resp.data))
+            self.assertLessEqual(len(statements), FEED_QUERY_BUDGET)
+
     def test_show_following(self):
         """Test show_following view function"""
         self.testuser.following.append(self.testuser2)
@@ -118,6 +262,40 @@ class UserViewTestCase(TestCase):
             following = User.query.get(self.testuser.id).following
             self.assertEqual(self.testuser2.username, following[0].username)
 
+    def test_follow_counts(self):
+        """Do following/unfollowing keep the follow counters in step?"""
+        user_id = self.testuser.id
+        follow_id = self.testuser2.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post(f"/users/follow/{follow_id}")
+            self.assertEqual(User.query.get(user_id).following_count, 1)
+            self.assertEqual(User.query.get(follow_id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{follow_id}")
+            self.assertEqual(User.query.get(user_id).following_count, 0)
+            self.assertEqual(User.query.get(follow_id).followers_count, 0)
+
+    def test_delete_user_counts(self):
+        """Does deleting a user decrement counts that included them?"""
+        m = Message(text="Test Message", user_id=self.testuser.id)
+        db.session.add(m)
+        self.testuser.following.append(self.testuser2)
+        self.testuser2.likes.append(m)
+        db.session.commit()
+        User.reconcile_counts()
+        db.session.commit()
+        user_id = self.testuser.id
+        other_id = self.testuser2.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post("/users/delete")
+        other = User.query.get(other_id)
+        self.assertEqual(other.followers_count, 0)
+        self.assertEqual(other.likes_count, 0)
+
     def test_add_follow_not_logged_in(self):
         """Test following a user if not logged in"""
         follow_id = self.testuser2.id
@@ -180,3 +358,92 @@ class UserViewTestCase(TestCase):
             self.assertIn("Access unauthorized", str(resp.data))
 
 
+
+    def test_follow_lists_paginate(self):
+        """Are following/followers listed a page at a time, with the viewer's follow state?"""
+        others = [User.signup(f"other{i}", f"other{i}@test.com", "password", None)
+                  for i in range(5)]
+        db.session.commit()
+        self.testuser2.following.extend(others)
+        self.testuser.following.extend([others[1], self.testuser2])
+        db.session.commit()
+        ids = [other.id for other in others]
+        testuser_id, testuser2_id = self.testuser.id, self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/api/users/{testuser2_id}/following?limit=2")
+            self.assertEqual([u["id"] for u in resp.json["users"]], ids[:2])
+            self.assertEqual([u["is_following"] for u in resp.json["users"]], [False, True])
+            self.assertEqual(resp.json["next"], ids[1])
+
+            resp = c.get(f"/api/users/{testuser2_id}/following?limit=2&after={ids[3]}")
+            self.assertEqual([u["id"] for u in resp.json["users"]], ids[4:])
+            self.assertIsNone(resp.json["next"])
+
+            resp = c.get(f"/api/users/{ids[1]}/followers")
+            self.assertEqual([(u["id"], u["is_following"]) for u in resp.json["users"]],
+                             [(testuser_id, False), (testuser2_id, True)])
+
+            resp = c.get(f"/users/{testuser2_id}/following?limit=2")
+            html = resp.get_data(as_text=True)
+            self.assertIn("@other1", html)
+            self.assertNotIn("@other2", html)
+            self.assertIn(f"?after={ids[1]}", html)
+
+    def test_follow_list_queries(self):
+        """Does a followers page cost the same queries whatever its size?"""
+        others = [User.signup(f"other{i}", f"other{i}@test.com", "password", None)
+                  for i in range(10)]
+        db.session.commit()
+        for other in others:
+            other.following.append(self.testuser2)
+        db.session.commit()
+        testuser2_id = self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            counts = []
+            for limit in (1, 10):
+                c.get(f"/users/{testuser2_id}/followers?limit={limit}")
+                with count_queries() as statements:
+                    resp = c.get(f"/users/{testuser2_id}/followers?limit={limit}")
+                self.assertEqual(resp.status_code, 200)
+                counts.append(len(statements))
+
+        self.assertEqual(counts[0], counts[1])
+
+    def test_likes_paginate(self):
+        """Are liked messages listed newest first, a page at a time, with the viewer's likes?"""
+        liker = User.signup("liker", "liker@test.com", "password", None)
+        msgs = [Message(text=f"liked {i}", user_id=self.testuser2.id) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        liker.likes.extend(msgs)
+        self.testuser.likes.append(msgs[1])
+        db.session.commit()
+        ids = [msg.id for msg in msgs]
+        liker_id = liker.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/api/users/{liker_id}/likes?limit=2")
+            self.assertEqual([(m["id"], m["liked"]) for m in resp.json["messages"]],
+                             [(ids[2], False), (ids[1], True)])
+            self.assertEqual(resp.json["messages"][0]["user"]["username"], "testuser2")
+            self.assertEqual(resp.json["next"], ids[1])
+
+            resp = c.get(f"/api/users/{liker_id}/likes?before={ids[1]}")
+            self.assertEqual([m["id"] for m in resp.json["messages"]], [ids[0]])
+            self.assertIsNone(resp.json["next"])
+
+            resp = c.get(f"/users/{liker_id}/likes?limit=2")
+            html = resp.get_data(as_text=True)
+            self.assertIn("liked 2", html)
+            self.assertNotIn("liked 0", html)
+            self.assertIn(f"?before={ids[1]}", html)
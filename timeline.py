@@ -0,0 +1,328 @@
+"""Materialized home timelines for Warbler.
+
+Instead of building the home feed from every followed account on each
+request, messages are copied ("fanned out") into a per-user `timelines`
+table when they're posted, so reading a feed is a single indexed range
+scan on (user_id, timestamp).
+
+Authors with very large followings can be excluded from fan-out (see
+`fanout_limit`); their messages are merged into the feed at read time.
+"""
+
+import heapq
+
+from sqlalchemy import select, delete, func, union_all, literal
+from sqlalchemy.orm import joinedload
+
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import before_key
+
+TIMELINE_COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+
+class TimelineStore:
+    """Interface for a home timeline backend.
+
+    Write methods are called inside the request's transaction, before
+    commit, so a failed request never leaves a half-delivered message.
+    """
+
+    def add_message(self, message):
+        """Deliver a newly posted `message` to its readers' timelines."""
+        raise NotImplementedError
+
+    def add_messages(self, messages):
+        """Deliver several newly posted messages; by default one at a time."""
+
+        for message in messages:
+            self.add_message(message)
+
+    def remove_message(self, message):
+        """Remove `message` from every timeline it was delivered to."""
+        raise NotImplementedError
+
+    def add_follow(self, follower_id, followed_id):
+        """Copy recent messages of `followed_id` into the follower's timeline."""
+        raise NotImplementedError
+
+    def add_follows(self, follower_id, followed_ids):
+        """Copy recent messages of several followed users; by default one at a time."""
+
+        for followed_id in followed_ids:
+            self.add_follow(follower_id, followed_id)
+
+    def remove_follow(self, follower_id, followed_id):
+        """Remove messages of `followed_id` from the follower's timeline."""
+        raise NotImplementedError
+
+    def remove_user(self, user_id):
+        """Drop the user's own timeline and their messages from all others."""
+        raise NotImplementedError
+
+    def home_messages(self, user_id, limit=100, before=None):
+        """Return the `limit` newest messages for the user's home feed.
+
+        If `before` is a (timestamp, id) key, only older messages are returned.
+        """
+        raise NotImplementedError
+
+    def backfill(self):
+        """Rebuild every timeline from follows and messages.
+
+        Returns the number of timeline entries written.
+        """
+        raise NotImplementedError
+
+
+class SQLTimelineStore(TimelineStore):
+    """Timeline store backed by the `timelines` table.
+
+    fanout_limit: authors with more followers than this aren't fanned out
+    on write; their messages are pulled in when the feed is read. `None`
+    fans out every message. Each message records whether it was fanned
+    out (`Message.fanned_out`), and reads pull in exactly the ones that
+    weren't, so authors crossing the limit either way lose nothing.
+
+    follow_backfill: how many of an author's latest messages are copied
+    into a timeline when someone starts following them, and how many
+    entries `backfill` writes for each reader.
+    """
+
+    def __init__(self, fanout_limit=None, follow_backfill=800):
+        self.fanout_limit = fanout_limit
+        self.follow_backfill = follow_backfill
+
+    def is_high_follower(self, user_id):
+        """Is `user_id` followed by too many users to fan out on write?"""
+
+        if self.fanout_limit is None:
+            return False
+
+        followers = (db.session
+                     .query(User.followers_count)
+                     .filter(User.id == user_id)
+                     .scalar()) or 0
+        return self.over_fanout_limit(followers)
+
+    def over_fanout_limit(self, followers_count):
+        """Is an author with `followers_count` followers too big to fan out?"""
+
+        return self.fanout_limit is not None and followers_count > self.fanout_limit
+
+    def _high_followers(self, user_ids):
+        """The set of `user_ids` currently above the fan-out limit."""
+
+        if self.fanout_limit is None:
+            return set()
+        return set(db.session.scalars(
+            select(User.id)
+            .where(User.id.in_(user_ids))
+            .where(User.followers_count > self.fanout_limit)))
+
+    def delivery(self, message_id, fan_out=True):
+        """INSERT copying a flushed message into its author's timeline, and
+        into its author's followers' timelines if `fan_out`."""
+
+        own = (select(Message.user_id.label('reader_id'),
+                      Message.id, Message.user_id, Message.timestamp)
+               .where(Message.id == message_id))
+        rows = own
+
+        if fan_out:
+            followers = (select(Follows.user_following_id,
+                                Message.id, Message.user_id, Message.timestamp)
+                         .select_from(Message)
+                         .join(Follows,
+                               Follows.user_being_followed_id == Message.user_id)
+                         .where(Message.id == message_id))
+            rows = union_all(own, followers)
+
+        return (TimelineEntry.__table__
+                .insert()
+                .from_select(TIMELINE_COLUMNS, rows))
+
+    def add_message(self, message):
+        db.session.flush()
+        if self.is_high_follower(message.user_id):
+            message.fanned_out = False
+        db.session.execute(self.delivery(message.id, fan_out=message.fanned_out))
+
+    def add_messages(self, messages):
+        db.session.flush()
+        high = self._high_followers({message.user_id for message in messages})
+        for message in messages:
+            if message.user_id in high:
+                message.fanned_out = False
+        if high:
+            db.session.flush()
+        ids = [message.id for message in messages]
+
+        own = (select(Message.user_id.label('reader_id'),
+                      Message.id, Message.user_id, Message.timestamp)
+               .where(Message.id.in_(ids)))
+
+        followers = (select(Follows.user_following_id,
+                            Message.id, Message.user_id, Message.timestamp)
+                     .select_from(Message)
+                     .join(Follows,
+                           Follows.user_being_followed_id == Message.user_id)
+                     .where(Message.id.in_(ids))
+                     .where(Message.fanned_out))
+
+        db.session.execute(TimelineEntry.__table__
+                           .insert()
+                           .from_select(TIMELINE_COLUMNS, union_all(own, followers)))
+
+    def remove_message(self, message):
+        db.session.execute(delete(TimelineEntry)
+                           .where(TimelineEntry.message_id == message.id))
+
+    def add_follow(self, follower_id, followed_id):
+        # Messages that weren't fanned out are pulled in at read time
+        recent = (select(literal(follower_id).label('reader_id'),
+                         Message.id, Message.user_id, Message.timestamp)
+                  .where(Message.user_id == followed_id)
+                  .where(Message.fanned_out)
+                  .order_by(Message.timestamp.desc())
+                  .limit(self.follow_backfill))
+
+        db.session.execute(TimelineEntry.__table__
+                           .insert()
+                           .from_select(TIMELINE_COLUMNS, recent))
+
+    def add_follows(self, follower_id, followed_ids):
+        # Each author's latest `follow_backfill` messages, in one statement
+        ranked = (select(literal(follower_id).label('reader_id'),
+                         Message.id, Message.user_id, Message.timestamp,
+                         func.row_number()
+                         .over(partition_by=Message.user_id,
+                               order_by=Message.timestamp.desc())
+                         .label('rank'))
+                  .where(Message.user_id.in_(followed_ids))
+                  .where(Message.fanned_out)
+                  .subquery())
+
+        recent = (select(ranked.c.reader_id, ranked.c.id,
+                         ranked.c.user_id, ranked.c.timestamp)
+                  .where(ranked.c.rank <= self.follow_backfill))
+
+        db.session.execute(TimelineEntry.__table__
+                           .insert()
+                           .from_select(TIMELINE_COLUMNS, recent))
+
+    def remove_follow(self, follower_id, followed_id):
+        db.session.execute(delete(TimelineEntry)
+                           .where(TimelineEntry.user_id == follower_id)
+                           .where(TimelineEntry.author_id == followed_id))
+
+    def remove_user(self, user_id):
+        db.session.execute(delete(TimelineEntry)
+                           .where((TimelineEntry.user_id == user_id)
+                                  | (TimelineEntry.author_id == user_id)))
+
+    def home_messages(self, user_id, limit=100, before=None):
+        feeds = [db.session.scalars(query).all()
+                 for query in self.home_queries(user_id, limit, before)]
+        return merge_newest(*feeds, limit=limit)
+
+    def home_queries(self, user_id, limit=100, before=None):
+        """Statements for the newest messages of the user's home feed.
+
+        The first reads the materialized timeline. With a fan-out limit, a
+        second reads followed authors' latest messages that weren't fanned
+        out; merge their results with `merge_newest`.
+        """
+
+        messages = (select(Message)
+                    .options(joinedload(Message.user, innerjoin=True))
+                    .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                    .where(TimelineEntry.user_id == user_id))
+        if before is not None:
+            messages = messages.where(before_key(TimelineEntry.timestamp,
+                                                 TimelineEntry.message_id,
+                                                 before))
+        messages = (messages
+                    .order_by(TimelineEntry.timestamp.desc(),
+                              TimelineEntry.message_id.desc())
+                    .limit(limit))
+
+        if self.fanout_limit is None:
+            return [messages]
+
+        # Messages posted while their author was over the limit aren't in
+        # the timeline: read them directly and merge them in.
+        pulled = (select(Message)
+                  .options(joinedload(Message.user, innerjoin=True))
+                  .join(Follows, Follows.user_being_followed_id == Message.user_id)
+                  .where(Follows.user_following_id == user_id)
+                  .where(~Message.fanned_out))
+        if before is not None:
+            pulled = pulled.where(before_key(Message.timestamp, Message.id, before))
+        pulled = (pulled
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(limit))
+
+        return [messages, pulled]
+
+    def backfill(self):
+        db.session.execute(delete(TimelineEntry))
+
+        own = select(Message.user_id.label('reader_id'),
+                     Message.id.label('message_id'),
+                     Message.user_id.label('author_id'),
+                     Message.timestamp)
+
+        followed = (select(Follows.user_following_id,
+                           Message.id, Message.user_id, Message.timestamp)
+                    .select_from(Message)
+                    .join(Follows,
+                          Follows.user_being_followed_id == Message.user_id)
+                    .where(Message.fanned_out))
+
+        # Each reader's latest `follow_backfill` entries, in one statement
+        entries = union_all(own, followed).subquery()
+        ranked = (select(entries,
+                         func.row_number()
+                         .over(partition_by=entries.c.reader_id,
+                               order_by=(entries.c.timestamp.desc(),
+                                         entries.c.message_id.desc()))
+                         .label('rank'))
+                  .subquery())
+
+        newest = (select(ranked.c.reader_id, ranked.c.message_id,
+                         ranked.c.author_id, ranked.c.timestamp)
+                  .where(ranked.c.rank <= self.follow_backfill))
+
+        result = db.session.execute(TimelineEntry.__table__
+                                    .insert()
+                                    .from_select(TIMELINE_COLUMNS, newest))
+        return result.rowcount
+
+
+def merge_newest(*feeds, limit):
+    """Merge newest-first message lists, dropping duplicates, up to `limit`."""
+
+    seen = set()
+    merged = []
+    for msg in heapq.merge(*feeds, key=lambda m: (m.timestamp, m.id), reverse=True):
+        if msg.id not in seen:
+            seen.add(msg.id)
+            merged.append(msg)
+            if len(merged) == limit:
+                break
+    return merged
+
+
+def connect_timeline(app, store=None):
+    """Set up the home timeline store for `app` and return it.
+
+    Pass `store` to use a different `TimelineStore` implementation.
+    """
+
+    if store is None:
+        store = SQLTimelineStore(
+            fanout_limit=app.config.get('TIMELINE_FANOUT_LIMIT'),
+            follow_backfill=app.config.get('TIMELINE_FOLLOW_BACKFILL', 800))
+
+    app.extensions['timeline'] = store
+    return store
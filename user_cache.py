@@ -0,0 +1,180 @@
+"""Cache of the logged-in user for building `g.user` without a query.
+
+Every request needs the current user for the nav bar and stats, but very
+few change it. We keep a small snapshot of the user's display fields in a
+cache and wrap it in `CurrentUser`; views that need to modify the user ask
+for `g.user.instance`, which loads the real `User` row on demand.
+
+Snapshots are dropped whenever a session commits changes to that user
+(profile edits, counter updates, deletes), including bulk UPDATEs of the
+users table, and expire after a TTL to bound staleness from changes made
+elsewhere (e.g. by other processes).
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from models import User
+
+SNAPSHOT_FIELDS = [
+    'id', 'username', 'image_url', 'header_image_url', 'bio', 'location',
+    'messages_count', 'following_count', 'followers_count', 'likes_count',
+]
+
+
+class UserCache:
+    """Interface for a user snapshot cache.
+
+    Snapshots are plain dicts of JSON-friendly values, so a shared backend
+    (e.g. Redis with SETEX/GET/DEL) can implement this by serializing them.
+    """
+
+    def get(self, user_id):
+        """Return the snapshot for `user_id`, or None if it isn't cached."""
+        raise NotImplementedError
+
+    def set(self, user_id, snapshot):
+        """Store `snapshot` for `user_id`."""
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        """Forget any snapshot for `user_id`."""
+        raise NotImplementedError
+
+
+class LRUUserCache(UserCache):
+    """In-process cache holding up to `maxsize` snapshots for `ttl` seconds."""
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires, snapshot = entry
+            if expires < monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def set(self, user_id, snapshot):
+        with self._lock:
+            self._entries[user_id] = (monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+class CurrentUser:
+    """Read-only stand-in for the logged-in `User`, built from a snapshot.
+
+    Has the snapshot fields as attributes plus the follow/like checks,
+    which only need the user's id. Use `instance` to get the `User` itself
+    when a view needs to change it.
+    """
+
+    _following_ids = None
+    _liked_ids = None
+
+    is_following = User.is_following
+    is_followed_by = User.is_followed_by
+    cache_following = User.cache_following
+    cache_likes = User.cache_likes
+
+    def __init__(self, snapshot):
+        self.__dict__.update(snapshot)
+        self._instance = None
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    @property
+    def instance(self):
+        """The `User` row for this user, loaded on first use."""
+
+        if self._instance is None:
+            self._instance = User.query.get(self.id)
+        return self._instance
+
+
+def make_snapshot(user):
+    """Copy the cached fields off a `User`."""
+
+    return {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+
+
+def load_current_user(cache, user_id):
+    """Return a `CurrentUser` for `user_id`, or None if there's no such user."""
+
+    snapshot = cache.get(user_id)
+    if snapshot is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        snapshot = make_snapshot(user)
+        cache.set(user_id, snapshot)
+
+    return CurrentUser(snapshot)
+
+
+def connect_user_cache(app, cache=None):
+    """Set up the current-user cache for `app` and return it.
+
+    Pass `cache` to use a different `UserCache` implementation.
+    """
+
+    if cache is None:
+        cache = LRUUserCache(maxsize=app.config.get('USER_CACHE_SIZE', 10000),
+                             ttl=app.config.get('USER_CACHE_TTL', 60))
+
+    def note_changed_users(session, flush_context):
+        changed = session.info.setdefault('changed_user_ids', set())
+        for obj in session.new | session.dirty | session.deleted:
+            if isinstance(obj, User):
+                changed.add(obj.id)
+
+    def note_bulk_updated_users(orm_execute_state):
+        # e.g. db.update(User).where(...) for counters: these never touch
+        # the session's objects, so look up which rows they'll change
+        if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+            return
+        mapper = orm_execute_state.bind_mapper
+        if mapper is None or mapper.class_ is not User:
+            return
+
+        where = orm_execute_state.statement.whereclause
+        ids = select(User.id) if where is None else select(User.id).where(where)
+        session = orm_execute_state.session
+        session.info.setdefault('changed_user_ids', set()).update(
+            session.execute(ids).scalars())
+
+    def forget_changed_users(session):
+        for user_id in session.info.pop('changed_user_ids', ()):
+            cache.delete(user_id)
+
+    def discard_changed_users(session, previous_transaction):
+        session.info.pop('changed_user_ids', None)
+
+    event.listen(Session, 'after_flush', note_changed_users)
+    event.listen(Session, 'do_orm_execute', note_bulk_updated_users)
+    event.listen(Session, 'after_commit', forget_changed_users)
+    event.listen(Session, 'after_soft_rollback', discard_changed_users)
+
+    app.extensions['user_cache'] = cache
+    return cache